@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processEmails'))
+from llm_inference import Config, Model
+from inferenceBenchmark import time_it
+from syntheticMailbox import generate_emails, synthetic_texts, kind_label
+
+# Backends to compare against the FP32 zero-shot pipeline; the ONNX ones need exportModel.py to have run
+BACKENDS = ["pytorch", "int8", "onnx", "onnx-int8"]
+
+def labelled_texts(labelled_csv, count):
+    # A labelled CSV has 'text' and 'label' columns; without one the synthetic mailbox supplies both
+    if labelled_csv:
+        df = pd.read_csv(labelled_csv, encoding='utf-8').head(count)
+        return df['text'].tolist(), df['label'].tolist()
+    labels = [kind_label(email) for email in generate_emails(count)]
+    return synthetic_texts(count), labels
+
+def to_labels(hypotheses):
+    inverted = {value: key for key, value in Config.hypothesis_class_label_dic.items()}
+    return [inverted[hypothesis] for hypothesis in hypotheses]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    labelled_csv = sys.argv[2] if len(sys.argv) > 2 else None
+    Config.PREDICTION_CACHE_PATH = None
+    texts, labels = labelled_texts(labelled_csv, count)
+    hypotheses = Config.hypothesis_class_lst
+
+    Config.BACKEND = "pytorch"
+    reference = Model()
+    (reference_hypotheses, _), _ = time_it(reference.pipeline_predict, texts, hypotheses)
+    reference_labels = to_labels(reference_hypotheses)
+    del reference
+
+    print(f"{'backend':10s} {'accuracy':>9s} {'agreement':>10s} {'emails/s':>9s} {'1-email latency (ms)':>21s}")
+    for backend in BACKENDS:
+        Config.BACKEND = backend
+        try:
+            model = Model()
+        except (OSError, ImportError) as e:
+            print(f"{backend:10s} skipped: {e}")
+            continue
+        (predicted, _), seconds = time_it(model.engine.predict, texts, hypotheses)
+        _, latency = time_it(model.engine.predict, texts[:1], hypotheses)
+        predicted = to_labels(predicted)
+        accuracy = sum(a == b for a, b in zip(predicted, labels)) / len(texts)
+        agreement = sum(a == b for a, b in zip(predicted, reference_labels)) / len(texts)
+        print(f"{backend:10s} {accuracy:9.1%} {agreement:10.1%} {len(texts) / seconds:9.1f} {latency * 1000:21.1f}")
+
+if __name__ == '__main__':
+    main()
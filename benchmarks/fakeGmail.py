@@ -0,0 +1,95 @@
+import json
+import time
+import base64
+from email.utils import parsedate_to_datetime
+
+def encode_body(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+def text_part(mime_type, text):
+    return {'mimeType': mime_type, 'filename': '', 'body': {'data': encode_body(text)}}
+
+def gmail_message(email):
+    # Builds the users.messages.get resource a synthetic email would come back as
+    headers = [{'name': name, 'value': email[name]} for name in ('From', 'To', 'Subject', 'Date')]
+    if email.get('Headers'):
+        headers += [{'name': name, 'value': value} for name, value in json.loads(email['Headers']).items()]
+    if email['Kind'] == 'newsletter':
+        # Newsletters are HTML only
+        payload = {'mimeType': 'multipart/alternative', 'parts': [text_part('text/html', email['Body'])]}
+    elif email['Kind'] == 'personal':
+        payload = text_part('text/plain', email['Body'])
+    else:
+        # Recruiting systems send both versions
+        html = f"<html><body><p>{email['Body']}</p></body></html>"
+        payload = {'mimeType': 'multipart/alternative',
+                   'parts': [text_part('text/plain', email['Body']), text_part('text/html', html)]}
+    payload['headers'] = headers
+    return {'id': email['MessageID'], 'payload': payload}
+
+
+class FakeRequest:
+    def __init__(self, function):
+        self.function = function
+
+    def execute(self, http=None):
+        return self.function()
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.service.round_trip()
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+
+class FakeGmailService:
+    # Serves users().messages().list/get, getProfile and batch requests from memory,
+    # optionally sleeping latency seconds per HTTP round trip
+    def __init__(self, emails, latency=0.0):
+        self.messages_by_id = {email['MessageID']: gmail_message(email) for email in emails}
+        # Gmail lists the newest mail first
+        self.dated_ids = sorted(((parsedate_to_datetime(email['Date']).timestamp(), email['MessageID']) for email in emails), reverse=True)
+        self.latency = latency
+        self.requests = 0
+
+    def round_trip(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def getProfile(self, userId):
+        return FakeRequest(lambda: {'historyId': '1'})
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def list(self, userId, q='', pageToken=None, maxResults=100):
+        after = int(q.split('after:')[1]) if 'after:' in q else 0
+        def run():
+            self.round_trip()
+            ids = [msg_id for timestamp, msg_id in self.dated_ids if timestamp > after]
+            start = int(pageToken or 0)
+            page = ids[start:start + maxResults]
+            response = {'messages': [{'id': msg_id} for msg_id in page]} if page else {}
+            if start + maxResults < len(ids):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return FakeRequest(run)
+
+    def get(self, userId, id, format='full', fields=None):
+        return FakeRequest(lambda: self.messages_by_id[id])
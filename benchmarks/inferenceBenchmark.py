@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processEmails'))
+from llm_inference import Config, Model
+from syntheticMailbox import synthetic_texts
+
+def time_it(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    Config.PREDICTION_CACHE_PATH = None
+    model = Model()
+    texts = synthetic_texts(count)
+    hypotheses = Config.hypothesis_class_lst
+
+    (pipeline_labels, _), pipeline_seconds = time_it(model.pipeline_predict, texts, hypotheses)
+    (engine_labels, _), engine_seconds = time_it(model.engine.predict, texts, hypotheses)
+    agree = sum(a == b for a, b in zip(pipeline_labels, engine_labels))
+    print(f"Agreement with the zero-shot pipeline: {agree}/{count}")
+
+    _, pipeline_latency = time_it(model.pipeline_predict, texts[:1], hypotheses)
+    _, engine_latency = time_it(model.engine.predict, texts[:1], hypotheses)
+    print(f"{'':10s} {'emails/s':>10s} {'1-email latency (ms)':>22s}")
+    print(f"{'pipeline':10s} {count / pipeline_seconds:10.1f} {pipeline_latency * 1000:22.1f}")
+    print(f"{'NLIEngine':10s} {count / engine_seconds:10.1f} {engine_latency * 1000:22.1f}")
+
+    print(f"{'max tokens':>10s} {'emails/s':>10s} {'padding efficiency':>20s}")
+    for max_batch_tokens in [None, 4096, 8192, 16384, 32768]:
+        model.engine.max_batch_tokens = max_batch_tokens
+        model.engine.real_tokens = model.engine.padded_tokens = 0
+        _, seconds = time_it(model.engine.predict, texts, hypotheses)
+        efficiency = model.engine.padding_stats()['padding_efficiency']
+        print(f"{str(max_batch_tokens):>10s} {count / seconds:10.1f} {efficiency:20.1%}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import re
+import sys
+import time
+import string
+import random
+from bs4 import BeautifulSoup
+from nltk.tokenize import word_tokenize
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processEmails'))
+from textNormalizer import TextNormalizer
+from syntheticMailbox import generate_emails, html_newsletter
+
+def legacy_tokenize(body):
+    # The refine_text chain TextNormalizer replaced, kept as the regression reference
+    if bool(BeautifulSoup(body, "html.parser").find()):
+        soup = BeautifulSoup(body, "html.parser")
+        text = soup.get_text(separator="\n")
+    else:
+        text = body.strip()
+    url_pattern = r'https?://\S+|www\.\S+'
+    text = re.sub(url_pattern, '', text)
+    text = re.sub(r'https?://\S+|www\.\S+', '', text)
+    text = re.sub(r'<.*?>', '', text)
+    text = re.sub(r'\S+@\S+', '', text)
+    text = re.sub(r'\b\w\b', '', text)
+    text = re.sub(r'\d+', '', text)
+    text = re.sub(r'[^a-zA-Z\s]', '', text)
+    text = re.sub(r'\S*@\S*\s?', '', text)
+    text = re.sub(f"[{string.punctuation}]", "", text)
+    text = re.sub(r'\s+', ' ', text).strip()
+    return word_tokenize(text)
+
+EDGE_CASES = [
+    "", "   ", "a < b and c > d", "<!-- only a comment -->", "I cannot go, gonna wanna GOTTA lemme gimme",
+    "mail me at john.doe@example.com or @handle or trailing@ a@b", "<http://x.com/a> foo <b>bold</b>",
+    "visit www.example.com/path?q=1 now", "hthttp://nested.example.com x", "café naïve résumé 123abc x_y a.b.c",
+    "tab\there\nnew\r\nline nbsp em", "&lt;tag&gt; entity &amp; more", "<p>Hello <a href='mailto:x@y.z'>x@y.z</a></p>",
+    "Order #12345 shipped! Track: https://t.co/abc?x=1&y=2.", "don't won't it's O'Neil rock'n'roll",
+    "<<>> <a<b>c> unbalanced <tag", "٣ arabic digits ٤٥ and ²³ superscripts",
+]
+
+def regression_corpus(count):
+    rng = random.Random(1)
+    corpus = list(EDGE_CASES)
+    for email in generate_emails(count):
+        corpus.append(email['Body'])
+        corpus.append(email['Subject'])
+    alphabet = "ab Z@<>/.:w1_é\n\t-'" + "http://" + "www."
+    for _ in range(count):
+        corpus.append(''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 60))))
+    return corpus
+
+def check_regression(corpus):
+    mismatches = [body for body in corpus if TextNormalizer.tokenize(body) != legacy_tokenize(body)]
+    for body in mismatches[:5]:
+        print(f"Mismatch: {body[:80]!r}")
+    print(f"Regression corpus: {len(corpus) - len(mismatches)}/{len(corpus)} identical")
+    return not mismatches
+
+def time_it(function, bodies, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            function(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    ok = check_regression(regression_corpus(count))
+
+    rng = random.Random(2)
+    newsletters = [html_newsletter(rng, 200) for _ in range(50)]
+    size_kb = sum(len(body) for body in newsletters) / 1024
+    legacy = time_it(legacy_tokenize, newsletters)
+    fast = time_it(TextNormalizer.tokenize, newsletters)
+    print(f"{len(newsletters)} HTML newsletters, {size_kb:.0f} KB")
+    print(f"legacy chain:   {legacy:.3f}s  ({size_kb / legacy:.0f} KB/s)")
+    print(f"TextNormalizer: {fast:.3f}s  ({size_kb / fast:.0f} KB/s)  {legacy / fast:.1f}x")
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+import os
+import re
+import sys
+import json
+import time
+import platform
+import resource
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime, timezone
+import pandas as pd
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARKS_DIR, '..', 'processEmails'))
+sys.path.append(os.path.join(BENCHMARKS_DIR, '..', 'mail'))
+import processEmails as refine_stage
+import extract as classify_stage
+from emailStore import EmailStore, StoreConfig
+from pipeline import PipelineConfig, open_classify_manager, open_refine_manager
+from fetchEmails import CSVManager, SQLiteManager
+from fakeGmail import FakeGmailService
+from syntheticMailbox import generate_emails
+import metrics
+
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+SENDER_PATTERN = re.compile(r'from: "[^"@]*@([a-z0-9-]+)')
+
+class StubModel:
+    # Stands in for llm_inference.Model with keyword rules, so the stages around the model do their real work
+    cache = None
+    engine = None
+
+    def predict(self, texts, *args, message_ids=None):
+        labels = []
+        for text in texts:
+            if 'not to move forward' in text:
+                labels.append('Rejected')
+            elif 'offer' in text and 'position' in text:
+                labels.append('Accepted')
+            elif 'application' in text:
+                labels.append('Applied')
+            else:
+                labels.append('Irrelevant')
+        return labels
+
+    def predict_candidates(self, texts, candidate_lists, message_ids=None):
+        return [candidates[0] for candidates in candidate_lists]
+
+
+class StubEntity:
+    label_ = 'ORG'
+
+    def __init__(self, text):
+        self.text = text
+
+
+class StubDoc:
+    def __init__(self, text):
+        match = SENDER_PATTERN.search(text)
+        self.ents = [StubEntity(match.group(1))] if match else []
+
+
+class StubNER:
+    # Stands in for the spaCy pipeline: the sender's domain is the only ORG entity
+    def pipe(self, texts, batch_size=32, n_process=1):
+        for text in texts:
+            yield StubDoc(text)
+
+
+class StageTimer:
+    def __init__(self):
+        self.latencies = []
+        self.emails = 0
+
+    def record(self, seconds, count):
+        self.latencies.append(seconds)
+        self.emails += count
+
+    def result(self):
+        seconds = sum(self.latencies)
+        return {
+            'emails': self.emails,
+            'chunks': len(self.latencies),
+            'seconds': seconds,
+            'emails_per_second': self.emails / seconds if seconds else 0.0,
+            'chunk_p50_ms': percentile(self.latencies, 50) * 1000,
+            'chunk_p95_ms': percentile(self.latencies, 95) * 1000,
+            'chunk_max_ms': max(self.latencies, default=0.0) * 1000,
+            'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+        }
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_classifier(model, ner):
+    email_processor = classify_stage.EmailProcessor()
+    if model == 'stub':
+        email_processor._model = StubModel()
+    else:
+        from llm_inference import Config, Model
+        Config.MODEL_PATH = model
+        # A .bin checkpoint is loaded as it is instead of being converted into the scratch directory
+        Config.WEIGHTS_CACHE_DIR = None
+        Config.PREDICTION_CACHE_PATH = None
+        email_processor._model = Model()
+    if ner == 'stub':
+        email_processor._ner = StubNER()
+    else:
+        email_processor.ner_model = ner
+    email_processor.load()
+    return email_processor
+
+def run_fetch(service, store):
+    timer = StageTimer()
+    fetch_manager = SQLiteManager(service, store, max_messages_per_second=10**9, sync_state_file='sync_state.json')
+    start = time.perf_counter()
+    for emails in fetch_manager.iter_new_emails(PipelineConfig.START_DATE):
+        now = time.perf_counter()
+        timer.record(now - start, len(emails))
+        start = now
+    return timer.result()
+
+def run_refine(store, chunk_size):
+    timer = StageTimer()
+    refine_manager = refine_stage.StoreFileManager(store)
+    email_processor = refine_stage.EmailProcessor(refine_stage.RefineConfig.WORKERS)
+    try:
+        for chunk in refine_manager.iter_emails(chunk_size):
+            start = time.perf_counter()
+            refine_manager.append_emails(email_processor.process_emails(chunk, []))
+            timer.record(time.perf_counter() - start, len(chunk))
+    finally:
+        email_processor.close()
+    return timer.result()
+
+def run_classify(store, email_processor, chunk_size):
+    timer = StageTimer()
+    classify_manager = classify_stage.StoreDataManager(store, 'applicationTracker.csv')
+    for emails_data in classify_manager.iter_emails(chunk_size):
+        start = time.perf_counter()
+        classify_manager.application_tracker.update_application_tracker(emails_data, email_processor)
+        classify_manager.flush_emails(emails_data)
+        timer.record(time.perf_counter() - start, emails_data.shape[0])
+    return timer.result()
+
+def run_fetch_files(service):
+    # save_emails_to_csv writes every page before returning, so the whole fetch is one chunk
+    timer = StageTimer()
+    fetch_manager = CSVManager(service, max_messages_per_second=10**9, sync_state_file='sync_state.json')
+    start = time.perf_counter()
+    fetch_manager.save_emails_to_csv(PipelineConfig.START_DATE)
+    seconds = time.perf_counter() - start
+    timer.record(seconds, pd.read_csv(PipelineConfig.EMAILS_PATH, usecols=['MessageID']).shape[0])
+    return timer.result()
+
+def run_refine_files(chunk_size):
+    timer = StageTimer()
+    refine_manager = open_refine_manager()
+    email_processor = refine_stage.EmailProcessor(refine_stage.RefineConfig.WORKERS)
+    try:
+        for chunk in refine_manager.iter_emails(chunk_size, refine_manager.read_processed_ids()):
+            start = time.perf_counter()
+            refined = email_processor.process_emails(chunk, [])
+            refine_manager.append_emails(refined)
+            refine_manager.flush_emails(refined)
+            timer.record(time.perf_counter() - start, len(chunk))
+    finally:
+        email_processor.close()
+    return timer.result()
+
+def run_classify_files(email_processor, chunk_size):
+    # As in the streaming pipeline, rows tracked from the Parquet dataset are moved to the flushed one at the end
+    timer = StageTimer()
+    classify_manager = open_classify_manager()
+    defer_flush = StoreConfig.PROCESSED_FORMAT == 'parquet'
+    tracked_ids = []
+    for emails_data in classify_manager.iter_emails(chunk_size):
+        start = time.perf_counter()
+        classify_manager.application_tracker.update_application_tracker(emails_data, email_processor)
+        if defer_flush:
+            tracked_ids.extend(emails_data['MessageID'])
+        else:
+            classify_manager.flush_emails(emails_data)
+        timer.record(time.perf_counter() - start, emails_data.shape[0])
+    if tracked_ids:
+        start = time.perf_counter()
+        classify_manager.flush_emails(pd.DataFrame({'MessageID': tracked_ids}))
+        timer.record(time.perf_counter() - start, 0)
+    return timer.result()
+
+def run(count, model='stub', ner='stub', chunk_size=PipelineConfig.CHUNK_SIZE, gmail_latency=0.0):
+    model = model if model == 'stub' else os.path.abspath(model)
+    emails = list(generate_emails(count))
+    result = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'emails': count,
+        'model': model,
+        'ner': ner,
+        'chunk_size': chunk_size,
+        'gmail_latency_s': gmail_latency,
+        'refine_workers': refine_stage.RefineConfig.WORKERS,
+        'backend': StoreConfig.BACKEND,
+        'processed_format': StoreConfig.PROCESSED_FORMAT if StoreConfig.BACKEND == 'csv' else None,
+        'stages': {},
+    }
+    metrics.REGISTRY.reset()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Every stage writes its relative paths (tracker, caches) inside the scratch directory
+        os.chdir(tmp)
+        try:
+            service = FakeGmailService(emails, gmail_latency)
+            # The stages print per email; that output is not part of what is measured
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                email_processor = load_classifier(model, ner)
+                result['model_load_seconds'] = time.perf_counter() - start
+                # The stages run on whichever backend StoreConfig selects, the same one the scripts use
+                if StoreConfig.BACKEND == 'sqlite':
+                    store = EmailStore(os.path.join(tmp, 'emails.db'))
+                    result['stages']['fetch'] = run_fetch(service, store)
+                    result['stages']['refine'] = run_refine(store, chunk_size)
+                    result['stages']['classify'] = run_classify(store, email_processor, chunk_size)
+                    store.close()
+                else:
+                    os.makedirs('mail')
+                    os.makedirs('processEmails')
+                    result['stages']['fetch'] = run_fetch_files(service)
+                    result['stages']['refine'] = run_refine_files(chunk_size)
+                    result['stages']['classify'] = run_classify_files(email_processor, chunk_size)
+        finally:
+            os.chdir(cwd)
+    result['gmail_requests'] = service.requests
+    if email_processor.pre_filter:
+        result['pre_filter'] = email_processor.pre_filter.stats()
+    seconds = sum(stage['seconds'] for stage in result['stages'].values())
+    result['total_seconds'] = seconds
+    result['emails_per_second'] = count / seconds if seconds else 0.0
+    result['peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_SELF)
+    result['children_peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    # What the stages recorded themselves: Gmail request latency, tokenize vs forward time, padding, rows written
+    result['metrics'] = metrics.REGISTRY.snapshot()
+    return result
+
+def report(result, baseline=None):
+    print(f"{result['emails']} emails, model {result['model']}, NER {result['ner']}, chunk size {result['chunk_size']}, "
+          f"backend {result['backend']}" + (f" ({result['processed_format']})" if result.get('processed_format') else ''))
+    print(f"{'stage':10s} {'emails/s':>10s} {'p50 (ms)':>9s} {'p95 (ms)':>9s} {'peak RSS (MB)':>14s}" + (f" {'vs baseline':>12s}" if baseline else ''))
+    for name, stage in result['stages'].items():
+        line = f"{name:10s} {stage['emails_per_second']:10.1f} {stage['chunk_p50_ms']:9.1f} {stage['chunk_p95_ms']:9.1f} {stage['peak_rss_mb']:14.1f}"
+        if baseline and name in baseline['stages'] and baseline['stages'][name]['emails_per_second']:
+            line += f" {stage['emails_per_second'] / baseline['stages'][name]['emails_per_second']:11.2f}x"
+        print(line)
+    print(f"end to end {result['emails_per_second']:.1f} emails/s in {result['total_seconds']:.2f}s, model load {result['model_load_seconds']:.2f}s")
+
+def main():
+    # pipelineBenchmark.py [count] [stub|model_path] [stub|spacy_model] [output.json] [baseline.json]
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    model = sys.argv[2] if len(sys.argv) > 2 else 'stub'
+    ner = sys.argv[3] if len(sys.argv) > 3 else 'stub'
+    output_path = sys.argv[4] if len(sys.argv) > 4 else None
+    baseline = None
+    if len(sys.argv) > 5:
+        with open(sys.argv[5], encoding='utf-8') as file:
+            baseline = json.load(file)
+
+    result = run(count, model, ner)
+    report(result, baseline)
+    if output_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output_path = os.path.join(RESULTS_DIR, f"pipeline-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.json")
+    with open(output_path, 'w', encoding='utf-8') as file:
+        json.dump(result, file, indent=2)
+    print(f"Results written to {output_path}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processEmails'))
+from preFilter import PreFilter
+from syntheticMailbox import generate_emails, hypothesis_text, kind_label
+
+THRESHOLDS = [0.5, 0.7, 1.0, 1.3, 1.6]
+
+def load_emails(count, labelled_csv):
+    # A labelled CSV has 'text' and 'label' columns and optionally 'From' and 'Headers'
+    if labelled_csv and labelled_csv != 'model':
+        df = pd.read_csv(labelled_csv, encoding='utf-8').head(count)
+        senders = df['From'].tolist() if 'From' in df else None
+        headers = df['Headers'].tolist() if 'Headers' in df else None
+        return df['text'].tolist(), senders, headers, df['label'].tolist()
+    emails = list(generate_emails(count))
+    texts = [hypothesis_text(email) for email in emails]
+    labels = [kind_label(email) for email in emails]
+    if labelled_csv == 'model':
+        # The model's own labels are the reference, so recall is measured against what the filter replaces
+        from llm_inference import Config, Model
+        Config.PREDICTION_CACHE_PATH = None
+        labels = Model().predict(texts)
+    return texts, [email['From'] for email in emails], [email['Headers'] for email in emails], labels
+
+def evaluate(routes, labels):
+    routed = [(route, label) for route, label in zip(routes, labels) if route is not None]
+    relevant = [route for route, label in zip(routes, labels) if label != 'Irrelevant']
+    irrelevant = sum(1 for label in labels if label == 'Irrelevant')
+    return {
+        'coverage': len(routed) / len(labels),
+        'routed_accuracy': sum(route == label for route, label in routed) / len(routed) if routed else 1.0,
+        # Share of job mail the filter did not throw away as Irrelevant; anything below 100% is lost applications
+        'relevant_recall': sum(route != 'Irrelevant' for route in relevant) / len(relevant) if relevant else 1.0,
+        'irrelevant_skipped': sum(route == 'Irrelevant' == label for route, label in routed) / irrelevant if irrelevant else 0.0,
+    }
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    labelled_csv = sys.argv[2] if len(sys.argv) > 2 else None
+    texts, senders, headers, labels = load_emails(count, labelled_csv)
+
+    print(f"{'threshold':>9s} {'coverage':>9s} {'routed acc':>11s} {'relevant recall':>16s} {'irrelevant skipped':>19s} {'emails/s':>9s}")
+    for threshold in THRESHOLDS:
+        pre_filter = PreFilter(threshold)
+        start = time.perf_counter()
+        routes = pre_filter.route(texts, senders, headers)
+        seconds = time.perf_counter() - start
+        result = evaluate(routes, labels)
+        print(f"{threshold:9.1f} {result['coverage']:9.1%} {result['routed_accuracy']:11.1%} "
+              f"{result['relevant_recall']:16.1%} {result['irrelevant_skipped']:19.1%} {len(texts) / seconds:9.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import os
+import sys
+import time
+import copy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processEmails'))
+from processEmails import EmailProcessor, RefineConfig
+from syntheticMailbox import generate_emails
+
+def run(emails, workers, chunk_size):
+    email_processor = EmailProcessor(workers, chunk_size)
+    batch = copy.deepcopy(emails)
+    start = time.perf_counter()
+    email_processor.process_emails(batch, [])
+    elapsed = time.perf_counter() - start
+    email_processor.close()
+    return elapsed
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else RefineConfig.CHUNK_SIZE
+    emails = list(generate_emails(count))
+    worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    print(f"{count} emails, chunk size {chunk_size}")
+    print("workers  seconds  emails/s")
+    for workers in worker_counts:
+        elapsed = run(emails, workers, chunk_size)
+        print(f"{workers:7d}  {elapsed:7.2f}  {count / elapsed:8.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+PROCESS_EMAILS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processEmails')
+COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common')
+
+# Each case runs in a fresh interpreter so imports and file caches from earlier cases do not leak into its timing
+PRELUDE = f"""
+import sys, time, json
+start = time.perf_counter()
+sys.path[:0] = [{PROCESS_EMAILS_DIR!r}, {COMMON_DIR!r}]
+"""
+REPORT = """
+print(json.dumps(time.perf_counter() - start))
+"""
+
+CASES = {
+    'import classify stage': """
+import extract
+""",
+    'classify run, no new mail': """
+import extract
+extract.StoreConfig.DB_PATH = DB_PATH
+extract.main()
+""",
+    'import torch + transformers': """
+import llm_inference
+""",
+    'load model': """
+import llm_inference
+llm_inference.Config.MODEL_PATH = MODEL_PATH
+llm_inference.Config.WEIGHTS_CACHE_DIR = WEIGHTS_CACHE_DIR
+llm_inference.Config.PREDICTION_CACHE_PATH = None
+llm_inference.Config.device = 'cpu'
+llm_inference.Model()
+""",
+}
+
+def run_case(code, variables, cwd):
+    # Cases run inside cwd, a temporary directory, so the tracker files extract.main() opens are not the repository's
+    assignments = ''.join(f"{name} = {value!r}\n" for name, value in variables.items())
+    output = subprocess.run([sys.executable, '-c', PRELUDE + assignments + code + REPORT],
+                            capture_output=True, text=True, check=True, cwd=cwd).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    model_path = sys.argv[1] if len(sys.argv) > 1 else "applicationTracker_DeBERTa_v3_base_finetuned"
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        variables = {
+            'DB_PATH': os.path.join(tmp, 'emails.db'),
+            'MODEL_PATH': os.path.abspath(model_path) if os.path.exists(model_path) else model_path,
+            'WEIGHTS_CACHE_DIR': os.path.join(tmp, 'safetensors'),
+        }
+        print(f"{'case':30s} {'best (s)':>9s} {'first (s)':>10s}")
+        for name, code in CASES.items():
+            # The first model load also converts the checkpoint to safetensors; later ones load the cached copy
+            timings = [run_case(code, variables, tmp) for _ in range(repeats)]
+            print(f"{name:30s} {min(timings):9.2f} {timings[0]:10.2f}")
+        cold = dict(variables, WEIGHTS_CACHE_DIR=None)
+        timings = [run_case(CASES['load model'], cold, tmp) for _ in range(repeats)]
+        print(f"{'load model, no weights cache':30s} {min(timings):9.2f} {timings[0]:10.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processEmails'))
+from textNormalizer import TextNormalizer
+
+COMPANIES = ["Interactive Brokers", "Globex", "Initech", "Umbrella Health", "Stark Industries", "Wayne Enterprises",
+             "Hooli", "Pied Piper", "Vandelay Industries", "Soylent Foods", "Cyberdyne Systems", "Wonka Labs"]
+ROLES = ["Software Engineer", "Data Scientist", "Machine Learning Engineer", "Backend Developer", "Software Developer Intern"]
+WORDS = ["update", "team", "product", "launch", "offer", "weekly", "news", "customer", "story", "design", "market",
+         "feature", "community", "event", "release", "growth", "insight", "report", "summer", "sale", "discount"]
+
+APPLIED_TEMPLATE = ("Dear {name}, thank you for applying to the {role} position at {company}. We have received your application "
+                    "and our recruiting team will review it shortly. If your qualifications match our needs we will contact you. "
+                    "Best regards, {company} Talent Acquisition")
+REJECTED_TEMPLATE = ("Hi {name}, thank you for your interest in the {role} role at {company}. After careful consideration we have "
+                     "decided not to move forward with your application at this time. We encourage you to apply again in the future. "
+                     "Sincerely, {company} Recruiting")
+ACCEPTED_TEMPLATE = ("Dear {name}, we are pleased to extend an offer for the {role} position at {company}. Congratulations! Please "
+                     "review the attached offer letter and reply by Friday. Welcome to the team, {company} HR")
+
+def html_newsletter(rng, paragraphs):
+    blocks = []
+    for _ in range(paragraphs):
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 60)))
+        blocks.append(f'<tr><td style="padding:12px;font-family:Arial"><p>{sentence}</p>'
+                      f'<a href="https://news.example.com/track?id={rng.randint(0, 10**9)}">Read more</a></td></tr>')
+    return ('<html><head><style>td {color:#333}</style></head><body><table width="600">' + ''.join(blocks) +
+            '<tr><td><a href="https://news.example.com/unsubscribe">Unsubscribe</a> | support@news.example.com</td></tr>'
+            '</table></body></html>')
+
+def generate_email(rng, index, date):
+    kind = rng.choices(['applied', 'rejected', 'accepted', 'newsletter', 'personal'], weights=[15, 10, 2, 55, 18])[0]
+    company = rng.choice(COMPANIES)
+    role = rng.choice(ROLES)
+    fields = {'name': 'Alex Doe', 'role': role, 'company': company}
+    domain = company.lower().replace(' ', '') + '.com'
+    headers = ''
+    if kind == 'applied':
+        sender, subject, body = f"careers@{domain}", f"Thank you for applying to {company}", APPLIED_TEMPLATE.format(**fields)
+    elif kind == 'rejected':
+        sender, subject, body = f"no-reply@{domain}", f"Your application for {role}", REJECTED_TEMPLATE.format(**fields)
+    elif kind == 'accepted':
+        sender, subject, body = f"hr@{domain}", f"Offer of employment - {role}", ACCEPTED_TEMPLATE.format(**fields)
+    elif kind == 'newsletter':
+        sender = f"newsletter@{rng.choice(WORDS)}news.com"
+        subject = ' '.join(rng.choice(WORDS) for _ in range(6)).title()
+        body = html_newsletter(rng, rng.randint(5, 80))
+        headers = json.dumps({'List-Unsubscribe': f"<mailto:unsubscribe@{sender.split('@')[1]}>"})
+    else:
+        sender = f"friend{rng.randint(1, 50)}@example.com"
+        subject = ' '.join(rng.choice(WORDS) for _ in range(4))
+        body = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(10, 200)))
+    return {
+        'MessageID': f"{index:016x}",
+        'From': sender,
+        'To': "alex.doe@example.com",
+        'Subject': subject,
+        'Body': body,
+        'Date': format_datetime(date),
+        'Headers': headers,
+        'Kind': kind,
+    }
+
+def generate_emails(count, seed=0, start_date=datetime(2023, 8, 2, tzinfo=timezone.utc)):
+    rng = random.Random(seed)
+    date = start_date
+    for index in range(count):
+        date += timedelta(seconds=rng.randint(30, 3600))
+        yield generate_email(rng, index, date)
+
+# Classifier label each kind of synthetic mail should get
+KIND_LABELS = {'applied': 'Applied', 'rejected': 'Rejected', 'accepted': 'Accepted'}
+
+def kind_label(email):
+    return KIND_LABELS.get(email['Kind'], 'Irrelevant')
+
+def hypothesis_text(email):
+    # Same layout as the refine stage's fit_hypothesis, without lemmatization
+    subject = ' '.join(TextNormalizer.tokenize(email['Subject']))
+    body = ' '.join(TextNormalizer.tokenize(email['Body']))
+    return ('The email is from: "' + email['From'] + '". The email subject: "' + subject +
+            '". -end of the email subject. The email body: "' + body + '" -end of the email body. ')
+
+def synthetic_texts(count):
+    return [hypothesis_text(email) for email in generate_emails(count)]
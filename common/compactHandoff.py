@@ -0,0 +1,32 @@
+import csv
+import sys
+from emailStore import StoreConfig
+from handoffLog import HandoffConfig, compact
+
+def set_max_csv_field_size():
+    max_int = sys.maxsize
+    while True:
+        try:
+            csv.field_size_limit(max_int)
+            break
+        except OverflowError:
+            max_int = int(max_int/10)
+
+def compact_all(pairs=HandoffConfig.PAIRS):
+    # Run from the repository root; a fetch or refine appending to a source file finishes before it is compacted
+    set_max_csv_field_size()
+    return sum(compact(source_path, flushed_path) for source_path, flushed_path in pairs)
+
+def compact_processed(roots=(StoreConfig.PROCESSED_DIR, StoreConfig.PROCESSED_FLUSH_DIR)):
+    # Each month of the Parquet datasets is merged into a single file
+    from processedStore import ProcessedStore
+    return sum(ProcessedStore(root).compact() for root in roots)
+
+def main():
+    moved = compact_all()
+    print(f"Moved {moved} consumed rows to the flushed files")
+    if StoreConfig.PROCESSED_FORMAT == 'parquet':
+        print(f"Merged the files of {compact_processed()} months of processed emails")
+
+if __name__ == '__main__':
+    main()
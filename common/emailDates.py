@@ -0,0 +1,159 @@
+import os
+import json
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+# Character codes of the month names, lowercased and packed three to an integer, in calendar order
+MONTH_CODES = [ord(name[0]) << 16 | ord(name[1]) << 8 | ord(name[2])
+               for name in ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']]
+DAYS_IN_MONTH = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+# Characters of a date compared position by position; longer strings are cut, which only drops trailing comments
+FAST_PATH_WIDTH = 40
+
+def date_to_epoch(date):
+    if not date or date == "No Date":
+        return None
+    try:
+        parsed = parsedate_to_datetime(date)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+def dates_to_epochs(dates):
+    # date_to_epoch for a whole column. Dates laid out exactly like 'Tue, 15 Aug 2023 19:48:01 +0000' (or with a one digit day,
+    # and anything after a space at the end) are decoded with numpy on the character codes at fixed positions;
+    # the rest go through date_to_epoch one by one
+    import numpy as np
+    dates = list(dates)
+    if not dates:
+        return []
+    texts = np.array([date if isinstance(date, str) else '' for date in dates], dtype=f'U{FAST_PATH_WIDTH}')
+    chars = texts.view(np.uint32).reshape(len(dates), FAST_PATH_WIDTH).astype(np.int64)
+    rows = np.arange(len(dates))
+    # Positions are those of a two digit day; with one digit everything after the day sits one character earlier
+    short = (chars[:, 6] == ord(' ')).astype(np.int64)
+
+    def at(position):
+        return chars[rows, position - short] if position > 6 else chars[:, position]
+
+    valid = (at(3) == ord(',')) & (at(4) == ord(' ')) & (at(7) == ord(' ')) & (at(11) == ord(' ')) & (at(16) == ord(' '))
+    valid &= (at(19) == ord(':')) & (at(22) == ord(':')) & (at(25) == ord(' ')) & ((at(31) == 0) | (at(31) == ord(' ')))
+    valid &= (at(26) == ord('+')) | (at(26) == ord('-'))
+
+    def number(*positions):
+        nonlocal valid
+        value = np.zeros(len(dates), dtype=np.int64)
+        for position in positions:
+            digit = at(position) - ord('0')
+            valid &= (digit >= 0) & (digit <= 9)
+            value = value * 10 + digit
+        return value
+
+    day = np.where(short == 1, chars[:, 5] - ord('0'), (chars[:, 5] - ord('0')) * 10 + chars[:, 6] - ord('0'))
+    valid &= (chars[:, 5] >= ord('0')) & (chars[:, 5] <= ord('9')) & ((short == 1) | ((chars[:, 6] >= ord('0')) & (chars[:, 6] <= ord('9'))))
+    year, hour, minute, second = number(12, 13, 14, 15), number(17, 18), number(20, 21), number(23, 24)
+    offset_hours, offset_minutes = number(27, 28), number(29, 30)
+    # date_to_epoch rejects offsets of a day or more; anything else unusual is left to it
+    valid &= (offset_hours <= 23) & (offset_minutes <= 59)
+    offset = (offset_hours * 3600 + offset_minutes * 60) * np.where(at(26) == ord('-'), -1, 1)
+    code = (at(8) | 32) << 16 | (at(9) | 32) << 8 | (at(10) | 32)
+    month = np.zeros(len(dates), dtype=np.int64)
+    for number_of_month, month_code in enumerate(MONTH_CODES, start=1):
+        month[code == month_code] = number_of_month
+    valid &= month > 0
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    days_in_month = np.asarray(DAYS_IN_MONTH)[np.maximum(month, 1) - 1] + ((month == 2) & leap)
+    valid &= (day >= 1) & (day <= days_in_month) & (hour <= 23) & (minute <= 59) & (second <= 59)
+    # Days since 1970-01-01 of a proleptic Gregorian date, counted in 400 year eras that start on March 1st
+    shifted_year = year - (month <= 2)
+    era = shifted_year // 400
+    year_of_era = shifted_year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    days = era * 146097 + year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year - 719468
+    epochs = days * 86400 + hour * 3600 + minute * 60 + second - offset
+    return [epoch if ok else date_to_epoch(date) if isinstance(date, str) else None
+            for epoch, ok, date in zip(epochs.tolist(), valid.tolist(), dates)]
+
+def to_epoch(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def email_epochs(emails):
+    # DateEpoch as set at ingest where a row has it, the rest parsed in bulk from Date; a CSV row holds it as a string
+    epochs = [to_epoch(email.get('DateEpoch')) for email in emails]
+    missing = [index for index, epoch in enumerate(epochs) if epoch is None]
+    for index, epoch in zip(missing, dates_to_epochs([emails[index].get('Date') for index in missing])):
+        epochs[index] = epoch
+    return epochs
+
+def epochs_to_timestamps(epochs):
+    # Rows without a date get 1970-01-01, as the refine stage gives them
+    import pandas as pd
+    return pd.to_datetime(pd.to_numeric(pd.Series(epochs), errors='coerce').fillna(0).astype('int64'), unit='s', utc=True)
+
+def parse_iso_dates(values):
+    import pandas as pd
+    return pd.to_datetime(values, utc=True, format='ISO8601', errors='coerce')
+
+def parsed_dates(df):
+    # The ParsedDate column as timestamps: from DateEpoch when the rows carry it, else from the strings in one ISO 8601 pass
+    if 'DateEpoch' in df:
+        return epochs_to_timestamps(df['DateEpoch'])
+    return parse_iso_dates(df['ParsedDate'])
+
+
+class DateSummary:
+    # Earliest and latest DateEpoch of a CSV's rows in a sidecar file, so the latest date is read without scanning the CSV.
+    # The CSV's size is saved with them; a CSV that changed without the summary (compaction, an interrupted run) is scanned once more
+    SUFFIX = '.dates.json'
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.path = csv_path + self.SUFFIX
+        self.earliest = None
+        self.latest = None
+
+    def csv_size(self):
+        return os.path.getsize(self.csv_path) if os.path.isfile(self.csv_path) else 0
+
+    def load(self):
+        size = self.csv_size()
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                summary = json.load(file)
+            if summary['size'] == size:
+                self.earliest, self.latest = summary['earliest'], summary['latest']
+                return self
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        return self.rebuild()
+
+    def rebuild(self):
+        self.earliest = self.latest = None
+        if self.csv_size():
+            import pandas as pd
+            columns = pd.read_csv(self.csv_path, nrows=0).columns
+            usecols = [column for column in ('Date', 'DateEpoch') if column in columns]
+            if usecols:
+                df = pd.read_csv(self.csv_path, usecols=usecols, dtype=str, keep_default_na=False, encoding='utf-8')
+                self.add(email_epochs(df.to_dict('records')))
+        return self.save()
+
+    def add(self, epochs):
+        epochs = [epoch for epoch in epochs if epoch is not None]
+        if self.earliest is not None:
+            epochs += [self.earliest, self.latest]
+        if epochs:
+            self.earliest, self.latest = min(epochs), max(epochs)
+        return self
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'earliest': self.earliest, 'latest': self.latest, 'size': self.csv_size()}, file)
+        os.replace(tmp_path, self.path)
+        return self
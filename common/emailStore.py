@@ -0,0 +1,200 @@
+import os
+import fcntl
+import sqlite3
+import time
+from datetime import datetime, timezone
+from emailDates import email_epochs
+import metrics
+
+class StoreConfig:
+    # 'csv' keeps fetched mail in mail/*.csv and refined mail in the processed datasets below; 'sqlite' keeps every stage
+    # in DB_PATH and is needed by the tracker daemon and by multi-account runs
+    BACKEND = 'csv'
+    DB_PATH = 'mail/emails.db'
+    # SQLite limits the number of bound parameters per statement
+    MAX_IN_PARAMS = 500
+    # With the 'csv' backend, refined emails go to month-partitioned Parquet datasets ('parquet') or the legacy CSVs ('csv')
+    PROCESSED_FORMAT = 'parquet'
+    PROCESSED_DIR = 'processEmails/processed_emails'
+    PROCESSED_FLUSH_DIR = 'processEmails/flushed_processed_emails'
+    # Every append writes one file per month it touches; a month holding more files than this is merged into one
+    PROCESSED_MAX_PARTITION_FILES = 16
+    # Imported into the datasets on first use
+    PROCESSED_CSV_PATH = 'processEmails/processed_emails.csv'
+    PROCESSED_FLUSH_CSV_PATH = 'processEmails/flushed_processed_emails.csv'
+    # Files of the 'csv' backend; switching to 'sqlite' creates DB_PATH from them when it does not exist yet (common/migrateToSQLite.py)
+    LEGACY_PATHS = ['mail/emails.csv', 'mail/flushed_emails.csv', 'mail/fail_emails.csv', PROCESSED_CSV_PATH,
+                    PROCESSED_FLUSH_CSV_PATH, PROCESSED_DIR, PROCESSED_FLUSH_DIR]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    "MessageID" TEXT PRIMARY KEY,
+    "From" TEXT,
+    "To" TEXT,
+    "Subject" TEXT,
+    "Body" TEXT,
+    "Date" TEXT,
+    "DateEpoch" INTEGER,
+    "Headers" TEXT,
+    "RefinedSubject" TEXT,
+    "RefinedBody" TEXT,
+    "text" TEXT,
+    "ParsedDate" TEXT,
+    "Status" TEXT,
+    "fetched_at" INTEGER,
+    "refined_at" INTEGER,
+    "classified_at" INTEGER,
+    "tracked_at" INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_emails_date ON emails("DateEpoch");
+CREATE INDEX IF NOT EXISTS idx_emails_pending_refine ON emails("DateEpoch") WHERE "refined_at" IS NULL;
+CREATE INDEX IF NOT EXISTS idx_emails_pending_classify ON emails("DateEpoch") WHERE "refined_at" IS NOT NULL AND "classified_at" IS NULL;
+CREATE TABLE IF NOT EXISTS failed_emails (
+    "MessageID" TEXT PRIMARY KEY,
+    "failed_at" INTEGER
+);
+"""
+# Columns added after the first release, created on databases that predate them
+ADDED_COLUMNS = {'Headers': 'TEXT'}
+
+
+class EmailStore:
+    def __init__(self, db_path=StoreConfig.DB_PATH):
+        self.db_path = db_path
+        if db_path == StoreConfig.DB_PATH and not os.path.exists(db_path):
+            migrate_legacy_files(db_path)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.add_missing_columns()
+
+    def add_missing_columns(self):
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(emails)')}
+        for name, column_type in ADDED_COLUMNS.items():
+            if name not in columns:
+                self.conn.execute(f'ALTER TABLE emails ADD COLUMN "{name}" {column_type}')
+
+    def close(self):
+        self.conn.close()
+
+    def _chunks(self, items):
+        items = list(items)
+        for i in range(0, len(items), StoreConfig.MAX_IN_PARAMS):
+            yield items[i:i + StoreConfig.MAX_IN_PARAMS]
+
+    def existing_ids(self, msg_ids):
+        existing = set()
+        for chunk in self._chunks(msg_ids):
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(f'SELECT "MessageID" FROM emails WHERE "MessageID" IN ({placeholders})', chunk)
+            existing.update(row[0] for row in rows)
+        return existing
+
+    def exists(self, msg_id):
+        return self.conn.execute('SELECT 1 FROM emails WHERE "MessageID" = ?', (msg_id,)).fetchone() is not None
+
+    def add_fetched(self, emails):
+        now = int(time.time())
+        with self.conn:
+            cursor = self.conn.executemany(
+                'INSERT OR IGNORE INTO emails ("MessageID", "From", "To", "Subject", "Body", "Date", "DateEpoch", "Headers", "fetched_at") '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(email['MessageID'], email['From'], email['To'], email['Subject'], email['Body'], email['Date'],
+                  epoch, email.get('Headers', ''), now) for email, epoch in zip(emails, email_epochs(emails))])
+            self.conn.executemany('DELETE FROM failed_emails WHERE "MessageID" = ?', [(email['MessageID'],) for email in emails])
+        metrics.inc('rows_written_total', cursor.rowcount, table='emails', stage='fetched')
+
+    def add_failed(self, msg_ids):
+        now = int(time.time())
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO failed_emails ("MessageID", "failed_at") VALUES (?, ?)',
+                                  [(msg_id, now) for msg_id in msg_ids])
+
+    def failed_ids(self):
+        return [row[0] for row in self.conn.execute('SELECT "MessageID" FROM failed_emails ORDER BY "failed_at"')]
+
+    def remove_failed(self, msg_ids):
+        with self.conn:
+            self.conn.executemany('DELETE FROM failed_emails WHERE "MessageID" = ?', [(msg_id,) for msg_id in msg_ids])
+
+    def latest_date(self):
+        # One step down idx_emails_date, however many emails the store holds
+        row = self.conn.execute('SELECT MAX("DateEpoch") FROM emails').fetchone()
+        if row[0] is None:
+            return None
+        return datetime.fromtimestamp(row[0], tz=timezone.utc)
+
+    def count(self, stage='fetched'):
+        return self.conn.execute(f'SELECT COUNT(*) FROM emails WHERE "{stage}_at" IS NOT NULL').fetchone()[0]
+
+    def read_pending_refine(self):
+        return [email for chunk in self.iter_pending_refine(StoreConfig.MAX_IN_PARAMS) for email in chunk]
+
+    def iter_pending_refine(self, chunk_size):
+        cursor = self.conn.execute(
+            'SELECT "MessageID", "From", "To", "Subject", "Body", "Date", "DateEpoch", "Headers" FROM emails '
+            'WHERE "refined_at" IS NULL ORDER BY "DateEpoch"')
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+
+    def mark_refined(self, emails):
+        now = int(time.time())
+        with self.conn:
+            cursor = self.conn.executemany(
+                'UPDATE emails SET "RefinedSubject" = ?, "RefinedBody" = ?, "text" = ?, "ParsedDate" = ?, "refined_at" = ? '
+                'WHERE "MessageID" = ?',
+                [(email['Subject'], email['Body'], email['text'], str(email['ParsedDate']), now, email['MessageID'])
+                 for email in emails])
+        metrics.inc('rows_written_total', cursor.rowcount, table='emails', stage='refined')
+
+    def read_pending_classify(self):
+        return [email for chunk in self.iter_pending_classify(StoreConfig.MAX_IN_PARAMS) for email in chunk]
+
+    def iter_pending_classify(self, chunk_size):
+        cursor = self.conn.execute(
+            'SELECT "MessageID", "From", "To", "RefinedSubject" AS "Subject", "RefinedBody" AS "Body", "Date", "DateEpoch", "Headers", "text", "ParsedDate" '
+            'FROM emails WHERE "refined_at" IS NOT NULL AND "classified_at" IS NULL ORDER BY "DateEpoch"')
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+
+    def mark_classified(self, statuses):
+        now = int(time.time())
+        with self.conn:
+            cursor = self.conn.executemany('UPDATE emails SET "Status" = ?, "classified_at" = ? WHERE "MessageID" = ?',
+                                           [(status, now, msg_id) for msg_id, status in statuses.items()])
+        metrics.inc('rows_written_total', cursor.rowcount, table='emails', stage='classified')
+
+    def mark_tracked(self, msg_ids):
+        now = int(time.time())
+        with self.conn:
+            cursor = self.conn.executemany('UPDATE emails SET "tracked_at" = ? WHERE "MessageID" = ?',
+                                           [(now, msg_id) for msg_id in msg_ids])
+        metrics.inc('rows_written_total', cursor.rowcount, table='emails', stage='tracked')
+
+def migrate_legacy_files(db_path):
+    # An upgrade from the 'csv' backend starts from its files instead of fetching every email again. The database is
+    # built under another name and renamed, so a stage opening it at the same time waits on the lock and never sees it half full
+    if not any(os.path.exists(path) for path in StoreConfig.LEGACY_PATHS):
+        return
+    with open(db_path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(db_path):
+            return
+        from migrateToSQLite import migrate
+        print(f"{db_path} not found, importing the existing CSV and Parquet files into it")
+        tmp_path = db_path + '.migrating'
+        for path in (tmp_path, tmp_path + '-wal', tmp_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        store = EmailStore(tmp_path)
+        migrate(store)
+        store.close()
+        os.replace(tmp_path, db_path)
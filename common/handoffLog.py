@@ -0,0 +1,153 @@
+import csv
+import fcntl
+import json
+import os
+
+class HandoffConfig:
+    # <source>.consumed lists the MessageIDs a consumer is done with, one per line
+    LOG_SUFFIX = '.consumed'
+    # Present only while a compaction is between appending to the flushed file and replacing the source
+    JOURNAL_SUFFIX = '.compact'
+    # (source, flushed) pairs compacted by common/compactHandoff.py
+    PAIRS = [
+        ('mail/emails.csv', 'mail/flushed_emails.csv'),
+        ('processEmails/processed_emails.csv', 'processEmails/flushed_processed_emails.csv'),
+    ]
+
+
+class HandoffLog:
+    # Consumers mark rows as done here instead of rewriting the producer's CSV; compact() moves them out later
+    def __init__(self, source_path):
+        self.source_path = source_path
+        self.path = source_path + HandoffConfig.LOG_SUFFIX
+        self.lock_path = self.path + '.lock'
+
+    def lock(self):
+        file = open(self.lock_path, 'a')
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return file
+
+    def read_ids(self):
+        if not os.path.isfile(self.path):
+            return set()
+        with open(self.path, encoding='utf-8') as file:
+            return {line.strip() for line in file if line.strip()}
+
+    def append(self, msg_ids):
+        msg_ids = [str(msg_id) for msg_id in msg_ids]
+        if not msg_ids:
+            return
+        with self.lock():
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write('\n'.join(msg_ids) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+    def trim(self, source_ids):
+        # Keeps only IDs still in the source, which includes any a consumer appended while the compaction ran.
+        # Running it twice gives the same log, so recovery can always redo it.
+        if not os.path.isfile(self.path):
+            return
+        with self.lock():
+            with open(self.path, encoding='utf-8') as file:
+                remaining = [line.strip() for line in file if line.strip() in source_ids]
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                file.write(''.join(msg_id + '\n' for msg_id in remaining))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+
+def source_lock(source_path):
+    # Held by a producer for as long as it appends to source_path, and by the compaction of source_path, which replaces
+    # the file; a producer opens the file only once it holds the lock, so it never appends to a replaced copy
+    file = open(source_path + '.lock', 'a')
+    fcntl.flock(file, fcntl.LOCK_EX)
+    return file
+
+def _fsync_replace(tmp_path, path):
+    with open(tmp_path, 'rb') as file:
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+def source_ids(source_path):
+    with open(source_path, mode='r', newline='', encoding='utf-8') as file:
+        return {row['MessageID'] for row in csv.DictReader(file)}
+
+def recover(source_path, flushed_path):
+    # The source's .tmp file is written before the journal, so while it exists the source has not been replaced
+    # and the flushed file is rolled back; once it is gone the compaction committed and only the log trim is left
+    log = HandoffLog(source_path)
+    journal_path = source_path + HandoffConfig.JOURNAL_SUFFIX
+    tmp_path = source_path + '.tmp'
+    if not os.path.isfile(journal_path):
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        return None
+    with open(journal_path, encoding='utf-8') as file:
+        journal = json.load(file)
+    if os.path.isfile(tmp_path):
+        if os.path.isfile(flushed_path):
+            os.truncate(flushed_path, journal['flushed_size'])
+        os.remove(tmp_path)
+        state = 'rolled back'
+    else:
+        log.trim(source_ids(source_path))
+        state = 'completed'
+    os.remove(journal_path)
+    print(f"Recovered interrupted compaction of {source_path}: {state}")
+    return state
+
+def compact(source_path, flushed_path):
+    # Safe to run next to the stages: producers wait on the source lock, and consumers only append to the log
+    with source_lock(source_path):
+        return _compact(source_path, flushed_path)
+
+def _compact(source_path, flushed_path):
+    recover(source_path, flushed_path)
+    log = HandoffLog(source_path)
+    if not os.path.isfile(log.path) or not os.path.isfile(source_path):
+        return 0
+    consumed = log.read_ids()
+    if not consumed:
+        return 0
+
+    tmp_path = source_path + '.tmp'
+    moved = []
+    kept_ids = set()
+    with open(source_path, mode='r', newline='', encoding='utf-8') as source, \
+            open(tmp_path, mode='w', newline='', encoding='utf-8') as tmp:
+        reader = csv.DictReader(source)
+        writer = csv.DictWriter(tmp, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        for row in reader:
+            if row['MessageID'] in consumed:
+                moved.append(row)
+            else:
+                writer.writerow(row)
+                kept_ids.add(row['MessageID'])
+        source_fieldnames = reader.fieldnames
+
+    flushed_size = os.path.getsize(flushed_path) if os.path.isfile(flushed_path) else 0
+    journal_path = source_path + HandoffConfig.JOURNAL_SUFFIX
+    with open(journal_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump({'flushed_size': flushed_size}, file)
+    _fsync_replace(journal_path + '.tmp', journal_path)
+
+    fieldnames = source_fieldnames
+    if flushed_size:
+        with open(flushed_path, mode='r', newline='', encoding='utf-8') as file:
+            fieldnames = next(csv.reader(file))
+    with open(flushed_path, mode='a', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction='ignore', restval='')
+        if not flushed_size:
+            writer.writeheader()
+        writer.writerows(moved)
+        file.flush()
+        os.fsync(file.fileno())
+
+    _fsync_replace(tmp_path, source_path)
+    log.trim(kept_ids)
+    os.remove(journal_path)
+    print(f"Compacted {source_path}: moved {len(moved)} rows to {flushed_path}")
+    return len(moved)
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+from bisect import bisect_left
+
+class MetricsConfig:
+    # Written at the end of each run: '.json' gets a JSON snapshot, anything else the Prometheus text format
+    # (e.g. a node_exporter textfile collector directory). None keeps the metrics in memory only
+    EXPORT_PATH = None
+    # cProfile stats of the whole run are dumped here when set; open them with pstats or snakeviz
+    PROFILE_PATH = None
+    # DEBUG brings back the per-email output (labels, company names, fetched IDs)
+    LOG_LEVEL = 'INFO'
+    LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+    # Upper bounds of histogram buckets in seconds, or in the metric's own unit for the others
+    TIME_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+    RATIO_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0]
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    # Counters, gauges and histograms keyed by name and a sorted tuple of label pairs; safe to update from the
+    # pipeline's stage threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, buckets=MetricsConfig.TIME_BUCKETS, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())],
+                'gauges': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.gauges.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                                'buckets': dict(zip([str(bound) for bound in histogram.buckets] + ['+Inf'], histogram.counts))}
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def prometheus_text(self):
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return '{' + ','.join(f'{label}="{value}"' for label, value in pairs) + '}' if pairs else ''
+        lines = []
+        with self.lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines.extend(f"{name}{label_text(labels)} {value}" for (metric, labels), value in sorted(metrics.items()) if metric == name)
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip([str(bound) for bound in histogram.buckets] + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{label_text(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{label_text(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path=None):
+        path = path or MetricsConfig.EXPORT_PATH
+        if not path:
+            return None
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            if path.endswith('.json'):
+                json.dump(self.snapshot(), file, indent=2)
+            else:
+                file.write(self.prometheus_text())
+        # Scrapers never see a half written file
+        os.replace(tmp_path, path)
+        return path
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+export = REGISTRY.export
+
+def setup_logging(level=None):
+    logging.basicConfig(level=level or MetricsConfig.LOG_LEVEL, format=MetricsConfig.LOG_FORMAT)
+
+@contextlib.contextmanager
+def profile(path=None):
+    # cProfile only sees the thread that enters this block; py-spy (`py-spy record -o profile.svg -- python ...`)
+    # samples every thread and needs no hook
+    path = path or MetricsConfig.PROFILE_PATH
+    if not path:
+        yield None
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logging.getLogger(__name__).info("Profile written to %s", path)
+
+@contextlib.contextmanager
+def run(name):
+    # Wraps a script's main(): logging, the optional profile, a run timer and the export at the end
+    setup_logging()
+    try:
+        with profile(), timer('run_seconds', script=name):
+            yield REGISTRY
+    finally:
+        path = export()
+        if path:
+            logging.getLogger(__name__).info("Metrics written to %s", path)
@@ -0,0 +1,109 @@
+import csv
+import os
+import sys
+import time
+from emailStore import EmailStore, StoreConfig
+from emailDates import email_epochs
+from handoffLog import HandoffLog
+
+BATCH_SIZE = 1000
+
+def set_max_csv_field_size():
+    max_int = sys.maxsize
+    while True:
+        try:
+            csv.field_size_limit(max_int)
+            break
+        except OverflowError:
+            max_int = int(max_int/10)
+
+def iter_csv_batches(csv_file):
+    if not os.path.exists(csv_file) or os.path.getsize(csv_file) == 0:
+        return
+    with open(csv_file, mode='r', newline='', encoding='utf-8') as file:
+        batch = []
+        for row in csv.DictReader(file):
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def import_fetched(store, csv_file):
+    count = 0
+    for batch in iter_csv_batches(csv_file):
+        store.add_fetched(batch)
+        count += len(batch)
+    print(f"Imported {count} fetched emails from {csv_file}")
+
+def import_failed(store, csv_file):
+    count = 0
+    for batch in iter_csv_batches(csv_file):
+        msg_ids = [row['MessageID'] for row in batch]
+        store.add_failed(set(msg_ids) - store.existing_ids(msg_ids))
+        count += len(batch)
+    print(f"Imported {count} failed ids from {csv_file}")
+
+def add_processed(store, batch, tracked, tracked_ids=()):
+    # Processed rows hold refined Subject/Body; raw columns stay as fetched when the mail/*.csv row exists.
+    # A row tracked in one source stays tracked whatever order the sources are imported in
+    now = int(time.time())
+    updates = []
+    for row in batch:
+        tracked_at = now if tracked or row['MessageID'] in tracked_ids else None
+        updates.append((row['Subject'], row['Body'], row['text'], row['ParsedDate'], now, tracked_at, tracked_at, row['MessageID']))
+    with store.conn:
+        store.conn.executemany(
+            'INSERT OR IGNORE INTO emails ("MessageID", "From", "To", "Date", "DateEpoch", "fetched_at") VALUES (?, ?, ?, ?, ?, ?)',
+            [(row['MessageID'], row['From'], row['To'], row['Date'], epoch, now) for row, epoch in zip(batch, email_epochs(batch))])
+        store.conn.executemany(
+            'UPDATE emails SET "RefinedSubject" = ?, "RefinedBody" = ?, "text" = ?, "ParsedDate" = ?, '
+            '"refined_at" = COALESCE("refined_at", ?), "classified_at" = COALESCE("classified_at", ?), '
+            '"tracked_at" = COALESCE("tracked_at", ?) WHERE "MessageID" = ?', updates)
+
+def import_processed(store, csv_file, tracked):
+    # Rows the classify stage consumed are still in the file until the next compaction; its log marks them as tracked
+    tracked_ids = HandoffLog(csv_file).read_ids()
+    count = 0
+    for batch in iter_csv_batches(csv_file):
+        add_processed(store, batch, tracked, tracked_ids)
+        count += len(batch)
+    print(f"Imported {count} processed emails from {csv_file}")
+
+def import_processed_dataset(store, root, tracked):
+    # The Parquet datasets of PROCESSED_FORMAT = 'parquet'. ParsedDate is stored as text, as the refine stage writes it,
+    # with 1970-01-01 for rows without a date
+    import pandas as pd
+    from processedStore import ProcessedStore
+    count = 0
+    for df in ProcessedStore(root).iter_batches(BATCH_SIZE):
+        df['ParsedDate'] = df['ParsedDate'].fillna(pd.Timestamp(0, tz='UTC')).astype(str)
+        batch = df.astype(object).where(df.notna(), None).to_dict('records')
+        add_processed(store, batch, tracked)
+        count += len(batch)
+    print(f"Imported {count} processed emails from {root}")
+
+def migrate(store):
+    # The files are only read. Rows consumed from mail/emails.csv are imported like any other fetched row:
+    # their refined copies mark them refined
+    set_max_csv_field_size()
+    import_fetched(store, 'mail/emails.csv')
+    import_fetched(store, 'mail/flushed_emails.csv')
+    import_failed(store, 'mail/fail_emails.csv')
+    import_processed(store, 'processEmails/processed_emails.csv', tracked=False)
+    import_processed(store, 'processEmails/flushed_processed_emails.csv', tracked=True)
+    import_processed_dataset(store, StoreConfig.PROCESSED_DIR, tracked=False)
+    import_processed_dataset(store, StoreConfig.PROCESSED_FLUSH_DIR, tracked=True)
+
+def main():
+    # A database that does not exist yet is filled from the files as EmailStore creates it
+    existed = os.path.exists(StoreConfig.DB_PATH)
+    store = EmailStore(StoreConfig.DB_PATH)
+    if existed:
+        migrate(store)
+    print(f"{StoreConfig.DB_PATH}: {store.count('fetched')} fetched, {store.count('refined')} refined, {store.count('tracked')} tracked")
+    store.close()
+
+if __name__ == '__main__':
+    main()
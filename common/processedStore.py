@@ -0,0 +1,268 @@
+import os
+import json
+import uuid
+import fcntl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from emailStore import StoreConfig
+import metrics
+
+SCHEMA = pa.schema([
+    ('MessageID', pa.string()),
+    ('From', pa.string()),
+    ('To', pa.string()),
+    ('Subject', pa.string()),
+    ('Body', pa.string()),
+    ('Date', pa.string()),
+    ('Headers', pa.string()),
+    ('text', pa.string()),
+    ('ParsedDate', pa.timestamp('us', tz='UTC')),
+])
+# Files live under month=YYYY-MM directories so date filters skip whole months without opening them
+PARTITIONING = ds.partitioning(pa.schema([('month', pa.string())]), flavor='hive')
+# What the classify stage reads; Subject and Body are already folded into text
+CLASSIFY_COLUMNS = ['MessageID', 'From', 'Date', 'Headers', 'text', 'ParsedDate']
+
+
+class ProcessedStore:
+    # Refined emails as a month-partitioned Parquet dataset with typed, compressed columns
+    def __init__(self, root, compression='zstd'):
+        self.root = root
+        self.file_options = ds.ParquetFileFormat().make_write_options(compression=compression)
+        # Present only while a move is between writing the target and removing the rows from this dataset
+        self.journal_path = root + '.move'
+
+    def lock(self):
+        # Held by every writer, so a move and an append never rewrite the same files at once
+        file = open(self.root + '.lock', 'a')
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return file
+
+    def dataset(self):
+        if not os.path.isdir(self.root):
+            return None
+        return ds.dataset(self.root, schema=SCHEMA.append(pa.field('month', pa.string())), format='parquet', partitioning=PARTITIONING)
+
+    @staticmethod
+    def to_table(emails):
+        df = pd.DataFrame(list(emails))
+        for field in SCHEMA:
+            if field.name not in df:
+                df[field.name] = None
+        df = df[SCHEMA.names]
+        df['ParsedDate'] = pd.to_datetime(df['ParsedDate'], utc=True, errors='coerce')
+        for name in SCHEMA.names[:-1]:
+            df[name] = df[name].where(df[name].notna(), None).astype(object)
+        table = pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False)
+        month = pc.fill_null(pc.strftime(table['ParsedDate'], format='%Y-%m'), '1970-01')
+        return table.append_column('month', month)
+
+    def append(self, emails, token=None):
+        # The files written are named after token, so an interrupted move can find and delete them;
+        # they are left unmerged until the move is over
+        table = emails if isinstance(emails, pa.Table) else self.to_table(emails)
+        if table.num_rows == 0:
+            return
+        with self.lock():
+            ds.write_dataset(table, self.root, format='parquet', partitioning=PARTITIONING, file_options=self.file_options,
+                             basename_template=f"part-{token or uuid.uuid4().hex}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore')
+            for month in pc.unique(table['month']).to_pylist() if token is None else []:
+                directory = os.path.join(self.root, f'month={month}')
+                if len(self.partition_files(directory)) > StoreConfig.PROCESSED_MAX_PARTITION_FILES:
+                    self.compact_partition(directory)
+        metrics.inc('rows_written_total', table.num_rows, table=os.path.basename(self.root))
+
+    @staticmethod
+    def partition_files(directory):
+        return sorted(name for name in os.listdir(directory) if name.endswith('.parquet')) if os.path.isdir(directory) else []
+
+    def compact(self, max_files=1):
+        # Merges every month holding more than max_files files; common/compactHandoff.py merges them all
+        if not os.path.isdir(self.root):
+            return 0
+        merged = 0
+        with self.lock():
+            for name in sorted(os.listdir(self.root)):
+                directory = os.path.join(self.root, name)
+                self.recover_partition(directory)
+                if len(self.partition_files(directory)) > max_files:
+                    self.compact_partition(directory)
+                    merged += 1
+        return merged
+
+    def compact_partition(self, directory):
+        # Called with the lock held. The merged file is complete under a hidden name, which the dataset skips,
+        # before the journal lists the files it replaces; only then is it renamed and the old files deleted
+        self.recover_partition(directory)
+        files = self.partition_files(directory)
+        if len(files) < 2:
+            return
+        table = pa.concat_tables([pq.read_table(os.path.join(directory, name), schema=SCHEMA) for name in files])
+        token = uuid.uuid4().hex
+        tmp_path = os.path.join(directory, f'.part-{token}.tmp')
+        merged = f'part-{token}-0.parquet'
+        pq.write_table(table.sort_by('ParsedDate'), tmp_path, compression='zstd')
+        journal_path = os.path.join(directory, '.compact')
+        with open(journal_path, 'w', encoding='utf-8') as file:
+            json.dump({'merged': merged, 'tmp': os.path.basename(tmp_path), 'files': files}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, os.path.join(directory, merged))
+        for name in files:
+            os.remove(os.path.join(directory, name))
+        os.remove(journal_path)
+        metrics.inc('processed_partitions_compacted_total', table=os.path.basename(self.root))
+
+    @staticmethod
+    def recover_partition(directory):
+        # Before the rename the merge is dropped; after it, the files it replaced are deleted
+        journal_path = os.path.join(directory, '.compact')
+        if os.path.isfile(journal_path):
+            with open(journal_path, encoding='utf-8') as file:
+                journal = json.load(file)
+            if os.path.isfile(os.path.join(directory, journal['merged'])):
+                stale = journal['files']
+            else:
+                stale = [journal['tmp']]
+            for name in stale:
+                if name != journal['merged'] and os.path.isfile(os.path.join(directory, name)):
+                    os.remove(os.path.join(directory, name))
+            os.remove(journal_path)
+        # A merge interrupted before its journal was written
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            if name.startswith('.part-') and name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+
+    @staticmethod
+    def date_filter(start=None, end=None):
+        expression = None
+        if start is not None:
+            start = pd.Timestamp(start, tz='UTC') if pd.Timestamp(start).tzinfo is None else pd.Timestamp(start)
+            expression = (ds.field('month') >= start.strftime('%Y-%m')) & (ds.field('ParsedDate') >= start.to_pydatetime())
+        if end is not None:
+            end = pd.Timestamp(end, tz='UTC') if pd.Timestamp(end).tzinfo is None else pd.Timestamp(end)
+            end_expression = (ds.field('month') <= end.strftime('%Y-%m')) & (ds.field('ParsedDate') < end.to_pydatetime())
+            expression = end_expression if expression is None else expression & end_expression
+        return expression
+
+    def read_table(self, columns=None, start=None, end=None):
+        dataset = self.dataset()
+        if dataset is None:
+            return SCHEMA.empty_table().select(columns or SCHEMA.names)
+        return dataset.to_table(columns=columns or SCHEMA.names, filter=self.date_filter(start, end))
+
+    def read(self, columns=None, start=None, end=None):
+        return self.read_table(columns, start, end).to_pandas()
+
+    def iter_batches(self, chunk_size, columns=None, start=None, end=None):
+        dataset = self.dataset()
+        if dataset is None:
+            return
+        # Record batches end at file boundaries, so they are regrouped into chunks of exactly chunk_size rows
+        pending = None
+        for batch in dataset.to_batches(columns=columns or SCHEMA.names, filter=self.date_filter(start, end), batch_size=chunk_size):
+            table = pa.Table.from_batches([batch])
+            pending = table if pending is None else pa.concat_tables([pending, table])
+            while pending.num_rows >= chunk_size:
+                yield pending.slice(0, chunk_size).to_pandas()
+                pending = pending.slice(chunk_size)
+        if pending is not None and pending.num_rows:
+            yield pending.to_pandas()
+
+    def ids(self):
+        return set(self.read_table(['MessageID'])['MessageID'].to_pylist())
+
+    def count(self):
+        dataset = self.dataset()
+        return dataset.count_rows() if dataset else 0
+
+    def files_with(self, value_set):
+        dataset = self.dataset()
+        if dataset is None:
+            return []
+        return [path for path in dataset.files
+                if pc.any(pc.is_in(pq.read_table(path, columns=['MessageID'])['MessageID'], value_set=value_set)).as_py()]
+
+    def remove(self, value_set, paths):
+        for path in paths:
+            table = pq.read_table(path, schema=SCHEMA)
+            remaining = table.filter(pc.invert(pc.is_in(table['MessageID'], value_set=value_set)))
+            if remaining.num_rows:
+                tmp_path = path + '.tmp'
+                pq.write_table(remaining, tmp_path, compression='zstd')
+                os.replace(tmp_path, path)
+            else:
+                os.remove(path)
+
+    def write_journal(self, journal):
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(journal, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def move(self, msg_ids, target):
+        # Only files holding one of msg_ids are rewritten; their rows go to target in the same partition layout.
+        # The journal names the move's target files, so a crash before they are complete deletes them again
+        # and a crash after it finishes removing the rows here; no row ends up in both datasets or in neither
+        self.recover()
+        value_set = pa.array(list(set(msg_ids)), type=pa.string())
+        with self.lock():
+            paths = self.files_with(value_set)
+            if not paths:
+                return 0
+            tables = [pq.read_table(path, schema=SCHEMA) for path in paths]
+            selected = pa.concat_tables([table.filter(pc.is_in(table['MessageID'], value_set=value_set)) for table in tables])
+            journal = {'target': target.root, 'token': uuid.uuid4().hex, 'ids': value_set.to_pylist(), 'appended': False}
+            self.write_journal(journal)
+            target.append(selected.append_column('month', pc.fill_null(pc.strftime(selected['ParsedDate'], format='%Y-%m'), '1970-01')),
+                          journal['token'])
+            self.write_journal(dict(journal, appended=True))
+            self.remove(value_set, paths)
+            os.remove(self.journal_path)
+        target.compact(StoreConfig.PROCESSED_MAX_PARTITION_FILES)
+        return selected.num_rows
+
+    def recover(self):
+        if not os.path.isfile(self.journal_path):
+            return None
+        with self.lock():
+            with open(self.journal_path, encoding='utf-8') as file:
+                journal = json.load(file)
+            if journal['appended']:
+                value_set = pa.array(journal['ids'], type=pa.string())
+                self.remove(value_set, self.files_with(value_set))
+                state = 'completed'
+            else:
+                prefix = f"part-{journal['token']}-"
+                for directory, _, names in os.walk(journal['target']):
+                    for name in names:
+                        if name.startswith(prefix):
+                            os.remove(os.path.join(directory, name))
+                state = 'rolled back'
+            os.remove(self.journal_path)
+        print(f"Recovered interrupted move from {self.root}: {state}")
+        return state
+
+    def import_csv(self, csv_path, chunk_size=10000):
+        if self.dataset() is not None or not os.path.isfile(csv_path):
+            return 0
+        imported = 0
+        for df in pd.read_csv(csv_path, encoding='utf-8', chunksize=chunk_size, dtype=str, keep_default_na=False):
+            self.append(df.to_dict('records'))
+            imported += df.shape[0]
+        print(f"Imported {imported} rows from {csv_path} into {self.root}")
+        return imported
+
+def open_processed_stores(processed_dir=StoreConfig.PROCESSED_DIR, flush_dir=StoreConfig.PROCESSED_FLUSH_DIR):
+    # The first run after switching formats carries the existing CSVs over
+    processed_store = ProcessedStore(processed_dir)
+    flush_store = ProcessedStore(flush_dir)
+    processed_store.recover()
+    processed_store.import_csv(StoreConfig.PROCESSED_CSV_PATH)
+    flush_store.import_csv(StoreConfig.PROCESSED_FLUSH_CSV_PATH)
+    return processed_store, flush_store
@@ -0,0 +1,44 @@
+import sqlite3
+import time
+import zlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS raw_bodies (
+    "MessageID" TEXT PRIMARY KEY,
+    "MimeType" TEXT,
+    "Size" INTEGER,
+    "Body" BLOB,
+    "stored_at" INTEGER
+);
+"""
+
+class RawBodyStore:
+    # Full, uncapped email bodies kept zlib compressed beside the capped copies the pipeline works on
+    def __init__(self, db_path, compression_level=6):
+        self.db_path = db_path
+        self.compression_level = compression_level
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def put_many(self, bodies):
+        # bodies are (msg_id, mime_type, text) tuples
+        now = int(time.time())
+        rows = []
+        for msg_id, mime_type, text in bodies:
+            data = text.encode('utf-8')
+            rows.append((msg_id, mime_type, len(data), zlib.compress(data, self.compression_level), now))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO raw_bodies ("MessageID", "MimeType", "Size", "Body", "stored_at") '
+                                  'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def get(self, msg_id):
+        row = self.conn.execute('SELECT "Body" FROM raw_bodies WHERE "MessageID" = ?', (msg_id,)).fetchone()
+        return zlib.decompress(row[0]).decode('utf-8') if row else None
+
+    def stats(self):
+        count, size, stored = self.conn.execute('SELECT COUNT(*), SUM("Size"), SUM(LENGTH("Body")) FROM raw_bodies').fetchone()
+        return {'bodies': count, 'bytes': size or 0, 'compressed_bytes': stored or 0}
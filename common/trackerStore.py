@@ -0,0 +1,148 @@
+import csv
+import os
+import re
+import sqlite3
+import sys
+import time
+from emailDates import date_to_epoch
+import metrics
+
+class TrackerConfig:
+    DB_PATH = 'applicationTracker.db'
+    # The CSV report is rewritten from the store once at the end of a run of extract.py;
+    # the streaming pipeline and the daemon have their own switches, off by default
+    EXPORT_CSV = True
+    FIELDNAMES = ['Company Name', 'Status', 'Email', 'Status Updated']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS applications (
+    "CompanyKey" TEXT,
+    "SenderDomain" TEXT,
+    "Company Name" TEXT,
+    "Email" TEXT,
+    "Status" TEXT,
+    "Status Updated" TEXT,
+    "StatusEpoch" INTEGER,
+    "first_seen_at" INTEGER,
+    "updated_at" INTEGER,
+    PRIMARY KEY ("CompanyKey", "SenderDomain")
+);
+CREATE INDEX IF NOT EXISTS idx_applications_order ON applications("Status" = 'Rejected', "Company Name");
+CREATE TABLE IF NOT EXISTS status_history (
+    "CompanyKey" TEXT,
+    "SenderDomain" TEXT,
+    "MessageID" TEXT,
+    "Status" TEXT,
+    "Status Updated" TEXT,
+    "StatusEpoch" INTEGER,
+    "recorded_at" INTEGER,
+    UNIQUE ("CompanyKey", "SenderDomain", "MessageID")
+);
+"""
+
+COMPANY_SUFFIXES = {'inc', 'llc', 'ltd', 'limited', 'corp', 'corporation', 'co', 'company', 'plc', 'gmbh', 'group', 'the'}
+NON_WORD_PATTERN = re.compile(r'[^a-z0-9]+')
+ADDRESS_PATTERN = re.compile(r'@([\w.-]+)')
+
+def normalize_company(company_name):
+    words = NON_WORD_PATTERN.sub(' ', str(company_name).lower()).split()
+    words = [word for word in words if word not in COMPANY_SUFFIXES]
+    return ' '.join(words) or 'unknown'
+
+def sender_domain(sender):
+    match = ADDRESS_PATTERN.search(str(sender))
+    return match.group(1).lower().rstrip('.') if match else ''
+
+
+class TrackerStore:
+    # One row per (normalized company, sender domain) holding its latest status, plus every status seen in status_history
+    def __init__(self, db_path=TrackerConfig.DB_PATH):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM applications').fetchone()[0]
+
+    def upsert_many(self, updates):
+        # updates are dicts with Company Name, Email, Status, Status Updated and optionally MessageID.
+        # A status only replaces the current one when it is at least as recent, so mail processed out of order
+        # cannot move an application back from Rejected to Applied.
+        now = int(time.time())
+        rows = []
+        for update in updates:
+            epoch = date_to_epoch(update['Status Updated'])
+            rows.append((normalize_company(update['Company Name']), sender_domain(update['Email']),
+                         update['Company Name'], update['Email'], update['Status'], update['Status Updated'],
+                         epoch, update.get('MessageID')))
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO status_history ("CompanyKey", "SenderDomain", "MessageID", "Status", "Status Updated", "StatusEpoch", "recorded_at") '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(row[0], row[1], row[7], row[4], row[5], row[6], now) for row in rows])
+            self.conn.executemany(
+                'INSERT INTO applications ("CompanyKey", "SenderDomain", "Company Name", "Email", "Status", "Status Updated", "StatusEpoch", "first_seen_at", "updated_at") '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT ("CompanyKey", "SenderDomain") DO UPDATE SET '
+                '"Company Name" = excluded."Company Name", "Email" = excluded."Email", "Status" = excluded."Status", '
+                '"Status Updated" = excluded."Status Updated", "StatusEpoch" = excluded."StatusEpoch", "updated_at" = excluded."updated_at" '
+                'WHERE applications."StatusEpoch" IS NULL OR excluded."StatusEpoch" >= applications."StatusEpoch"',
+                [row[:7] + (now, now) for row in rows])
+        metrics.inc('rows_written_total', len(rows), table='applications')
+
+    def history(self, company_name, sender):
+        rows = self.conn.execute(
+            'SELECT "Status", "Status Updated", "MessageID" FROM status_history '
+            'WHERE "CompanyKey" = ? AND "SenderDomain" = ? ORDER BY "StatusEpoch"',
+            (normalize_company(company_name), sender_domain(sender)))
+        return [dict(row) for row in rows]
+
+    def import_csv(self, csv_path):
+        if self.count() or not os.path.isfile(csv_path):
+            return 0
+        with open(csv_path, mode='r', newline='', encoding='utf-8') as file:
+            # Rows get stable placeholder IDs so importing twice does not duplicate their history
+            rows = [dict(row, MessageID=f"csv:{line}") for line, row in enumerate(csv.DictReader(file))]
+        self.upsert_many(rows)
+        print(f"Imported {len(rows)} rows from {csv_path} into {self.db_path}")
+        return len(rows)
+
+    def rows(self):
+        rows = self.conn.execute(
+            'SELECT "Company Name", "Status", "Email", "Status Updated" FROM applications '
+            'ORDER BY "Status" = \'Rejected\', "Company Name"')
+        return [dict(row) for row in rows]
+
+    def export_csv(self, csv_path):
+        write_csv(csv_path, TrackerConfig.FIELDNAMES, self.rows())
+
+def write_csv(csv_path, fieldnames, rows):
+    tmp_path = csv_path + '.tmp'
+    with open(tmp_path, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    os.replace(tmp_path, csv_path)
+
+def export_merged_csv(stores, csv_path):
+    # stores maps an account name to its TrackerStore; the merged report keeps one block of rows per account
+    rows = [dict(row, Account=account) for account, store in sorted(stores.items()) for row in store.rows()]
+    write_csv(csv_path, ['Account'] + TrackerConfig.FIELDNAMES, rows)
+
+def main():
+    # trackerStore.py [db_path] [csv_path] writes the CSV report on demand, e.g. while the daemon runs
+    db_path = sys.argv[1] if len(sys.argv) > 1 else TrackerConfig.DB_PATH
+    csv_path = sys.argv[2] if len(sys.argv) > 2 else 'applicationTracker.csv'
+    store = TrackerStore(db_path)
+    store.export_csv(csv_path)
+    print(f"Exported {store.count()} applications from {db_path} to {csv_path}")
+    store.close()
+
+if __name__ == '__main__':
+    main()
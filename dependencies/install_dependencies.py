@@ -10,15 +10,16 @@ def run_command(command):
         sys.exit(1)
 
 def install_pytorch():
+    # processEmails/onnxBackend.py exports with torch.onnx.export(..., dynamo=False), which needs torch 2.5 or later
     os_type = platform.system()
     if os_type == "Darwin":  # macOS
-        command = "conda install pytorch torchvision torchaudio -c pytorch"
+        command = "conda install \"pytorch>=2.5\" torchvision torchaudio -c pytorch"
     elif os_type == "Windows":
         cuda_version = get_cuda_version()
         if cuda_version:
-            command = f"conda install --yes -c pytorch -c nvidia pytorch torchvision torchaudio cudatoolkit={cuda_version}"
+            command = f"conda install --yes -c pytorch -c nvidia \"pytorch>=2.5\" torchvision torchaudio cudatoolkit={cuda_version}"
         else:
-            command = "conda install --yes -c pytorch torchvision torchaudio -c pytorch-nightly"
+            command = "conda install --yes -c pytorch \"pytorch>=2.5\" torchvision torchaudio -c pytorch-nightly"
     else:
         print(f"Unsupported OS for PyTorch installation: {os_type}")
         sys.exit(1)
@@ -1,186 +1,475 @@
 import os.path
 import base64
+import codecs
+import json
 import pickle
 import csv
+import sys
 import time
+import random
+import logging
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from datetime import datetime, timedelta
-from email.utils import parsedate_to_datetime
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from emailStore import EmailStore, StoreConfig
+from emailDates import DateSummary, date_to_epoch
+from handoffLog import source_lock
+from rawBodyStore import RawBodyStore
+import metrics
+
+logger = logging.getLogger(__name__)
+
 # Increase the maximum field size limit
 csv.field_size_limit(2147483647)  # Max int value for 32/64 bit
 
+class FetchConfig:
+    # Gmail recommends at most 50 calls per batch request
+    BATCH_SIZE = 50
+    # messages.get costs 5 quota units and the per-user limit is 250 units/second
+    MAX_MESSAGES_PER_SECOND = 40
+    # The limiter halves its rate on every quota error, never below this, and regains RATE_INCREASE per clean batch
+    MIN_MESSAGES_PER_SECOND = 2
+    RATE_INCREASE = 1.0
+    MAX_RETRIES = 5
+    # Backoff before retry n is drawn between half and all of min(BACKOFF_CAP, BACKOFF_BASE * 2 ** n) seconds
+    BACKOFF_BASE = 1.0
+    BACKOFF_CAP = 32.0
+    HTTP_TIMEOUT = 60
+    # Headers kept with each email for the classify stage's bulk mail filter
+    KEPT_HEADERS = ['List-Unsubscribe', 'List-Id', 'Precedence', 'Auto-Submitted']
+    # Partial response: only the headers, MIME types and inline body data are downloaded
+    MESSAGE_FIELDS = 'id,payload(mimeType,filename,headers(name,value),body/data,parts(mimeType,filename,body/data,parts(mimeType,filename,body/data,parts)))'
+    # The classifier reads at most 512 tokens, roughly 3,000 characters of text; HTML bodies carry several times
+    # that in markup, so bodies are cut here before anything downstream stores or parses them. None keeps them whole
+    MAX_BODY_CHARS = 20000
+    # Full bodies are kept zlib compressed in this SQLite file when set
+    RAW_BODY_STORE = None
+    LIST_PAGE_SIZE = 500
+
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded'}
+
+def error_reason(error):
+    try:
+        return json.loads(error.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return ''
+
+def classify_error(error):
+    # 'rate_limit' slows the limiter down, 'transient' is retried as is, 'permanent' is never retried
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 429 or (status == 403 and error_reason(error) in RATE_LIMIT_REASONS):
+            return 'rate_limit'
+        if status >= 500 or status == 408:
+            return 'transient'
+        return 'permanent'
+    return 'transient'
+
+def backoff_delay(attempt, base=FetchConfig.BACKOFF_BASE, cap=FetchConfig.BACKOFF_CAP):
+    # Jitter keeps clients that failed together from retrying together
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class RateLimiter:
+    # Token bucket whose rate follows Gmail's answers: halved on quota errors, raised additively after clean batches
+    def __init__(self, rate, min_rate=FetchConfig.MIN_MESSAGES_PER_SECOND, burst=FetchConfig.BATCH_SIZE, increase=FetchConfig.RATE_INCREASE):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate) if rate else 0
+        self.capacity = burst
+        self.increase = increase
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, count=1):
+        if not self.rate:
+            return
+        self.refill()
+        if self.tokens < count:
+            time.sleep((count - self.tokens) / self.rate)
+            self.refill()
+        # A request larger than the bucket leaves it in debt, which the next acquire waits out
+        self.tokens -= count
+
+    def on_success(self):
+        if self.rate:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_rate_limited(self):
+        if self.rate:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            metrics.inc('gmail_rate_limited_total')
+            logger.warning("Gmail quota reached, slowing down to %.1f messages/s", self.rate)
+
 class GmailService:
     SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
-    def __init__(self):
+    def __init__(self, token_path='mail/token.pickle', cred_path='mail/cred.json', interactive=True):
+        self.token_path = token_path
+        self.cred_path = cred_path
+        # Worker processes cannot open a browser, so without interactive a missing or revoked token is an error
+        self.interactive = interactive
         self.service = self.get_gmail_service()
 
     def get_gmail_service(self):
         creds = None
-        if os.path.exists('mail/token.pickle'):
-            with open('mail/token.pickle', 'rb') as token:
+        if os.path.exists(self.token_path):
+            with open(self.token_path, 'rb') as token:
                 creds = pickle.load(token)
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
+            elif not self.interactive:
+                raise RuntimeError(f"No valid Gmail token at {self.token_path}")
             else:
-                flow = InstalledAppFlow.from_client_secrets_file('mail/cred.json', self.SCOPES)
+                flow = InstalledAppFlow.from_client_secrets_file(self.cred_path, self.SCOPES)
                 creds = flow.run_local_server(port=0)
-            with open('mail/token.pickle', 'wb') as token:
+            with open(self.token_path, 'wb') as token:
                 pickle.dump(creds, token)
-        return build('gmail', 'v1', credentials=creds)
+        # The discovery document ships with the client library, and one Http object keeps its connections open across calls.
+        # httplib2.Http is not thread-safe, so a service is only used by the thread that built it; the pipeline's reader
+        # thread, the daemon and each sharded worker process build their own
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=FetchConfig.HTTP_TIMEOUT))
+        return build('gmail', 'v1', http=http, static_discovery=True, cache_discovery=False)
 
 class EmailManager:
-    def __init__(self, service):
+    def __init__(self, service, max_body_chars=FetchConfig.MAX_BODY_CHARS, raw_store=None):
         self.service = service
+        self.max_body_chars = max_body_chars
+        self.raw_store = raw_store
+        self.raw_bodies = []
+        # Messages Gmail refused for good (deleted, not found, malformed), which re-drives skip
+        self.permanent_failures = set()
 
     @staticmethod
-    def decode_mime_data(mime_data):
+    def decode_mime_data(mime_data, max_chars=None):
         try:
-            byte_data = base64.urlsafe_b64decode(mime_data + '===')
-            return byte_data.decode('utf-8')
+            cut = max_chars is not None and len(mime_data) > (max_chars * 4 + 2) // 3 * 4
+            if cut:
+                # A UTF-8 character is at most 4 bytes, and 4 base64 characters carry 3 bytes
+                mime_data = mime_data[:(max_chars * 4 + 2) // 3 * 4]
+            byte_data = base64.urlsafe_b64decode(mime_data + '=' * (-len(mime_data) % 4))
+            # Invalid UTF-8 still fails the whole body; only a character split by the cut is dropped
+            return codecs.getincrementaldecoder('utf-8')().decode(byte_data, final=not cut)[:max_chars]
         except Exception as e:
-            print(f"Error decoding MIME data: {e}")
+            logger.warning("Error decoding MIME data: %s", e)
             return "Error decoding body."
 
+    @staticmethod
+    def find_body_parts(payload):
+        # One depth-first walk in document order; the first text/plain and text/html parts that are not attachments win
+        found = {}
+        stack = [payload]
+        while stack:
+            part = stack.pop()
+            mime_type = part.get('mimeType', '')
+            if mime_type.startswith('multipart/'):
+                stack.extend(reversed(part.get('parts', [])))
+            elif mime_type in ('text/plain', 'text/html') and mime_type not in found and not part.get('filename'):
+                data = part.get('body', {}).get('data', '')
+                if data:
+                    found[mime_type] = data
+                    if 'text/plain' in found:
+                        break
+        return found
+
     @staticmethod
     def get_email_body(parts, mime_type='text/plain'):
-        if not parts:
-            return ''
-        for part in parts:
-            if part['mimeType'] == mime_type:
-                body_data = part['body'].get('data', '')
-                if body_data:
-                    return EmailManager.decode_mime_data(body_data)
-            elif part['mimeType'] in ['multipart/alternative', 'multipart/related']:
-                return EmailManager.get_email_body(part.get('parts', []), mime_type)
-        return ''
+        found = EmailManager.find_body_parts({'mimeType': 'multipart/mixed', 'parts': parts or []})
+        data = found.get(mime_type)
+        return EmailManager.decode_mime_data(data) if data else ''
 
-    def get_email_details(self, msg_id, max_retries=3):
-        for attempt in range(max_retries):
+    def flush_raw_bodies(self):
+        if self.raw_store and self.raw_bodies:
+            self.raw_store.put_many(self.raw_bodies)
+        self.raw_bodies = []
+
+    @staticmethod
+    def kept_headers(headers):
+        kept = {header['name']: header['value'] for header in headers if header['name'] in FetchConfig.KEPT_HEADERS}
+        return json.dumps(kept) if kept else ''
+
+    def parse_message(self, msg_id, msg):
+        headers = msg['payload']['headers']
+        found = self.find_body_parts(msg['payload'])
+        mime_type = 'text/plain' if 'text/plain' in found else 'text/html'
+        body = ''
+        if mime_type in found:
+            body = self.decode_mime_data(found[mime_type], self.max_body_chars)
+            if self.raw_store:
+                self.raw_bodies.append((str(msg_id), mime_type, self.decode_mime_data(found[mime_type])))
+
+        date = next((header['value'] for header in headers if header['name'] == 'Date'), "No Date")
+        email_data = {
+            "MessageID": str(msg_id),
+            "From": next((header['value'] for header in headers if header['name'] == 'From'), "No Sender"),
+            "To": next((header['value'] for header in headers if header['name'] == 'To'), "No Recipient"),
+            "Subject": next((header['value'] for header in headers if header['name'] == 'Subject'), "No Subject"),
+            "Date": date,
+            # Parsed once here; later stages sort and compare the epoch instead of the header
+            "DateEpoch": date_to_epoch(date),
+            "Body": body,
+            "Headers": self.kept_headers(headers)
+        }
+        return email_data
+
+    def get_email_details(self, msg_id, max_retries=FetchConfig.MAX_RETRIES):
+        return self.get_emails_details([msg_id], max_retries=max_retries)[msg_id]
+
+    def get_emails_details(self, msg_ids, rate_limiter=None, batch_size=FetchConfig.BATCH_SIZE, max_retries=FetchConfig.MAX_RETRIES):
+        # Fetches many messages per round trip using Gmail batch requests.
+        # Returns {msg_id: email_data or None}; quota and server errors are retried with jittered backoff,
+        # permanent ones are recorded in permanent_failures and not retried.
+        results = {}
+        errors = {}
+        pending = list(dict.fromkeys(msg_ids))
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = (classify_error(exception), exception)
+                return
             try:
-                msg = self.service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-                headers = msg['payload']['headers']
-                parts = msg.get('payload', {}).get('parts', [])
-                body = ''
-                if msg['payload']['mimeType'] in ['text/plain', 'text/html']:
-                    body = self.decode_mime_data(msg['payload']['body'].get('data', ''))
-                else:
-                    body = self.get_email_body(parts, 'text/plain')
-                    if not body:
-                        body = self.get_email_body(parts, 'text/html')
-
-                email_data = {
-                    "MessageID": str(msg_id),
-                    "From": next((header['value'] for header in headers if header['name'] == 'From'), "No Sender"),
-                    "To": next((header['value'] for header in headers if header['name'] == 'To'), "No Recipient"),
-                    "Subject": next((header['value'] for header in headers if header['name'] == 'Subject'), "No Subject"),
-                    "Date": next((header['value'] for header in headers if header['name'] == 'Date'), "No Date"),
-                    "Body": body
-                }
-                return email_data
+                results[request_id] = self.parse_message(request_id, response)
             except Exception as e:
-                if attempt < max_retries - 1:
-                    wait_time = (2 ** attempt)
-                    print(f"Retry {attempt + 1}/{max_retries} for email {msg_id} after error: {e}. Waiting {wait_time} seconds...")
-                    time.sleep(wait_time)
-                else:
-                    print(f"Failed to get details for message {msg_id} after {max_retries} attempts: {e}")
-        return None
+                errors[request_id] = ('permanent', e)
+
+        for attempt in range(max_retries):
+            errors.clear()
+            for i in range(0, len(pending), batch_size):
+                chunk = pending[i:i + batch_size]
+                if rate_limiter:
+                    rate_limiter.acquire(len(chunk))
+                batch = self.service.new_batch_http_request(callback=callback)
+                for msg_id in chunk:
+                    batch.add(self.service.users().messages().get(userId='me', id=msg_id, format='full', fields=FetchConfig.MESSAGE_FIELDS),
+                              request_id=msg_id)
+                try:
+                    with metrics.timer('gmail_request_seconds', call='batch_get'):
+                        batch.execute()
+                except Exception as e:
+                    for msg_id in chunk:
+                        if msg_id not in results:
+                            errors[msg_id] = (classify_error(e), e)
+                if rate_limiter:
+                    if any(errors.get(msg_id, ('',))[0] == 'rate_limit' for msg_id in chunk):
+                        rate_limiter.on_rate_limited()
+                    else:
+                        rate_limiter.on_success()
+            for msg_id, (kind, e) in errors.items():
+                metrics.inc('gmail_errors_total', kind=kind)
+                if kind == 'permanent':
+                    self.permanent_failures.add(msg_id)
+                    logger.warning("Giving up on message %s: %s", msg_id, e)
+            pending = [msg_id for msg_id in pending if msg_id in errors and errors[msg_id][0] != 'permanent']
+            if not pending:
+                break
+            if attempt < max_retries - 1:
+                wait_time = backoff_delay(attempt)
+                metrics.inc('gmail_retries_total', len(pending))
+                logger.warning("Retry %d/%d for %d emails after errors such as: %s. Waiting %.1f seconds...",
+                               attempt + 1, max_retries, len(pending), errors[pending[0]][1], wait_time)
+                time.sleep(wait_time)
+            else:
+                for msg_id in pending:
+                    logger.warning("Failed to get details for message %s after %d attempts: %s", msg_id, max_retries, errors[msg_id][1])
+
+        self.flush_raw_bodies()
+        metrics.inc('gmail_messages_fetched_total', len(results))
+        return {msg_id: results.get(msg_id) for msg_id in msg_ids}
+
+    def fetch_new(self, msg_ids, rate_limiter=None):
+        # Returns the fetched emails in msg_ids order and the ids worth retrying on a later run
+        details = self.get_emails_details(msg_ids, rate_limiter)
+        emails = [details[msg_id] for msg_id in msg_ids if details[msg_id]]
+        failed_ids = [msg_id for msg_id in msg_ids if not details[msg_id] and msg_id not in self.permanent_failures]
+        return emails, failed_ids
+
+class SyncState:
+    # Persists the Gmail historyId reached by the last successful sync
+    def __init__(self, state_file='mail/sync_state.json'):
+        self.state_file = state_file
+
+    def load_history_id(self):
+        try:
+            with open(self.state_file, mode='r', encoding='utf-8') as file:
+                return json.load(file).get('historyId')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_history_id(self, history_id):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, mode='w', encoding='utf-8') as file:
+            json.dump({'historyId': str(history_id), 'updated': datetime.now(timezone.utc).isoformat()}, file)
+        os.replace(tmp_file, self.state_file)
 
 class CSVManager:
-    def __init__(self, service):
+    def __init__(self, service, max_messages_per_second=FetchConfig.MAX_MESSAGES_PER_SECOND, sync_state_file='mail/sync_state.json'):
         self.service = service
-        self.email_manager = EmailManager(service)
+        raw_store = RawBodyStore(FetchConfig.RAW_BODY_STORE) if FetchConfig.RAW_BODY_STORE else None
+        self.email_manager = EmailManager(service, FetchConfig.MAX_BODY_CHARS, raw_store)
+        self.rate_limiter = RateLimiter(max_messages_per_second)
+        self.sync_state = SyncState(sync_state_file)
 
     @staticmethod
     def get_latest_email_date(csv_file,flushed_file=''):
-        new_latest_date = None
-        flushed_latest_date = None
-        if os.path.exists(csv_file):
-            with open(csv_file, mode='r', newline='', encoding='utf-8') as file:
-                reader = csv.DictReader(file)
-                dates = [row['Date'] for row in reader if row['Date'] and row['Date'] != "No Date"]
-                if dates:
-                    try:
-                        new_latest_date = max(parsedate_to_datetime(date).replace(tzinfo=timezone.utc) for date in dates)
-                    except ValueError as e:
-                        print(f"Error parsing date: {e}")
-                        
-        if os.path.exists(flushed_file):
-            with open(flushed_file, mode='r', newline='', encoding='utf-8') as file2:
-                reader = csv.DictReader(file2)
-                dates = [row['Date'] for row in reader if row['Date'] and row['Date'] != "No Date"]
-                if dates:
-                    try:
-                        flushed_latest_date = max(parsedate_to_datetime(date).replace(tzinfo=timezone.utc) for date in dates)
-                    except ValueError as e:
-                        print(f"Error parsing date: {e}")
-                        
-        if flushed_latest_date == None and new_latest_date!=None :
-            return new_latest_date
-        elif new_latest_date == None and flushed_latest_date != None :
-            return flushed_latest_date
-        elif flushed_latest_date != None and new_latest_date != None:
-            return max(new_latest_date,flushed_latest_date)
-        else:
-            return None
+        # Read from the files' date summaries instead of parsing every row's Date
+        latest = [DateSummary(path).load().latest for path in (csv_file, flushed_file) if path and os.path.exists(path)]
+        latest = [epoch for epoch in latest if epoch is not None]
+        return datetime.fromtimestamp(max(latest), tz=timezone.utc) if latest else None
 
-    def save_emails_to_csv(self, start_date):
-        csv_file = 'mail/emails.csv'
-        fail_csv_file = 'mail/fail_emails.csv'
-        flushed_file = 'mail/flushed_emails.csv'
-        latest_date = self.get_latest_email_date(csv_file, flushed_file)
+    def iter_query_pages(self, query):
+        with metrics.timer('gmail_request_seconds', call='messages_list'):
+            response = self.service.users().messages().list(userId='me', q=query, maxResults=FetchConfig.LIST_PAGE_SIZE).execute()
+        while 'messages' in response:
+            yield [msg['id'] for msg in response['messages']]
+            if 'nextPageToken' in response:
+                page_token = response['nextPageToken']
+                with metrics.timer('gmail_request_seconds', call='messages_list'):
+                    response = self.service.users().messages().list(userId='me', q=query, pageToken=page_token, maxResults=FetchConfig.LIST_PAGE_SIZE).execute()
+            else:
+                break
+
+    def iter_history_pages(self, start_history_id):
+        # Raises HttpError 404 when start_history_id is too old for Gmail to serve a delta
+        page_token = None
+        while True:
+            with metrics.timer('gmail_request_seconds', call='history_list'):
+                response = self.service.users().history().list(userId='me', startHistoryId=start_history_id, historyTypes='messageAdded',
+                                                               pageToken=page_token, maxResults=FetchConfig.LIST_PAGE_SIZE).execute()
+            msg_ids = []
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    labels = added['message'].get('labelIds', [])
+                    if 'SPAM' not in labels and 'TRASH' not in labels:
+                        msg_ids.append(added['message']['id'])
+            if msg_ids:
+                yield msg_ids
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+    def iter_new_message_pages(self, start_date, get_latest_date):
+        history_id = self.sync_state.load_history_id()
+        if history_id:
+            try:
+                yield from self.iter_history_pages(history_id)
+                return
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                logger.warning("Sync cursor %s expired, falling back to a date based scan.", history_id)
+
+        latest_date = get_latest_date()
         if not latest_date or latest_date <= start_date:
             latest_date = start_date
         else:
             latest_date += timedelta(seconds=1)
-        query = f'after:{int(latest_date.timestamp())}'
+        yield from self.iter_query_pages(f'after:{int(latest_date.timestamp())}')
 
-        with open(csv_file, mode='a', newline='', encoding='utf-8') as file, \
-             open(fail_csv_file, mode='a', newline='', encoding='utf-8') as fail_file:
-            
-            fieldnames = ['MessageID', 'From', 'To', 'Subject', 'Body', 'Date']
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            fail_writer = csv.writer(fail_file)
-            
-            if os.stat(csv_file).st_size == 0:
+    @staticmethod
+    def email_csv_fieldnames(csv_file):
+        fieldnames = ['MessageID', 'From', 'To', 'Subject', 'Body', 'Date', 'DateEpoch', 'Headers']
+        if os.path.isfile(csv_file) and os.stat(csv_file).st_size:
+            # Files started before a column was added keep their own header
+            with open(csv_file, mode='r', newline='', encoding='utf-8') as existing_file:
+                fieldnames = next(csv.reader(existing_file))
+        return fieldnames
+
+    @staticmethod
+    def read_failed_ids(fail_csv_file):
+        if not os.path.isfile(fail_csv_file):
+            return []
+        with open(fail_csv_file, mode='r', newline='', encoding='utf-8') as file:
+            return list(dict.fromkeys(row['MessageID'] for row in csv.DictReader(file) if row.get('MessageID')))
+
+    def redrive_failed_csv(self, csv_file, fail_csv_file, existing_ids, date_summary):
+        # Messages that failed on earlier runs are fetched again; fail_csv_file keeps only those that still fail
+        failed_ids = self.read_failed_ids(fail_csv_file)
+        if not failed_ids:
+            return 0
+        retry_ids = [msg_id for msg_id in failed_ids if msg_id not in existing_ids]
+        emails, still_failed = self.email_manager.fetch_new(retry_ids, self.rate_limiter)
+        fieldnames = self.email_csv_fieldnames(csv_file)
+        with open(csv_file, mode='a', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction='ignore')
+            if file.tell() == 0:
                 writer.writeheader()
-            if os.stat(fail_csv_file).st_size == 0:
-                fail_writer.writerow(['MessageID'])
-            
+            for email_details in emails:
+                writer.writerow(email_details)
+                existing_ids.add(email_details['MessageID'])
+        date_summary.add(email['DateEpoch'] for email in emails).save()
+        tmp_file = fail_csv_file + '.tmp'
+        with open(tmp_file, mode='w', newline='', encoding='utf-8') as file:
+            fail_writer = csv.writer(file)
+            fail_writer.writerow(['MessageID'])
+            fail_writer.writerows([msg_id] for msg_id in still_failed)
+        os.replace(tmp_file, fail_csv_file)
+        print(f"Re-fetched {len(emails)} of {len(retry_ids)} previously failed emails, {len(still_failed)} still failing.")
+        return len(emails)
+
+    def save_emails_to_csv(self, start_date):
+        csv_file = 'mail/emails.csv'
+        fail_csv_file = 'mail/fail_emails.csv'
+        flushed_file = 'mail/flushed_emails.csv'
+        # A compaction of csv_file waits until this fetch has finished appending to it
+        with source_lock(csv_file):
+            # Taken before listing so mail arriving mid-run is picked up again by the next delta
+            current_history_id = self.service.users().getProfile(userId='me').execute()['historyId']
+
             existing_ids = set()
             if os.path.exists(csv_file):
                 with open(csv_file, mode='r', newline='', encoding='utf-8') as existing_file:
                     reader = csv.DictReader(existing_file)
                     existing_ids = {row['MessageID'] for row in reader}
+            date_summary = DateSummary(csv_file).load()
+            added = self.redrive_failed_csv(csv_file, fail_csv_file, existing_ids, date_summary)
 
-            response = self.service.users().messages().list(userId='me', q=query).execute()
-            while 'messages' in response:
-                messages = response['messages']
-                for msg in messages:
-                    if msg['id'] not in existing_ids:
-                        email_details = self.email_manager.get_email_details(msg['id'])
-                        if email_details:
-                            writer.writerow(email_details)
-                            print(f"Added email {msg['id']} to CSV.")
-                            existing_ids.add(msg['id'])
-                        else:
-                            fail_writer.writerow([msg['id']])
-                            print(f"Failed email {msg['id']} recorded in fail_emails.csv.")
-                if 'nextPageToken' in response:
-                    page_token = response['nextPageToken']
-                    response = self.service.users().messages().list(userId='me', q=query, pageToken=page_token).execute()
-                else:
-                    break
+            fieldnames = self.email_csv_fieldnames(csv_file)
+            with open(csv_file, mode='a', newline='', encoding='utf-8') as file, \
+                 open(fail_csv_file, mode='a', newline='', encoding='utf-8') as fail_file:
+            
+                writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction='ignore')
+                fail_writer = csv.writer(fail_file)
             
-            if not messages:
-                print("No new emails to add.")
+                if os.stat(csv_file).st_size == 0:
+                    writer.writeheader()
+                if os.stat(fail_csv_file).st_size == 0:
+                    fail_writer.writerow(['MessageID'])
+
+                for page_ids in self.iter_new_message_pages(start_date, lambda: self.get_latest_email_date(csv_file, flushed_file)):
+                    new_ids = list(dict.fromkeys(msg_id for msg_id in page_ids if msg_id not in existing_ids))
+                    emails, failed_ids = self.email_manager.fetch_new(new_ids, self.rate_limiter)
+                    # Rows are written in listing order regardless of the order batch responses arrive in
+                    for email_details in emails:
+                        writer.writerow(email_details)
+                        logger.debug("Added email %s to CSV.", email_details['MessageID'])
+                        existing_ids.add(email_details['MessageID'])
+                        added += 1
+                    date_summary.add(email['DateEpoch'] for email in emails)
+                    metrics.inc('rows_written_total', len(emails), table='emails.csv')
+                    for msg_id in failed_ids:
+                        fail_writer.writerow([msg_id])
+                        logger.debug("Failed email %s recorded in fail_emails.csv.", msg_id)
+            
+                if not added:
+                    print("No new emails to add.")
+
+            date_summary.save()
+            self.sync_state.save_history_id(current_history_id)
 
     @staticmethod
     def email_exists_in_csv(csv_file, message_id):
@@ -205,12 +494,66 @@ class CSVManager:
                 else:
                     print("No emails in CSV.")
 
+class SQLiteManager(CSVManager):
+    def __init__(self, service, store, max_messages_per_second=FetchConfig.MAX_MESSAGES_PER_SECOND, sync_state_file='mail/sync_state.json'):
+        super().__init__(service, max_messages_per_second, sync_state_file)
+        self.store = store
+
+    def redrive_failed(self):
+        failed_ids = self.store.failed_ids()
+        if not failed_ids:
+            return []
+        emails, still_failed = self.email_manager.fetch_new(failed_ids, self.rate_limiter)
+        self.store.add_fetched(emails)
+        self.store.remove_failed([msg_id for msg_id in failed_ids if msg_id in self.email_manager.permanent_failures])
+        print(f"Re-fetched {len(emails)} of {len(failed_ids)} previously failed emails, {len(still_failed)} still failing.")
+        return emails
+
+    def iter_new_emails(self, start_date):
+        # Yields each page of newly fetched emails once it is stored; the cursor advances after the last page
+        current_history_id = self.service.users().getProfile(userId='me').execute()['historyId']
+        emails = self.redrive_failed()
+        if emails:
+            yield emails
+        for page_ids in self.iter_new_message_pages(start_date, self.store.latest_date):
+            existing_ids = self.store.existing_ids(page_ids)
+            new_ids = list(dict.fromkeys(msg_id for msg_id in page_ids if msg_id not in existing_ids))
+            emails, failed_ids = self.email_manager.fetch_new(new_ids, self.rate_limiter)
+            self.store.add_fetched(emails)
+            self.store.add_failed(failed_ids)
+            logger.info("Added %d emails to %s, %d failed.", len(emails), self.store.db_path, len(failed_ids))
+            if emails:
+                yield emails
+        self.sync_state.save_history_id(current_history_id)
+
+    def save_emails_to_db(self, start_date):
+        added = 0
+        for emails in self.iter_new_emails(start_date):
+            added += len(emails)
+        if not added:
+            print("No new emails to add.")
+
+    def report_emails_info(self):
+        pending = self.store.count('fetched') - self.store.count('refined')
+        latest_date = self.store.latest_date()
+        if latest_date:
+            print(f"Number of new emails in store: {pending}")
+            print(f"Latest date fetched: {latest_date.strftime('%Y-%m-%d %H:%M:%S %z')}")
+        else:
+            print("No emails in store.")
+
 def main():
     gmail_service = GmailService().service
-    csv_manager = CSVManager(gmail_service)
     start_date = datetime(2023, 8, 1, 23, 59, 59, tzinfo=timezone.utc)
-    csv_manager.save_emails_to_csv(start_date)
-    csv_manager.report_emails_info('mail/emails.csv')
+    if StoreConfig.BACKEND == 'sqlite':
+        db_manager = SQLiteManager(gmail_service, EmailStore(StoreConfig.DB_PATH))
+        db_manager.save_emails_to_db(start_date)
+        db_manager.report_emails_info()
+    else:
+        csv_manager = CSVManager(gmail_service)
+        csv_manager.save_emails_to_csv(start_date)
+        csv_manager.report_emails_info('mail/emails.csv')
 
 if __name__ == '__main__':
-    main()
+    with metrics.run('fetchEmails'):
+        main()
@@ -0,0 +1,22 @@
+import os
+from transformers import AutoTokenizer, AutoModelForSequenceClassification, AutoConfig
+from llm_inference import Config
+from onnxBackend import onnx_model_path, export_onnx, quantize_onnx
+
+def main():
+    tokenizer = AutoTokenizer.from_pretrained(Config.MODEL_PATH, model_max_length = Config.MAX_LEN, truncation = True)
+    model = AutoModelForSequenceClassification.from_pretrained(Config.MODEL_PATH)
+    onnx_path = onnx_model_path(Config.EXPORT_DIR)
+    int8_path = onnx_model_path(Config.EXPORT_DIR, quantized=True)
+
+    export_onnx(model, tokenizer, onnx_path)
+    print(f"Exported {onnx_path} ({os.path.getsize(onnx_path) / 2**20:.0f} MB)")
+    quantize_onnx(onnx_path, int8_path)
+    print(f"Quantized {int8_path} ({os.path.getsize(int8_path) / 2**20:.0f} MB)")
+    # The ONNX backends load the tokenizer and label2id from the exported directory and fingerprint it for the prediction
+    # cache, so they do not need the original checkpoint
+    AutoConfig.from_pretrained(Config.MODEL_PATH).save_pretrained(Config.EXPORT_DIR)
+    tokenizer.save_pretrained(Config.EXPORT_DIR)
+
+if __name__ == "__main__":
+    main()
@@ -1,135 +1,263 @@
-import csv
 import re
 import os
-import spacy
+import sys
 import joblib
+import logging
 import pandas as pd
-from llm_inference import Config, Model
 from collections import Counter
 import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from emailStore import EmailStore, StoreConfig
+from trackerStore import TrackerStore, TrackerConfig
+from handoffLog import HandoffLog
+from emailDates import parsed_dates
+import metrics
+from preFilter import PreFilter, PreFilterConfig
+
+logger = logging.getLogger(__name__)
+
+class NERConfig:
+    MODEL = "en_core_web_trf"
+    # Texts per nlp.pipe batch and worker processes for it
+    BATCH_SIZE = 32
+    N_PROCESS = 1
+    # Only ORG entities are used, so every other component is switched off
+    KEEP_PIPES = ["transformer", "tok2vec", "ner"]
+
 class EmailProcessor:
-    def __init__(self, ner_model="en_core_web_trf"):
-        self.model = Model()
-        self.Config = Config()
-        self.ner = spacy.load(ner_model)
-
-    def predict_labels(self, text):
-        prediction = self.model.predict(text)
-        print(prediction)
+    # torch, transformers and spaCy are imported and their weights loaded on first use,
+    # so runs that find no new mail never pay for them
+    def __init__(self, ner_model=NERConfig.MODEL):
+        self.ner_model = ner_model
+        self._model = None
+        self._ner = None
+        self.pre_filter = PreFilter() if PreFilterConfig.ENABLED else None
+
+    @property
+    def model(self):
+        if self._model is None:
+            from llm_inference import Model
+            self._model = Model()
+        return self._model
+
+    @property
+    def ner(self):
+        if self._ner is None:
+            import spacy
+            self._ner = spacy.load(self.ner_model)
+            self._ner.select_pipes(disable=[name for name in self._ner.pipe_names if name not in NERConfig.KEEP_PIPES])
+        return self._ner
+
+    def load(self):
+        return self.model, self.ner
+
+    def predict_labels(self, text, message_ids=None):
+        with metrics.timer('classify_seconds', step='model'):
+            prediction = self.model.predict(text, message_ids=message_ids)
+        logger.debug("Predicted %s", prediction)
         return prediction
 
-    def determine_status(self, text):
-        applied_phrases = [
-            "we received your application", "we have received your application",
-            "we look forward to reviewing your application", "We’ve received your application",
-            "will be reviewed", "Your application has been received",
-            "will review it shortly"
-        ]
-
-        reject_phrases = [
-            "not to move forward", "We regret to inform you", "other candidates", "other applicants",
-            "unable to offer you", "you were not selected", "unable to move forward",
-            "we are pursuing other applicants",
-        ]
-
-        return self.predict_labels(text)
+    def determine_status(self, text, message_ids=None):
+        return self.predict_labels(text, message_ids)
+
+    def classify_emails(self, emails_data):
+        # The pre-filter settles the conclusive emails; only the rest reach the model
+        texts = emails_data['text'].tolist()
+        message_ids = emails_data['MessageID'].tolist()
+        if self.pre_filter is None:
+            return self.determine_status(texts, message_ids)
+        headers = emails_data['Headers'].tolist() if 'Headers' in emails_data else None
+        with metrics.timer('classify_seconds', step='pre_filter'):
+            statuses = self.pre_filter.route(texts, emails_data['From'].tolist(), headers)
+        pending = [index for index, status in enumerate(statuses) if status is None]
+        metrics.inc('classified_emails_total', len(texts) - len(pending), route='pre_filter')
+        metrics.inc('classified_emails_total', len(pending), route='model')
+        if pending:
+            for index, status in zip(pending, self.determine_status([texts[index] for index in pending],
+                                                                    [message_ids[index] for index in pending])):
+                statuses[index] = status
+        return statuses
     
     def extract_company_name(self, text):
-        company_name = "Unknown"
-        nes = self.ner(text)
-        named_entities = [ent.text for ent in nes.ents if ent.label_ == "ORG"]
-        if named_entities:
-            named_entities_dict = {str(item): str(item) for item in named_entities}
-            company_name = self.model.predict([text], named_entities_dict, named_entities)
-        return company_name[0]
+        return self.extract_company_names([text])[0]
+
+    def extract_company_names(self, texts, batch_size=NERConfig.BATCH_SIZE, n_process=NERConfig.N_PROCESS, message_ids=None):
+        company_names = ["Unknown"] * len(texts)
+        if not texts:
+            return company_names
+        candidates = []
+        with metrics.timer('classify_seconds', step='ner'):
+            for index, doc in enumerate(self.ner.pipe(texts, batch_size=batch_size, n_process=n_process)):
+                named_entities = [str(ent.text) for ent in doc.ents if ent.label_ == "ORG"]
+                if named_entities:
+                    candidates.append((index, named_entities))
+        if candidates:
+            # One batched model call scores the ORG candidates of every text
+            with metrics.timer('classify_seconds', step='company_model'):
+                predictions = self.model.predict_candidates([texts[index] for index, _ in candidates],
+                                                            [named_entities for _, named_entities in candidates],
+                                                            [message_ids[index] for index, _ in candidates] if message_ids else None)
+            for (index, _), company_name in zip(candidates, predictions):
+                company_names[index] = company_name
+        return company_names
 
 
 class ApplicationTracker:
-    def __init__(self, tracker_file):
+    def __init__(self, tracker_file, tracker_db=TrackerConfig.DB_PATH):
         self.tracker_file = tracker_file
+        self.store = TrackerStore(tracker_db)
+        # The first run on an existing tracker carries its rows over into the store
+        self.store.import_csv(tracker_file)
 
-    def update_application_tracker(self, emails_data, email_processor):
-        
-        tracker_data = []
-        try:
-            with open(self.tracker_file, mode='r', newline='', encoding='utf-8') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    tracker_data.append(row)
-        except FileNotFoundError:
-            pass
-
-        emails_data['Status'] = email_processor.determine_status(emails_data['text'].tolist())
-        for _,email_data in emails_data.iterrows():
-            if email_data['Status'] == "Irrelevant":
-                continue
-            company_name = email_processor.extract_company_name(email_data['text'])
-            print(company_name)
-            tracker_data.append({
+    @staticmethod
+    def build_updates(emails_data, email_processor):
+        # Sets emails_data['Status'] and returns a tracker update for every relevant email, keyed by its row index
+        emails_data['Status'] = email_processor.classify_emails(emails_data)
+        relevant_emails = emails_data[emails_data['Status'] != "Irrelevant"]
+        company_names = email_processor.extract_company_names(relevant_emails['text'].tolist(),
+                                                              message_ids=relevant_emails['MessageID'].tolist())
+        updates = {}
+        for (index, email_data), company_name in zip(relevant_emails.iterrows(), company_names):
+            logger.debug("Company %s", company_name)
+            updates[index] = {
                 'Company Name' : company_name,
                 'Email': email_data['From'],
                 'Status': email_data['Status'],
-                'Status Updated' : email_data['Date']
-            })
-            
-        tracker_data.sort(key=lambda x: (x['Status'] == "Rejected", x['Company Name']))
-        
-        with open(self.tracker_file, mode='w', newline='', encoding='utf-8') as file:
-            fieldnames = ['Company Name', 'Status', 'Email', 'Status Updated']
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            for entry in tracker_data:
-                writer.writerow(entry)
-        print(f"{self.tracker_file} updated") 
+                'Status Updated' : email_data['Date'],
+                'MessageID': email_data['MessageID']
+            }
+        return updates
+
+    def update_application_tracker(self, emails_data, email_processor):
+        self.record(list(self.build_updates(emails_data, email_processor).values()))
+
+    def record(self, updates):
+        self.store.upsert_many(updates)
+
+    def export(self):
+        self.store.export_csv(self.tracker_file)
+        logger.info("%s updated", self.tracker_file)
 
 
 class EmailDataManager:
     def __init__(self, emails_csv_path, application_tracker_path):
         self.emails_csv_path = emails_csv_path
         self.application_tracker = ApplicationTracker(application_tracker_path)
+        # Flushed rows stay in the CSV until common/compactHandoff.py moves them to the flushed file
+        self.handoff_log = HandoffLog(emails_csv_path)
 
     def read_emails(self):
         try:
             df = pd.read_csv(self.emails_csv_path, encoding='utf-8')
-            df['ParsedDate'] = pd.to_datetime(df['ParsedDate'], errors='coerce')
+            df['ParsedDate'] = parsed_dates(df)
+            df = df[~df['MessageID'].isin(self.handoff_log.read_ids())]
             sorted_df = df.sort_values(by='ParsedDate')
             return sorted_df
         except FileNotFoundError:
             # Return an empty DataFrame if the file does not exist
             return pd.DataFrame()
+
+    def iter_emails(self, chunk_size):
+        if not os.path.isfile(self.emails_csv_path):
+            return
+        consumed_ids = self.handoff_log.read_ids()
+        for df in pd.read_csv(self.emails_csv_path, encoding='utf-8', chunksize=chunk_size):
+            df['ParsedDate'] = parsed_dates(df)
+            df = df[~df['MessageID'].isin(consumed_ids)]
+            if not df.empty:
+                yield df
     
-    def flush_emails(self, emails_data, emails_csv_path, flush_path):
-        emails_data = pd.DataFrame(emails_data)
-        file_exists = os.path.isfile(flush_path) and os.path.getsize(flush_path) > 0
+    def flush_emails(self, emails_data, emails_csv_path=None, flush_path=None):
+        self.handoff_log.append(emails_data['MessageID'])
+        logger.info("Emails Flushed")
+
+
+class ParquetDataManager:
+    # Same interface as EmailDataManager, backed by the processed and flushed ProcessedStore datasets
+    def __init__(self, processed_store, flush_store, application_tracker_path, columns=None):
+        self.processed_store = processed_store
+        self.flush_store = flush_store
+        self.application_tracker = ApplicationTracker(application_tracker_path)
+        # Only the columns classification and tracking use are read; Subject and Body stay on disk
+        self.columns = columns
+
+    def read_emails(self, start=None, end=None):
+        df = self.processed_store.read(self.columns, start, end)
+        return df.sort_values(by='ParsedDate') if not df.empty else pd.DataFrame()
 
-        all_emails = pd.read_csv(emails_csv_path)
-        emails_to_flush = all_emails[all_emails['MessageID'].isin(emails_data['MessageID'])]
-        emails_to_flush.to_csv(flush_path, mode='a', header=not file_exists, index=False)
+    def iter_emails(self, chunk_size):
+        return self.processed_store.iter_batches(chunk_size, self.columns)
+
+    def flush_emails(self, emails_data, emails_csv_path=None, flush_path=None):
+        self.processed_store.move(emails_data['MessageID'].tolist(), self.flush_store)
+        logger.info("Emails Flushed")
+
+
+class StoreDataManager:
+    # Same interface as EmailDataManager, backed by the stage columns of the SQLite email store
+    def __init__(self, store, application_tracker_path):
+        self.store = store
+        self.application_tracker = ApplicationTracker(application_tracker_path)
+
+    def read_emails(self):
+        df = pd.DataFrame(self.store.read_pending_classify())
+        if not df.empty:
+            df['ParsedDate'] = parsed_dates(df)
+        return df
 
-        filtered_all_emails = all_emails[~all_emails['MessageID'].isin(emails_data['MessageID'])]
-        filtered_all_emails.to_csv(emails_csv_path, index=False)
+    def iter_emails(self, chunk_size):
+        for chunk in self.store.iter_pending_classify(chunk_size):
+            df = pd.DataFrame(chunk)
+            df['ParsedDate'] = parsed_dates(df)
+            yield df
 
-        print("Emails Flushed")
+    def flush_emails(self, emails_data, emails_csv_path=None, flush_path=None):
+        self.store.mark_classified(dict(zip(emails_data['MessageID'], emails_data['Status'])))
+        self.store.mark_tracked(emails_data['MessageID'].tolist())
+        logger.info("Emails Flushed")
 
 
 def main():
     emails_csv_path = 'processEmails/processed_emails.csv'
     application_tracker_path = 'applicationTracker.csv'
     flush_path = 'processEmails/flushed_processed_emails.csv'
-    email_processor = EmailProcessor()
-    email_data_manager = EmailDataManager(emails_csv_path, application_tracker_path)
+    if StoreConfig.BACKEND == 'sqlite':
+        email_data_manager = StoreDataManager(EmailStore(StoreConfig.DB_PATH), application_tracker_path)
+    elif StoreConfig.PROCESSED_FORMAT == 'parquet':
+        from processedStore import CLASSIFY_COLUMNS, open_processed_stores
+        email_data_manager = ParquetDataManager(*open_processed_stores(), application_tracker_path, CLASSIFY_COLUMNS)
+    else:
+        email_data_manager = EmailDataManager(emails_csv_path, application_tracker_path)
 
     emails_data = email_data_manager.read_emails()
     #emails_data = emails_data.sample(frac=0.01)
     if emails_data.shape[0] == 0:
         print("No New Emails to Track")
     else :
+        email_processor = EmailProcessor()
         email_data_manager.application_tracker.update_application_tracker(emails_data, email_processor)
         email_data_manager.flush_emails(emails_data,emails_csv_path,flush_path)
+        if TrackerConfig.EXPORT_CSV:
+            email_data_manager.application_tracker.export()
+        if email_processor.pre_filter:
+            print(f"Pre-filter routing: {email_processor.pre_filter.stats()}")
+        # Reading the stats must not load a model the pre-filter made unnecessary
+        model = email_processor._model
+        if model and model.cache:
+            cache_stats = model.cache.stats()
+            metrics.set_gauge('prediction_cache_hit_rate', cache_stats['hit_rate'])
+            print(f"Prediction cache: {cache_stats}")
+        if model and model.engine and model.engine.token_cache:
+            print(f"Token cache: {model.engine.token_cache.stats()}")
+        if model and model.engine:
+            padding_stats = model.engine.padding_stats()
+            metrics.set_gauge('padding_efficiency', padding_stats['padding_efficiency'])
+            print(f"Padding: {padding_stats}")
 
 if __name__ == "__main__":
     time_i = time.time()
-    main()
+    with metrics.run('extract'):
+        main()
     time_j = time.time()
     print(time_j-time_i)
@@ -1,11 +1,37 @@
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+from transformers import AutoTokenizer, AutoModelForSequenceClassification, AutoConfig, pipeline
+import os
+import sys
+import logging
 import torch
+import numpy as np
+from onnxBackend import ONNXSequenceClassifier, onnx_model_path, quantize_torch
+from predictionCache import PredictionCache, model_fingerprint, hypothesis_fingerprint
+from tokenCache import TokenCache, TokenCacheConfig, tokenizer_fingerprint
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+
+logger = logging.getLogger(__name__)
 
 class Config:
     MAX_LEN = 512
     MODEL_PATH = "applicationTracker_DeBERTa_v3_base_finetuned"
     BATCH_SIZE = 128 #8 if 'xsmall' in MODEL_PATH else 4
-    device = 'cuda:5' if torch.cuda.is_available() else torch.device("mps")
+    # NLIEngine groups pairs of similar length and caps each batch at this many padded tokens; None keeps fixed BATCH_SIZE batches
+    MAX_BATCH_TOKENS = 16384
+    device = 'cuda:5' if torch.cuda.is_available() else torch.device("mps") if torch.backends.mps.is_available() else torch.device("cpu")
+
+    # 'pytorch' runs the checkpoint as is, 'int8' quantizes its Linear layers dynamically for CPU,
+    # 'onnx' and 'onnx-int8' run the artifacts written by exportModel.py with ONNX Runtime on CPU
+    BACKEND = "pytorch"
+    EXPORT_DIR = MODEL_PATH + "_export"
+    # CPU threads for one forward pass and for independent operators; None uses every core
+    INTRA_OP_THREADS = None
+    INTER_OP_THREADS = 1
+    # Checkpoints saved as pytorch_model.bin are converted once into this directory as safetensors, which load memory-mapped
+    WEIGHTS_CACHE_DIR = MODEL_PATH + "_safetensors"
+    # Runs one sample prediction while the model loads, so the first real batch does not pay for lazy CUDA/MPS setup
+    WARMUP = False
 
     hypothesis_class_label_dic = {
     "Applied": "The email is related to a job application that the recipient has submitted, for instance, a confirmation email received after applying for a job.",
@@ -17,39 +43,320 @@ class Config:
     hypothesis_company_name_dic = {}
     hypothesis_class_lst = list(hypothesis_class_label_dic.values())
 
+    # 'nli' scores premise/hypothesis pairs directly with NLIEngine, 'pipeline' uses the transformers zero-shot pipeline
+    ENGINE = "nli"
+
+    # Labels already predicted for identical texts are reused from here; None disables the cache
+    PREDICTION_CACHE_PATH = "processEmails/prediction_cache.db"
+    PREDICTION_CACHE_MAX_ENTRIES = 500000
+
+class NLIEngine:
+    # Does what the zero-shot pipeline does with multi_label=False, without re-tokenizing the hypotheses for every text:
+    # each hypothesis is tokenized once per process, each premise once per call, and pairs are assembled from the ids.
+    def __init__(self, model, tokenizer, device, batch_size=Config.BATCH_SIZE, max_len=Config.MAX_LEN, max_batch_tokens=Config.MAX_BATCH_TOKENS):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.batch_size = batch_size
+        self.max_len = max_len
+        self.max_batch_tokens = max_batch_tokens
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.entailment_id = next((ind for label, ind in model.config.label2id.items() if label.lower().startswith("entail")), -1)
+        self.use_token_type_ids = "token_type_ids" in tokenizer.model_input_names
+        self.pad_token_type_id = getattr(tokenizer, "pad_token_type_id", 0)
+        self.read_pair_template()
+        self.hypothesis_ids = {}
+        # Premise ids cached by MessageID across runs; set by Model when TokenCacheConfig.PATH is set
+        self.token_cache = None
+
+    def read_pair_template(self):
+        # The special tokens around a pair, read off the tokenizer's own encoding of a probe pair
+        first = self.tokenizer("a", add_special_tokens=False)['input_ids']
+        second = self.tokenizer("b", add_special_tokens=False)['input_ids']
+        pair = self.tokenizer("a", "b")
+        ids = pair['input_ids']
+        types = pair.get('token_type_ids') or [0] * len(ids)
+        first_start = next(i for i in range(len(ids)) if ids[i:i + len(first)] == first)
+        first_end = first_start + len(first)
+        second_start = next(i for i in range(first_end, len(ids)) if ids[i:i + len(second)] == second)
+        second_end = second_start + len(second)
+        self.prefix, self.middle, self.suffix = ids[:first_start], ids[first_end:second_start], ids[second_end:]
+        self.prefix_types, self.middle_types, self.suffix_types = types[:first_start], types[first_end:second_start], types[second_end:]
+        self.first_type, self.second_type = types[first_start], types[second_start]
+        self.num_special_tokens = len(self.prefix) + len(self.middle) + len(self.suffix)
+
+    def encode_hypotheses(self, hypotheses):
+        new_hypotheses = [hypothesis for hypothesis in dict.fromkeys(hypotheses) if hypothesis not in self.hypothesis_ids]
+        if new_hypotheses:
+            encoded = self.tokenizer(new_hypotheses, add_special_tokens=False)['input_ids']
+            self.hypothesis_ids.update(zip(new_hypotheses, encoded))
+        return [self.hypothesis_ids[hypothesis] for hypothesis in hypotheses]
+
+    def encode_premises(self, texts, message_ids=None):
+        if self.token_cache is None or message_ids is None:
+            return self.tokenizer(list(texts), add_special_tokens=False)['input_ids']
+        premises = self.token_cache.get_many(message_ids, texts)
+        missing = [index for index, premise_ids in enumerate(premises) if premise_ids is None]
+        if missing:
+            encoded = self.tokenizer([texts[index] for index in missing], add_special_tokens=False)['input_ids']
+            self.token_cache.put_many([message_ids[index] for index in missing], [texts[index] for index in missing], encoded)
+            for index, premise_ids in zip(missing, encoded):
+                premises[index] = premise_ids
+        return premises
+
+    def build_pair(self, premise_ids, hypothesis_ids):
+        # Same as truncation="only_first": the premise is cut so the pair fits max_len, unless it is too short to cut
+        room = self.max_len - len(hypothesis_ids) - self.num_special_tokens
+        if 0 < room < len(premise_ids):
+            premise_ids = premise_ids[:room]
+        if isinstance(premise_ids, np.ndarray):
+            # Cached ids are views into the memory-mapped file; only the part that fits is copied out
+            premise_ids = premise_ids.tolist()
+        input_ids = self.prefix + premise_ids + self.middle + hypothesis_ids + self.suffix
+        token_type_ids = None
+        if self.use_token_type_ids:
+            token_type_ids = (self.prefix_types + [self.first_type] * len(premise_ids) + self.middle_types +
+                              [self.second_type] * len(hypothesis_ids) + self.suffix_types)
+        return input_ids, token_type_ids
+
+    def forward(self, pairs):
+        length = max(len(input_ids) for input_ids, _ in pairs)
+        input_ids = torch.full((len(pairs), length), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(pairs), length), dtype=torch.long)
+        token_type_ids = torch.full((len(pairs), length), self.pad_token_type_id, dtype=torch.long)
+        left = self.tokenizer.padding_side == "left"
+        for row, (ids, types) in enumerate(pairs):
+            span = slice(length - len(ids), length) if left else slice(0, len(ids))
+            input_ids[row, span] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, span] = 1
+            if types is not None:
+                token_type_ids[row, span] = torch.tensor(types, dtype=torch.long)
+        inputs = {"input_ids": input_ids.to(self.device), "attention_mask": attention_mask.to(self.device)}
+        if self.use_token_type_ids:
+            inputs["token_type_ids"] = token_type_ids.to(self.device)
+        with torch.inference_mode():
+            logits = self.model(**inputs).logits
+        return logits[:, self.entailment_id].float().cpu()
+
+    def make_batches(self, pairs):
+        # Lists of pair indices; with a token budget the pairs are sorted by length so batches need little padding
+        if not self.max_batch_tokens:
+            return [list(range(i, min(i + self.batch_size, len(pairs)))) for i in range(0, len(pairs), self.batch_size)]
+        batches = []
+        batch = []
+        for index in sorted(range(len(pairs)), key=lambda i: len(pairs[i][0])):
+            length = len(pairs[index][0])
+            if batch and (len(batch) == self.batch_size or length * (len(batch) + 1) > self.max_batch_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def entailment_logits(self, pairs):
+        logits = torch.empty(len(pairs))
+        for batch in self.make_batches(pairs):
+            batch_pairs = [pairs[index] for index in batch]
+            real_tokens = sum(len(input_ids) for input_ids, _ in batch_pairs)
+            padded_tokens = len(batch_pairs) * max(len(input_ids) for input_ids, _ in batch_pairs)
+            self.real_tokens += real_tokens
+            self.padded_tokens += padded_tokens
+            metrics.observe('batch_padding_efficiency', real_tokens / padded_tokens, buckets=metrics.MetricsConfig.RATIO_BUCKETS)
+            metrics.inc('model_pairs_total', len(batch_pairs))
+            # Scattering back by index restores the caller's order
+            with metrics.timer('model_forward_seconds', backend=Config.BACKEND):
+                logits[batch] = self.forward(batch_pairs)
+        return logits
+
+    def padding_stats(self):
+        return {
+            'real_tokens': self.real_tokens,
+            'padded_tokens': self.padded_tokens,
+            'padding_efficiency': self.real_tokens / self.padded_tokens if self.padded_tokens else 1.0,
+        }
+
+    def predict(self, texts, hypotheses, message_ids=None):
+        # Returns the best hypothesis for every text and its softmax probability across the hypotheses
+        if not texts:
+            return [], []
+        with metrics.timer('model_tokenize_seconds'):
+            hypothesis_ids = self.encode_hypotheses(hypotheses)
+            pairs = [self.build_pair(premise_ids, ids) for premise_ids in self.encode_premises(texts, message_ids) for ids in hypothesis_ids]
+        scores = self.entailment_logits(pairs).view(len(texts), len(hypotheses)).softmax(dim=1)
+        probabilities, best = scores.max(dim=1)
+        return [hypotheses[index] for index in best.tolist()], probabilities.tolist()
+
+    def predict_candidates(self, texts, candidate_lists, message_ids=None):
+        # Like predict, but every text brings its own hypotheses; all pairs still go through one batched pass
+        pairs = []
+        spans = []
+        with metrics.timer('model_tokenize_seconds'):
+            for premise_ids, candidates in zip(self.encode_premises(texts, message_ids), candidate_lists):
+                start = len(pairs)
+                pairs.extend(self.build_pair(premise_ids, ids) for ids in self.encode_hypotheses(candidates))
+                spans.append((start, len(pairs)))
+        logits = self.entailment_logits(pairs)
+        best_candidates = []
+        probabilities = []
+        for (start, end), candidates in zip(spans, candidate_lists):
+            probability, best = logits[start:end].softmax(dim=0).max(dim=0)
+            best_candidates.append(candidates[best.item()])
+            probabilities.append(probability.item())
+        return best_candidates, probabilities
+
+
+def has_safetensors(model_dir):
+    return os.path.isdir(model_dir) and any(name.endswith(".safetensors") for name in os.listdir(model_dir))
+
+def latest_mtime(model_dir):
+    return max(os.path.getmtime(os.path.join(model_dir, name)) for name in os.listdir(model_dir))
+
+def load_classifier(model_path, weights_cache_dir=None):
+    if has_safetensors(model_path) or not weights_cache_dir or not os.path.isdir(model_path):
+        return AutoModelForSequenceClassification.from_pretrained(model_path, low_cpu_mem_usage=True)
+    # A checkpoint retrained in place is newer than its cached copy, which is then rebuilt
+    if has_safetensors(weights_cache_dir) and latest_mtime(weights_cache_dir) >= latest_mtime(model_path):
+        return AutoModelForSequenceClassification.from_pretrained(weights_cache_dir, low_cpu_mem_usage=True)
+    model = AutoModelForSequenceClassification.from_pretrained(model_path, low_cpu_mem_usage=True)
+    model.save_pretrained(weights_cache_dir, safe_serialization=True)
+    print(f"Cached {model_path} weights as safetensors in {weights_cache_dir}")
+    return model
+
+
+def set_torch_threads(intra_op_threads, inter_op_threads):
+    torch.set_num_threads(intra_op_threads or os.cpu_count() or 1)
+    if inter_op_threads and torch.get_num_interop_threads() != inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Only allowed once per process, before any inter-op work has started
+            logger.warning("Could not set torch inter-op threads to %d; keeping %d.", inter_op_threads, torch.get_num_interop_threads())
+
 class Model:
     def __init__(self):
         
-        self.tokenizer = AutoTokenizer.from_pretrained(Config.MODEL_PATH, model_max_length = Config.MAX_LEN, truncation = True)
-        self.model = AutoModelForSequenceClassification.from_pretrained(Config.MODEL_PATH)
-        self.pipe_classifier = pipeline(
-                                "zero-shot-classification",
-                                model=self.model,  
-                                tokenizer=self.tokenizer,
-                                framework="pt",
-                                device=Config.device,
-                            )
-        self.predict()
+        # The ONNX backends run from what exportModel.py wrote, without the original checkpoint
+        model_dir = Config.EXPORT_DIR if Config.BACKEND in ("onnx", "onnx-int8") else Config.MODEL_PATH
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, model_max_length = Config.MAX_LEN, truncation = True)
+        self.pipe_classifier = None
+        if Config.BACKEND in ("onnx", "onnx-int8"):
+            # ONNX Runtime sessions only run through NLIEngine
+            self.model = ONNXSequenceClassifier(onnx_model_path(Config.EXPORT_DIR, quantized=Config.BACKEND == "onnx-int8"),
+                                                AutoConfig.from_pretrained(Config.EXPORT_DIR),
+                                                Config.INTRA_OP_THREADS, Config.INTER_OP_THREADS)
+            device = torch.device("cpu")
+        else:
+            self.model = load_classifier(Config.MODEL_PATH, Config.WEIGHTS_CACHE_DIR)
+            device = Config.device
+            if Config.BACKEND == "int8":
+                self.model = quantize_torch(self.model)
+                device = torch.device("cpu")
+            if device == torch.device("cpu") or device == "cpu":
+                set_torch_threads(Config.INTRA_OP_THREADS, Config.INTER_OP_THREADS)
+            self.pipe_classifier = pipeline(
+                                    "zero-shot-classification",
+                                    model=self.model,  
+                                    tokenizer=self.tokenizer,
+                                    framework="pt",
+                                    device=device,
+                                )
+            device = self.pipe_classifier.device
+        self.engine = None
+        if Config.ENGINE == "nli" or self.pipe_classifier is None:
+            self.engine = NLIEngine(self.model, self.tokenizer, device)
+            if TokenCacheConfig.PATH:
+                self.engine.token_cache = TokenCache(TokenCacheConfig.PATH, tokenizer_fingerprint(self.tokenizer, self.engine.max_len),
+                                                     self.engine.max_len)
+        self.cache = None
+        if Config.PREDICTION_CACHE_PATH:
+            self.cache = PredictionCache(Config.PREDICTION_CACHE_PATH,
+                                         model_fingerprint(model_dir, Config.MAX_LEN, Config.BACKEND),
+                                         hypothesis_fingerprint(Config.hypothesis_class_label_dic, Config.hypothesis_class_lst),
+                                         Config.PREDICTION_CACHE_MAX_ENTRIES)
+        if Config.WARMUP:
+            self.classify()
+
+    def predict(self, text, hypothesis_class_label_dic=Config.hypothesis_class_label_dic, hypothesis_class_lst=Config.hypothesis_class_lst, message_ids=None):
+        # message_ids, one per text, let the engine reuse the texts' cached token ids
+        if self.cache is None:
+            return self.classify(text, hypothesis_class_label_dic, hypothesis_class_lst, message_ids)
+
+        hypotheses = hypothesis_fingerprint(hypothesis_class_label_dic, hypothesis_class_lst)
+        keys = [self.cache.key(t, hypotheses) for t in text]
+        cached = self.cache.get_many(keys)
+        # Only texts the cache has not seen go to the model, each distinct one once
+        missing = list(dict.fromkeys(key for key in keys if key not in cached))
+        if missing:
+            missing_text = {key: t for key, t in zip(keys, text) if key not in cached}
+            missing_ids = None
+            if message_ids is not None:
+                missing_message_ids = {key: message_id for key, message_id in zip(keys, message_ids) if key not in cached}
+                missing_ids = [missing_message_ids[key] for key in missing]
+            labels = self.classify([missing_text[key] for key in missing], hypothesis_class_label_dic, hypothesis_class_lst, missing_ids)
+            new_labels = dict(zip(missing, labels))
+            self.cache.put_many(new_labels)
+            cached.update(new_labels)
+        return [cached[key] for key in keys]
     
-    def predict(self, text =["The Subject : ""Ext Confirmation On The Position Of Software Developer Internship At Interactive Brokers LLC."" - End of the Subject The email: ""Dear Shoaib Mohammed We are pleased to extend the following offer of employment to you on behalf of Interactive Brokers LLC You have been selected a the best candidate for the Software Developer Internship position Congratulations We believe that your knowledge skill and experience would be an ideal fit for our IT department team We hope you will enjoy your role and make significant contribution to the overall success of Interactive Brokers LLC Please take the time to review our offer It includes important detail about your compensation benefit and the term and condition of your anticipated employment with Interactive Brokers LLC We will need all form signed and returned a soon a possible We are very excited to start this journey together and can wait to have you join the team You are expected to contact Cindy Via Trillian IM platform a regard further briefing on the position and Training Best Regard Recruiting Team"" -end of the email. "], hypothesis_class_label_dic=Config.hypothesis_class_label_dic, hypothesis_class_lst=Config.hypothesis_class_lst):
-
-        pipe_output = self.pipe_classifier(
-                        text,
-                        candidate_labels=hypothesis_class_lst,
-                        hypothesis_template="{}",
-                        multi_label=False,
-                        batch_size=Config.BATCH_SIZE
-                    )
-        hypothesis_pred_true_probability = []
-        hypothesis_pred_true = []
-        for dic in pipe_output:
-            hypothesis_pred_true_probability.append(dic["scores"][0])
-            hypothesis_pred_true.append(dic["labels"][0])
+    def predict_candidates(self, texts, candidate_lists, message_ids=None):
+        # Picks one of each text's own candidates (e.g. the ORG entities found in it) for a batch of texts
+        if not texts:
+            return []
+        candidate_lists = [list(dict.fromkeys(candidates)) for candidates in candidate_lists]
+        keys = None
+        cached = {}
+        if self.cache is not None:
+            keys = [self.cache.key(text, hypothesis_fingerprint({c: c for c in candidates}, candidates))
+                    for text, candidates in zip(texts, candidate_lists)]
+            cached = self.cache.get_many(keys)
+        missing = [i for i in range(len(texts)) if keys is None or keys[i] not in cached]
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            missing_candidates = [candidate_lists[i] for i in missing]
+            if self.engine:
+                labels, _ = self.engine.predict_candidates(missing_texts, missing_candidates,
+                                                           [message_ids[i] for i in missing] if message_ids is not None else None)
+            else:
+                labels = [self.classify([text], {c: c for c in candidates}, candidates)[0]
+                          for text, candidates in zip(missing_texts, missing_candidates)]
+            if self.cache is not None:
+                new_labels = {keys[i]: label for i, label in zip(missing, labels)}
+                self.cache.put_many(new_labels)
+                cached.update(new_labels)
+            else:
+                return labels
+        return [cached[key] for key in keys]
+
+    def classify(self, text =["The Subject : ""Ext Confirmation On The Position Of Software Developer Internship At Interactive Brokers LLC."" - End of the Subject The email: ""Dear Shoaib Mohammed We are pleased to extend the following offer of employment to you on behalf of Interactive Brokers LLC You have been selected a the best candidate for the Software Developer Internship position Congratulations We believe that your knowledge skill and experience would be an ideal fit for our IT department team We hope you will enjoy your role and make significant contribution to the overall success of Interactive Brokers LLC Please take the time to review our offer It includes important detail about your compensation benefit and the term and condition of your anticipated employment with Interactive Brokers LLC We will need all form signed and returned a soon a possible We are very excited to start this journey together and can wait to have you join the team You are expected to contact Cindy Via Trillian IM platform a regard further briefing on the position and Training Best Regard Recruiting Team"" -end of the email. "], hypothesis_class_label_dic=Config.hypothesis_class_label_dic, hypothesis_class_lst=Config.hypothesis_class_lst, message_ids=None):
+
+        if self.engine:
+            hypothesis_pred_true, hypothesis_pred_true_probability = self.engine.predict(text, hypothesis_class_lst, message_ids)
+        else:
+            hypothesis_pred_true, hypothesis_pred_true_probability = self.pipeline_predict(text, hypothesis_class_lst)
 
         # map the long hypotheses to their corresponding short label names
         hypothesis_label_dic_inference_inverted = {value: key for key, value in hypothesis_class_label_dic.items()}
         label_pred = [hypothesis_label_dic_inference_inverted[hypo] for hypo in hypothesis_pred_true]
-        print(label_pred)
+        logger.debug("Labels %s", label_pred)
         return label_pred
+
+    def pipeline_predict(self, text, hypothesis_class_lst=Config.hypothesis_class_lst):
+        # The pipeline tokenizes inside the same call, so its timing covers both
+        with metrics.timer('model_forward_seconds', backend='pipeline'):
+            pipe_output = self.pipe_classifier(
+                            text,
+                            candidate_labels=hypothesis_class_lst,
+                            hypothesis_template="{}",
+                            multi_label=False,
+                            batch_size=Config.BATCH_SIZE
+                        )
+        hypothesis_pred_true_probability = []
+        hypothesis_pred_true = []
+        for dic in pipe_output:
+            hypothesis_pred_true_probability.append(dic["scores"][0])
+            hypothesis_pred_true.append(dic["labels"][0])
+        return hypothesis_pred_true, hypothesis_pred_true_probability
     
 #Model()
\ No newline at end of file
@@ -0,0 +1,45 @@
+import os
+import torch
+from types import SimpleNamespace
+
+def onnx_model_path(export_dir, quantized=False):
+    return os.path.join(export_dir, "model.int8.onnx" if quantized else "model.onnx")
+
+def export_onnx(model, tokenizer, output_path, opset=17):
+    # Batch and sequence length stay dynamic so one export serves every batch shape NLIEngine builds
+    model.eval()
+    sample = tokenizer(["An example premise."], ["An example hypothesis."], return_tensors="pt")
+    input_names = [name for name in ["input_ids", "attention_mask", "token_type_ids"] if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in input_names), output_path,
+                          input_names=input_names, output_names=["logits"], dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False)
+
+def quantize_onnx(input_path, output_path):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(input_path, output_path, weight_type=QuantType.QInt8)
+
+def quantize_torch(model):
+    # Dynamic int8 quantization of the Linear layers, which hold almost all of DeBERTa's weights and FLOPs
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class ONNXSequenceClassifier:
+    # Stands in for the PyTorch model inside NLIEngine: same keyword inputs, an object with .logits back
+    def __init__(self, onnx_path, config, intra_op_threads=None, inter_op_threads=1):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads or os.cpu_count() or 1
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.config = config
+
+    def __call__(self, **inputs):
+        feed = {name: tensor.cpu().numpy() for name, tensor in inputs.items() if name in self.input_names}
+        logits = self.session.run(["logits"], feed)[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
@@ -0,0 +1,161 @@
+import os
+import sys
+import queue
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+import pandas as pd
+import processEmails as refine_stage
+import extract as classify_stage
+from emailStore import EmailStore, StoreConfig
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class PipelineConfig:
+    # Emails handed between stages at a time
+    CHUNK_SIZE = 256
+    # Chunks buffered between two stages before the upstream stage blocks
+    QUEUE_DEPTH = 2
+    # Also stream new mail straight from Gmail once the stored backlog is drained (SQLite backend only)
+    FETCH = False
+    START_DATE = datetime(2023, 8, 1, 23, 59, 59, tzinfo=timezone.utc)
+
+    EMAILS_PATH = 'mail/emails.csv'
+    MAIL_FLUSH_PATH = 'mail/flushed_emails.csv'
+    PROCESSED_PATH = 'processEmails/processed_emails.csv'
+    PROCESSED_FLUSH_PATH = 'processEmails/flushed_processed_emails.csv'
+    APPLICATION_TRACKER_PATH = 'applicationTracker.csv'
+    # Write the tracker CSV once the run is over; python common/trackerStore.py writes it on demand
+    EXPORT_CSV = False
+
+_DONE = object()
+
+class StageThread(threading.Thread):
+    # Runs one stage and always signals the downstream queue, keeping the error for the consumer to re-raise
+    def __init__(self, target, out_queue):
+        super().__init__(daemon=True)
+        self.target = target
+        self.out_queue = out_queue
+        self.error = None
+
+    def run(self):
+        try:
+            self.target()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.out_queue.put(_DONE)
+
+def open_refine_manager():
+    if StoreConfig.BACKEND == 'sqlite':
+        return refine_stage.StoreFileManager(EmailStore(StoreConfig.DB_PATH))
+    if StoreConfig.PROCESSED_FORMAT == 'parquet':
+        from processedStore import open_processed_stores
+        return refine_stage.ParquetFileManager(PipelineConfig.EMAILS_PATH, open_processed_stores()[0], PipelineConfig.MAIL_FLUSH_PATH)
+    return refine_stage.CSVFileManager(PipelineConfig.EMAILS_PATH, PipelineConfig.PROCESSED_PATH, PipelineConfig.MAIL_FLUSH_PATH)
+
+def open_classify_manager():
+    if StoreConfig.BACKEND == 'sqlite':
+        return classify_stage.StoreDataManager(EmailStore(StoreConfig.DB_PATH), PipelineConfig.APPLICATION_TRACKER_PATH)
+    if StoreConfig.PROCESSED_FORMAT == 'parquet':
+        from processedStore import CLASSIFY_COLUMNS, open_processed_stores
+        return classify_stage.ParquetDataManager(*open_processed_stores(), PipelineConfig.APPLICATION_TRACKER_PATH, CLASSIFY_COLUMNS)
+    return classify_stage.EmailDataManager(PipelineConfig.PROCESSED_PATH, PipelineConfig.APPLICATION_TRACKER_PATH)
+
+class StreamingPipeline:
+    def __init__(self, chunk_size=PipelineConfig.CHUNK_SIZE, queue_depth=PipelineConfig.QUEUE_DEPTH, fetch=PipelineConfig.FETCH):
+        self.chunk_size = chunk_size
+        self.fetch = fetch and StoreConfig.BACKEND == 'sqlite'
+        self.source_queue = queue.Queue(maxsize=queue_depth)
+        self.refined_queue = queue.Queue(maxsize=queue_depth)
+        # Flushing the Parquet processed store rewrites files the classify stage may be streaming from,
+        # so those flushes wait for the end of the run; the other backends only record progress
+        self.defer_tracked_flush = StoreConfig.BACKEND == 'csv' and StoreConfig.PROCESSED_FORMAT == 'parquet'
+        self.tracked_ids = []
+
+    def read_source(self):
+        # Refined rows left over from an earlier run go straight to classification
+        for df in open_classify_manager().iter_emails(self.chunk_size):
+            self.source_queue.put(('refined', df))
+
+        refine_manager = open_refine_manager()
+        skip_ids = refine_manager.read_processed_ids()
+        for chunk in refine_manager.iter_emails(self.chunk_size, skip_ids):
+            self.source_queue.put(('raw', chunk))
+
+        if self.fetch:
+            sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mail'))
+            from fetchEmails import GmailService, SQLiteManager
+            db_manager = SQLiteManager(GmailService().service, EmailStore(StoreConfig.DB_PATH))
+            for emails in db_manager.iter_new_emails(PipelineConfig.START_DATE):
+                for i in range(0, len(emails), self.chunk_size):
+                    self.source_queue.put(('raw', emails[i:i + self.chunk_size]))
+
+    def refine(self):
+        refine_manager = open_refine_manager()
+        email_processor = refine_stage.EmailProcessor(refine_stage.RefineConfig.WORKERS)
+        try:
+            while True:
+                item = self.source_queue.get()
+                if item is _DONE:
+                    if self.reader.error:
+                        raise self.reader.error
+                    break
+                kind, chunk = item
+                if kind == 'raw':
+                    refined = email_processor.process_emails(chunk, [])
+                    refine_manager.append_emails(refined)
+                    refine_manager.flush_emails(refined)
+                    chunk = pd.DataFrame(refined)
+                self.refined_queue.put(chunk)
+        finally:
+            email_processor.close()
+
+    def run(self):
+        self.reader = StageThread(self.read_source, self.source_queue)
+        self.refiner = StageThread(self.refine, self.refined_queue)
+        self.reader.start()
+        self.refiner.start()
+
+        # Model loading overlaps with reading and refining the first chunks
+        email_processor = classify_stage.EmailProcessor()
+        email_processor.load()
+        classify_manager = open_classify_manager()
+        tracked = 0
+        while True:
+            emails_data = self.refined_queue.get()
+            if emails_data is _DONE:
+                if self.refiner.error:
+                    raise self.refiner.error
+                break
+            if emails_data.empty:
+                continue
+            classify_manager.application_tracker.update_application_tracker(emails_data, email_processor)
+            if self.defer_tracked_flush:
+                self.tracked_ids.extend(emails_data['MessageID'])
+            else:
+                classify_manager.flush_emails(emails_data)
+            tracked += emails_data.shape[0]
+            metrics.inc('tracked_emails_total', emails_data.shape[0])
+            logger.info("Tracked %d emails so far.", tracked)
+
+        if self.tracked_ids:
+            classify_manager.flush_emails(pd.DataFrame({'MessageID': self.tracked_ids}), PipelineConfig.PROCESSED_PATH, PipelineConfig.PROCESSED_FLUSH_PATH)
+        if PipelineConfig.EXPORT_CSV and tracked:
+            classify_manager.application_tracker.export()
+        if not tracked:
+            print("No New Emails to Track")
+        return tracked
+
+def main():
+    refine_stage.set_max_csv_field_size()
+    StreamingPipeline().run()
+
+if __name__ == "__main__":
+    time_i = time.time()
+    with metrics.run('pipeline'):
+        main()
+    time_j = time.time()
+    print(time_j-time_i)
@@ -0,0 +1,133 @@
+import re
+import json
+from collections import Counter
+
+class PreFilterConfig:
+    ENABLED = True
+    # Evidence an email needs before its label is taken without running the model; lower routes more mail past it
+    MIN_CONFIDENCE = 1.0
+    # The model truncates to Config.MAX_LEN tokens, so text past this many characters cannot change its answer either
+    MAX_CHARS = 4000
+    # Evidence each matched phrase, bulk header and bulk sender adds
+    PHRASE_WEIGHT = 0.5
+    BULK_HEADER_WEIGHT = 0.6
+    BULK_SENDER_WEIGHT = 0.3
+    NO_JOB_KEYWORD_WEIGHT = 0.4
+
+    APPLIED_PHRASES = [
+        "we received your application", "we have received your application",
+        "we look forward to reviewing your application", "We’ve received your application",
+        "will be reviewed", "Your application has been received",
+        "will review it shortly", "thank you for applying", "thank you for your application",
+    ]
+    REJECTED_PHRASES = [
+        "not to move forward", "We regret to inform you", "other candidates", "other applicants",
+        "unable to offer you", "you were not selected", "unable to move forward",
+        "we are pursuing other applicants", "decided to pursue other candidates", "will not be moving forward",
+    ]
+    # Offers are rare and costly to get wrong, so they only ever veto a shortcut
+    ACCEPTED_PHRASES = [
+        "pleased to offer you", "offer of employment", "pleased to extend", "offer letter",
+    ]
+    # Any of these makes an email job related, which rules out the Irrelevant shortcut.
+    # "offer" is left out because promotions use it constantly; real offers are caught by ACCEPTED_PHRASES
+    JOB_KEYWORDS = [
+        "application", "applying", "applied", "candidate", "candidacy", "position", "role", "interview",
+        "recruiter", "recruiting", "recruitment", "hiring", "resume", "job", "career", "talent",
+    ]
+    BULK_SENDER_WORDS = ["newsletter", "news", "digest", "marketing", "promo", "promotions", "deals", "offers", "updates"]
+    BULK_PRECEDENCE = {"bulk", "list", "junk"}
+
+WORD_PATTERN = re.compile(r'[a-z]{2,}')
+SENDER_PATTERN = re.compile(r'([^<\s@]+)@')
+
+def canonical_text(text, max_chars=None):
+    # Refined text is lemmatized and stripped of punctuation and single letters, so phrases and text are both
+    # reduced to lowercase words without a trailing 's' and compared in that form
+    text = str(text)[:max_chars].lower().replace("'", "").replace("’", "")
+    words = (word[:-1] if word[-1] == 's' else word for word in WORD_PATTERN.findall(text))
+    return ' '.join(word for word in words if len(word) > 1)
+
+def compile_phrases(phrases):
+    # One alternation over every phrase scans the text once whatever the number of phrases
+    canonical = sorted({canonical_text(phrase) for phrase in phrases}, key=len, reverse=True)
+    return re.compile(r'\b(?:' + '|'.join(re.escape(phrase) for phrase in canonical) + r')\b')
+
+
+class PreFilter:
+    # Labels the emails whose phrases or headers are conclusive and leaves the rest to the model (None)
+    def __init__(self, min_confidence=PreFilterConfig.MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+        self.applied_pattern = compile_phrases(PreFilterConfig.APPLIED_PHRASES)
+        self.rejected_pattern = compile_phrases(PreFilterConfig.REJECTED_PHRASES)
+        self.accepted_pattern = compile_phrases(PreFilterConfig.ACCEPTED_PHRASES)
+        self.job_keywords = {canonical_text(keyword) for keyword in PreFilterConfig.JOB_KEYWORDS}
+        self.bulk_sender_words = set(PreFilterConfig.BULK_SENDER_WORDS)
+        self.routed = Counter()
+
+    @staticmethod
+    def parse_headers(headers):
+        if not isinstance(headers, str) or not headers:
+            return {}
+        try:
+            return json.loads(headers)
+        except ValueError:
+            return {}
+
+    def bulk_header(self, headers):
+        headers = self.parse_headers(headers)
+        if 'List-Unsubscribe' in headers or 'List-Id' in headers:
+            return True
+        if headers.get('Precedence', '').strip().lower() in PreFilterConfig.BULK_PRECEDENCE:
+            return True
+        return headers.get('Auto-Submitted', 'no').strip().lower() not in ('', 'no')
+
+    def bulk_sender(self, sender):
+        match = SENDER_PATTERN.search(str(sender).lower())
+        if not match:
+            return False
+        return any(word in self.bulk_sender_words for word in re.split(r'[^a-z]+', match.group(1)))
+
+    def scores(self, text, sender='', headers=''):
+        canonical = canonical_text(text, PreFilterConfig.MAX_CHARS)
+        applied = len(set(self.applied_pattern.findall(canonical)))
+        rejected = len(set(self.rejected_pattern.findall(canonical)))
+        accepted = self.accepted_pattern.search(canonical) is not None
+        scores = {'Applied': 0.0, 'Rejected': 0.0, 'Irrelevant': 0.0}
+        if accepted:
+            return scores
+        # Rejections usually thank the candidate for applying too, so applied phrases only count on their own
+        if rejected:
+            scores['Rejected'] = rejected * PreFilterConfig.PHRASE_WEIGHT
+        elif applied:
+            scores['Applied'] = applied * PreFilterConfig.PHRASE_WEIGHT
+        elif not self.job_keywords.intersection(canonical.split()):
+            scores['Irrelevant'] = PreFilterConfig.NO_JOB_KEYWORD_WEIGHT
+            if self.bulk_header(headers):
+                scores['Irrelevant'] += PreFilterConfig.BULK_HEADER_WEIGHT
+            if self.bulk_sender(sender):
+                scores['Irrelevant'] += PreFilterConfig.BULK_SENDER_WEIGHT
+        return scores
+
+    def route_one(self, text, sender='', headers=''):
+        scores = self.scores(text, sender, headers)
+        label = max(scores, key=scores.get)
+        if scores[label] >= self.min_confidence:
+            self.routed['prefilter', label] += 1
+            return label
+        self.routed['model'] += 1
+        return None
+
+    def route(self, texts, senders=None, headers=None):
+        senders = senders if senders is not None else [''] * len(texts)
+        headers = headers if headers is not None else [''] * len(texts)
+        return [self.route_one(text, sender, header) for text, sender, header in zip(texts, senders, headers)]
+
+    def stats(self):
+        total = sum(self.routed.values())
+        stats = {'model': self.routed['model']}
+        for key, count in self.routed.items():
+            if key != 'model':
+                stats[f"prefilter_{key[1]}"] = count
+        stats['short_circuit_rate'] = (total - self.routed['model']) / total if total else 0.0
+        return stats
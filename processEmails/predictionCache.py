@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    "key" TEXT PRIMARY KEY,
+    "label" TEXT,
+    "last_used" INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_predictions_last_used ON predictions("last_used");
+CREATE TABLE IF NOT EXISTS meta (
+    "name" TEXT PRIMARY KEY,
+    "value" TEXT
+);
+"""
+
+def newest_mtime(model_path):
+    # Overwriting the files of a checkpoint directory leaves the directory's own mtime unchanged
+    if os.path.isdir(model_path):
+        return max((os.path.getmtime(os.path.join(root, name)) for root, _, names in os.walk(model_path) for name in names), default=None)
+    return os.path.getmtime(model_path) if os.path.exists(model_path) else None
+
+def model_fingerprint(model_path, max_len, backend="pytorch"):
+    # A model retrained in place keeps its path, so the weights' modification time is part of the fingerprint
+    mtime = newest_mtime(model_path)
+    return hashlib.sha256(json.dumps([model_path, max_len, backend, mtime]).encode('utf-8')).hexdigest()
+
+def hypothesis_fingerprint(hypothesis_class_label_dic, hypothesis_class_lst):
+    return hashlib.sha256(json.dumps([hypothesis_class_label_dic, hypothesis_class_lst], sort_keys=True).encode('utf-8')).hexdigest()
+
+def normalize_text(text):
+    return ' '.join(text.split())
+
+
+class PredictionCache:
+    # Persistent label cache for Model.predict keyed on the model, the hypotheses and the normalized text
+    def __init__(self, db_path, model_fingerprint, class_hypothesis_fingerprint, max_entries=500000):
+        self.db_path = db_path
+        self.model_fingerprint = model_fingerprint
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.invalidate_if_changed(model_fingerprint + class_hypothesis_fingerprint)
+        # An upper bound on the number of rows; only counted again once it passes max_entries
+        self.entries = self.count()
+
+    def invalidate_if_changed(self, fingerprint):
+        row = self.conn.execute('SELECT "value" FROM meta WHERE "name" = \'fingerprint\'').fetchone()
+        if row is None or row[0] != fingerprint:
+            with self.conn:
+                self.conn.execute('DELETE FROM predictions')
+                self.conn.execute('INSERT OR REPLACE INTO meta ("name", "value") VALUES (\'fingerprint\', ?)', (fingerprint,))
+            if row is not None:
+                metrics.inc('prediction_cache_invalidations_total')
+                print("Model or hypotheses changed, prediction cache cleared")
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM predictions')
+        self.entries = 0
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    def key(self, text, hypotheses_fingerprint):
+        data = self.model_fingerprint + hypotheses_fingerprint + normalize_text(text)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(f'SELECT "key", "label" FROM predictions WHERE "key" IN ({placeholders})', chunk)
+            found.update(rows)
+        if found:
+            now = int(time.time())
+            with self.conn:
+                self.conn.executemany('UPDATE predictions SET "last_used" = ? WHERE "key" = ?', [(now, key) for key in found])
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        metrics.inc('prediction_cache_lookups_total', hits, result='hit')
+        metrics.inc('prediction_cache_lookups_total', len(keys) - hits, result='miss')
+        return found
+
+    def put_many(self, labels):
+        now = int(time.time())
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO predictions ("key", "label", "last_used") VALUES (?, ?, ?)',
+                                  [(key, label, now) for key, label in labels.items()])
+        # A replaced key is counted too, so the bound can only overshoot
+        self.entries += len(labels)
+        if self.entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        count = self.count()
+        if count > self.max_entries:
+            # Drop the least recently used tenth so eviction does not run on every insert
+            excess = count - int(self.max_entries * 0.9)
+            with self.conn:
+                self.conn.execute('DELETE FROM predictions WHERE "key" IN '
+                                  '(SELECT "key" FROM predictions ORDER BY "last_used" LIMIT ?)', (excess,))
+            count -= excess
+        self.entries = count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
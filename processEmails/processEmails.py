@@ -1,29 +1,59 @@
 import csv
 import sys
-import re
 import os
-import pandas as pd
-from bs4 import BeautifulSoup
+import json
+import time
+import logging
+import nltk
+from collections import OrderedDict
 from datetime import datetime, timezone
-from email.utils import parsedate_to_datetime
-from nltk.tokenize import word_tokenize
 from nltk.stem import WordNetLemmatizer
-import string
+from multiprocessing import Pool
+from textNormalizer import TextNormalizer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from emailStore import EmailStore, StoreConfig
+from handoffLog import HandoffLog, source_lock
+from emailDates import date_to_epoch, email_epochs, to_epoch
+import metrics
+
+logger = logging.getLogger(__name__)
 
 class CSVFileManager:
     def __init__(self, input_file_path, output_file_path, flush_path):
         self.input_file_path = input_file_path
         self.output_file_path = output_file_path
         self.flush_path = flush_path
+        # Flushed rows stay in the input file until common/compactHandoff.py moves them to flush_path
+        self.handoff_log = HandoffLog(input_file_path)
 
     def read_emails(self):
         emails = []
+        consumed_ids = self.handoff_log.read_ids()
         with open(self.input_file_path, mode='r', encoding='utf-8') as file:
             reader = csv.DictReader(file)
             for row in reader:
-                emails.append(row)
+                if row['MessageID'] not in consumed_ids:
+                    emails.append(row)
         return emails
 
+    def iter_emails(self, chunk_size, skip_ids=()):
+        if not os.path.isfile(self.input_file_path):
+            return
+        chunk = []
+        consumed_ids = self.handoff_log.read_ids()
+        with open(self.input_file_path, mode='r', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                if row['MessageID'] in skip_ids or row['MessageID'] in consumed_ids:
+                    continue
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
     def read_processed_emails(self):
         try:
             with open(self.output_file_path, mode='r', encoding='utf-8') as file:
@@ -32,76 +62,254 @@ class CSVFileManager:
         except FileNotFoundError:
             return []
 
+    def read_processed_ids(self):
+        try:
+            with open(self.output_file_path, mode='r', encoding='utf-8') as file:
+                reader = csv.DictReader(file)
+                return {row['MessageID'] for row in reader}
+        except FileNotFoundError:
+            return set()
+
     def append_emails(self, emails):
-        with open(self.output_file_path, mode='a', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=emails[0].keys())
-            if file.tell() == 0:  # Check if file is empty to write header
-                writer.writeheader()
-            for email in emails:
-                writer.writerow(email)
+        fieldnames = list(emails[0].keys())
+        with source_lock(self.output_file_path):
+            if os.path.isfile(self.output_file_path) and os.path.getsize(self.output_file_path):
+                # Rows appended to an existing file follow its header, even if the input has gained a column since
+                with open(self.output_file_path, mode='r', newline='', encoding='utf-8') as file:
+                    fieldnames = next(csv.reader(file))
+            with open(self.output_file_path, mode='a', newline='', encoding='utf-8') as file:
+                writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction='ignore', restval='')
+                if file.tell() == 0:  # Check if file is empty to write header
+                    writer.writeheader()
+                for email in emails:
+                    writer.writerow(email)
+        metrics.inc('rows_written_total', len(emails), table=os.path.basename(self.output_file_path))
     
     def flush_emails(self, new_emails):
-        new_emails = pd.DataFrame(new_emails)
-        file_exists = os.path.isfile(self.flush_path) and os.path.getsize(self.flush_path) > 0
+        self.handoff_log.append(email['MessageID'] for email in new_emails)
+        logger.info("Emails Flushed")
 
-        all_emails = pd.read_csv(self.input_file_path)
-        emails_to_flush = all_emails[all_emails['MessageID'].isin(new_emails['MessageID'])]
-        emails_to_flush.to_csv(self.flush_path, mode='a', header=not file_exists, index=False)
+class ParquetFileManager(CSVFileManager):
+    # Reads raw mail from the CSVs like CSVFileManager but writes refined emails to a ProcessedStore
+    def __init__(self, input_file_path, processed_store, flush_path):
+        super().__init__(input_file_path, None, flush_path)
+        self.processed_store = processed_store
 
-        filtered_all_emails = all_emails[~all_emails['MessageID'].isin(new_emails['MessageID'])]
-        filtered_all_emails.to_csv(self.input_file_path, index=False)
+    def read_processed_emails(self):
+        return [{'MessageID': msg_id} for msg_id in self.processed_store.ids()]
+
+    def read_processed_ids(self):
+        return self.processed_store.ids()
+
+    def append_emails(self, emails):
+        self.processed_store.append(emails)
+
+class StoreFileManager:
+    # Same interface as CSVFileManager, backed by the stage columns of the SQLite email store
+    def __init__(self, store):
+        self.store = store
 
-        print("Emails Flushed")
+    def read_emails(self):
+        return self.store.read_pending_refine()
+
+    def iter_emails(self, chunk_size, skip_ids=()):
+        return self.store.iter_pending_refine(chunk_size)
+
+    def read_processed_emails(self):
+        # read_emails only returns unrefined rows, so there is nothing to exclude
+        return []
+
+    def read_processed_ids(self):
+        return set()
+
+    def append_emails(self, emails):
+        self.store.mark_refined(emails)
+
+    def flush_emails(self, new_emails):
+        # refined_at already hands the rows to the next stage
+        pass
+
+class RefineConfig:
+    # Worker processes used by process_emails; 1 refines in the calling process
+    WORKERS = 1
+    # Emails handed to a worker per task
+    CHUNK_SIZE = 64
+    # Distinct words kept in the lemma cache
+    LEMMA_CACHE_SIZE = 200000
+    # Set to a path such as 'processEmails/lemma_cache.json' to keep the lemma cache between runs
+    LEMMA_CACHE_PATH = None
+    # Set to the classifier's MODEL_PATH (with its MAX_LEN) to write each refined email's token ids to the token cache,
+    # so classification and later reclassification skip tokenizing them
+    PRETOKENIZE_MODEL_PATH = None
+    PRETOKENIZE_MAX_LEN = 512
+
+class LemmaCache:
+    # Bounded LRU cache in front of WordNetLemmatizer.lemmatize; email token frequencies are heavily skewed
+    def __init__(self, lemmatizer, max_size=RefineConfig.LEMMA_CACHE_SIZE):
+        self.lemmatizer = lemmatizer
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Lemmas computed since the last drain, kept only in pool workers
+        self.learned = None
+
+    def lemmatize(self, word):
+        lemma = self.cache.get(word)
+        if lemma is not None:
+            self.hits += 1
+            self.cache.move_to_end(word)
+            return lemma
+        self.misses += 1
+        lemma = self.lemmatizer.lemmatize(word)
+        self.cache[word] = lemma
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        if self.learned is not None:
+            self.learned.append((word, lemma))
+        return lemma
+
+    def drain(self):
+        # What a pool worker hands back to the parent with each chunk: its new lemmas and its lookups since the last drain
+        report = (self.learned, self.hits, self.misses)
+        self.learned, self.hits, self.misses = [], 0, 0
+        return report
+
+    def merge(self, learned, hits, misses):
+        self.hits += hits
+        self.misses += misses
+        for word, lemma in learned:
+            self.cache[word] = lemma
+            self.cache.move_to_end(word)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.cache),
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def load(self, path):
+        try:
+            with open(path, mode='r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return
+        # Lemmas from another NLTK release may differ, so its cache is not reused
+        if data.get('nltk_version') != nltk.__version__:
+            return
+        for word, lemma in data['lemmas'][-self.max_size:]:
+            self.cache[word] = lemma
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as file:
+            json.dump({'nltk_version': nltk.__version__, 'lemmas': list(self.cache.items())}, file)
+        os.replace(tmp_path, path)
+
+_worker_processor = None
+
+def _init_refine_worker(lemma_cache_path):
+    # The lemmatizer and the rest of the refinement state are built once per worker. Workers never save the lemma
+    # cache; the parent merges what they learn and saves it once
+    global _worker_processor
+    _worker_processor = EmailProcessor(lemma_cache_path=lemma_cache_path)
+    _worker_processor.lemma_cache.learned = []
+
+def _refine_chunk(emails):
+    return [_worker_processor.refine_email(email) for email in emails], _worker_processor.lemma_cache.drain()
 
 class EmailProcessor:
-    def __init__(self):
+    def __init__(self, workers=1, chunk_size=RefineConfig.CHUNK_SIZE, lemma_cache_path=RefineConfig.LEMMA_CACHE_PATH):
         self.lemmatizer = WordNetLemmatizer()
+        self.lemma_cache = LemmaCache(self.lemmatizer)
+        self.lemma_cache_path = lemma_cache_path
+        if lemma_cache_path:
+            self.lemma_cache.load(lemma_cache_path)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.pool = None
+        self.tokenizer = None
+        self.token_cache = None
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.lemma_cache_path:
+            self.lemma_cache.save(self.lemma_cache_path)
+        if self.token_cache:
+            self.token_cache.close()
+            self.token_cache = None
 
     def refine_text(self, body):
-        if bool(BeautifulSoup(body, "html.parser").find()):
-            soup = BeautifulSoup(body, "html.parser")
-            text = soup.get_text(separator="\n")
-        else:
-            text = body.strip()
-        url_pattern = r'https?://\S+|www\.\S+'
-        text = re.sub(url_pattern, '', text)
-        text = re.sub(r'https?://\S+|www\.\S+', '', text)
-        text = re.sub(r'<.*?>', '', text)
-        text = re.sub(r'\S+@\S+', '', text)
-        text = re.sub(r'\b\w\b', '', text)
-        text = re.sub(r'\d+', '', text)
-        text = re.sub(r'[^a-zA-Z\s]', '', text)
-        text = re.sub(r'\S*@\S*\s?', '', text)
-        text = re.sub(f"[{string.punctuation}]", "", text)
-        text = re.sub(r'\s+', ' ', text).strip()
-        tokens = word_tokenize(text)
-        tokens = [self.lemmatizer.lemmatize(word) for word in tokens]
+        tokens = TextNormalizer.tokenize(body)
+        tokens = [self.lemma_cache.lemmatize(word) for word in tokens]
         return ' '.join(tokens)
     
-    def convert_to_utc(self, dt):
-        if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
-            return dt.replace(tzinfo=timezone.utc)
-        else:
-            return dt.astimezone(timezone.utc)
-    
     def fit_hypothesis(self, email):
         return 'The email is from: "'+ email['From']+ '". The email subject: "' + email['Subject'] + '". -end of the email subject. The email body: "' + email['Body']+ '" -end of the email body. '
 
+    def refine_email(self, email):
+        email['Body'] = self.refine_text(email['Body'])
+        email['Subject'] = self.refine_text(email['Subject'])
+        email['text'] = self.fit_hypothesis(email)
+        epoch = to_epoch(email.get('DateEpoch'))
+        if epoch is None:
+            epoch = date_to_epoch(email.get('Date'))
+        # Emails without a usable date sort first, at 1970-01-01
+        email['DateEpoch'] = epoch
+        email['ParsedDate'] = datetime.fromtimestamp(epoch or 0, tz=timezone.utc)
+        return email
+
+    def refine_emails(self, emails):
+        if self.workers <= 1 or len(emails) <= self.chunk_size:
+            return [self.refine_email(email) for email in emails]
+        if self.pool is None:
+            self.pool = Pool(self.workers, initializer=_init_refine_worker, initargs=(self.lemma_cache_path,))
+        chunks = [emails[i:i + self.chunk_size] for i in range(0, len(emails), self.chunk_size)]
+        refined = []
+        # imap keeps the input order whatever order the workers finish in
+        for chunk, lemma_report in self.pool.imap(_refine_chunk, chunks):
+            refined.extend(chunk)
+            self.lemma_cache.merge(*lemma_report)
+        return refined
+
     def process_emails(self, emails, processed_emails):
         processed_emails_ids = {email['MessageID'] for email in processed_emails}
         new_emails = [email for email in emails if email['MessageID'] not in processed_emails_ids]
-        for email in new_emails:
-            email['Body'] = self.refine_text(email['Body'])
-            email['Subject'] = self.refine_text(email['Subject'])
-            email['text'] = self.fit_hypothesis(email)
-            try:
-                parsed_date = parsedate_to_datetime(email['Date'])
-                email['ParsedDate'] = self.convert_to_utc(parsed_date)
-            except (ValueError, KeyError):
-                email['ParsedDate'] = self.convert_to_utc(datetime(1970, 1, 1))
-        new_emails.sort(key=lambda x: x['ParsedDate'])
+        chars = sum(len(email['Body']) + len(email['Subject']) for email in new_emails)
+        start = time.perf_counter()
+        # Rows fetched before DateEpoch existed get theirs from one bulk parse rather than one parse per email
+        for email, epoch in zip(new_emails, email_epochs(new_emails)):
+            email['DateEpoch'] = epoch
+        new_emails = self.refine_emails(new_emails)
+        seconds = time.perf_counter() - start
+        if new_emails:
+            # Per KB (1024 characters) of raw subject and body, so chunks of long HTML mail and short notes compare
+            metrics.observe('refine_seconds', seconds)
+            metrics.observe('refine_seconds_per_kb', seconds / max(chars / 1024, 1e-3))
+            metrics.inc('refine_input_chars_total', chars)
+            metrics.inc('refined_emails_total', len(new_emails))
+        new_emails.sort(key=lambda x: x['DateEpoch'] or 0)
+        if RefineConfig.PRETOKENIZE_MODEL_PATH and new_emails:
+            self.pretokenize(new_emails)
         return new_emails
 
+    def pretokenize(self, emails):
+        if self.token_cache is None:
+            from tokenCache import open_token_cache
+            self.tokenizer, self.token_cache = open_token_cache(RefineConfig.PRETOKENIZE_MODEL_PATH, RefineConfig.PRETOKENIZE_MAX_LEN)
+        texts = [email['text'] for email in emails]
+        with metrics.timer('pretokenize_seconds'):
+            token_ids = self.tokenizer(texts, add_special_tokens=False)['input_ids']
+            self.token_cache.put_many([email['MessageID'] for email in emails], texts, token_ids)
+
 def set_max_csv_field_size():
     max_int = sys.maxsize
     while True:
@@ -117,12 +325,23 @@ def main():
     output_path = 'processEmails/processed_emails.csv'
     flush_path = 'mail/flushed_emails.csv'
 
-    file_manager = CSVFileManager(emails_path, output_path, flush_path)
+    if StoreConfig.BACKEND == 'sqlite':
+        file_manager = StoreFileManager(EmailStore(StoreConfig.DB_PATH))
+    elif StoreConfig.PROCESSED_FORMAT == 'parquet':
+        from processedStore import open_processed_stores
+        file_manager = ParquetFileManager(emails_path, open_processed_stores()[0], flush_path)
+    else:
+        file_manager = CSVFileManager(emails_path, output_path, flush_path)
     all_emails = file_manager.read_emails()
     processed_emails = file_manager.read_processed_emails()
 
-    email_processor = EmailProcessor()
+    email_processor = EmailProcessor(RefineConfig.WORKERS)
     new_emails = email_processor.process_emails(all_emails, processed_emails)
+    email_processor.close()
+    # With a pool, the workers' lookups have been merged into the parent's cache
+    lemma_stats = email_processor.lemma_cache.stats()
+    metrics.set_gauge('lemma_cache_hit_rate', lemma_stats['hit_rate'])
+    print(f"Lemma cache: {lemma_stats}")
 
     if new_emails:
         file_manager.append_emails(new_emails)
@@ -132,4 +351,5 @@ def main():
         print("No new emails to process.")
 
 if __name__ == "__main__":
-    main()
+    with metrics.run('processEmails'):
+        main()
@@ -0,0 +1,172 @@
+import os
+import sys
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import processEmails as refine_stage
+import extract as classify_stage
+from emailStore import EmailStore
+from emailDates import parsed_dates
+from trackerStore import TrackerStore, TrackerConfig, export_merged_csv
+from pipeline import PipelineConfig
+import metrics
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mail'))
+from fetchEmails import GmailService, SQLiteManager
+
+logger = logging.getLogger(__name__)
+
+class ShardConfig:
+    # One directory per mailbox holding its token.pickle, emails.db, sync_state.json and tracker files
+    ACCOUNTS_DIR = 'accounts'
+    # OAuth client shared by every account unless its directory has its own cred.json
+    CRED_PATH = 'mail/cred.json'
+    # Accounts fetched and refined at the same time, each in its own process
+    PROCESSES = min(4, os.cpu_count() or 1)
+    # Every account's applications in one report, with an Account column
+    MERGED_TRACKER_PATH = 'applicationTracker_all.csv'
+
+
+class Account:
+    def __init__(self, name, accounts_dir=ShardConfig.ACCOUNTS_DIR):
+        self.name = name
+        self.root = os.path.join(accounts_dir, name)
+        self.token_path = os.path.join(self.root, 'token.pickle')
+        own_cred_path = os.path.join(self.root, 'cred.json')
+        self.cred_path = own_cred_path if os.path.isfile(own_cred_path) else ShardConfig.CRED_PATH
+        self.db_path = os.path.join(self.root, 'emails.db')
+        self.sync_state_path = os.path.join(self.root, 'sync_state.json')
+        self.tracker_path = os.path.join(self.root, 'applicationTracker.csv')
+        self.tracker_db_path = os.path.join(self.root, 'applicationTracker.db')
+
+def list_accounts(accounts_dir=ShardConfig.ACCOUNTS_DIR, names=None):
+    if not os.path.isdir(accounts_dir):
+        return []
+    names = names or sorted(name for name in os.listdir(accounts_dir) if os.path.isdir(os.path.join(accounts_dir, name)))
+    return [Account(name, accounts_dir) for name in names]
+
+def fetch_and_refine(account, fetch=True):
+    # Runs in a worker process and leaves the account's mail refined in its store for the classifier
+    metrics.setup_logging()
+    refine_stage.set_max_csv_field_size()
+    store = EmailStore(account.db_path)
+    fetched = 0
+    if fetch:
+        service = GmailService(account.token_path, account.cred_path, interactive=False).service
+        fetch_manager = SQLiteManager(service, store, sync_state_file=account.sync_state_path)
+        for emails in fetch_manager.iter_new_emails(PipelineConfig.START_DATE):
+            fetched += len(emails)
+    refine_manager = refine_stage.StoreFileManager(store)
+    email_processor = refine_stage.EmailProcessor()
+    refined = 0
+    try:
+        for chunk in refine_manager.iter_emails(PipelineConfig.CHUNK_SIZE):
+            refined_emails = email_processor.process_emails(chunk, [])
+            refine_manager.append_emails(refined_emails)
+            refined += len(refined_emails)
+    finally:
+        email_processor.close()
+        store.close()
+    return fetched, refined
+
+
+class ShardedTracker:
+    # Fetch and refine run per account in worker processes. The classifier and NER models are loaded once, here,
+    # and every batch they see can mix the refined mail of several accounts
+    def __init__(self, accounts, processes=ShardConfig.PROCESSES, chunk_size=PipelineConfig.CHUNK_SIZE, fetch=True):
+        self.accounts = {account.name: account for account in accounts}
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.fetch = fetch
+        self.stores = {}
+        self.trackers = {}
+        self.email_processor = classify_stage.EmailProcessor()
+        self.pending = None
+        self.tracked = 0
+
+    def open(self, name):
+        account = self.accounts[name]
+        self.stores[name] = EmailStore(account.db_path)
+        self.trackers[name] = classify_stage.ApplicationTracker(account.tracker_path, account.tracker_db_path)
+
+    def collect(self, name):
+        for chunk in self.stores[name].iter_pending_classify(self.chunk_size):
+            df = pd.DataFrame(chunk)
+            df['ParsedDate'] = parsed_dates(df)
+            df['Account'] = name
+            self.pending = df if self.pending is None else pd.concat([self.pending, df], ignore_index=True)
+            while self.pending.shape[0] >= self.chunk_size:
+                self.classify(self.pending.iloc[:self.chunk_size].reset_index(drop=True))
+                self.pending = self.pending.iloc[self.chunk_size:].reset_index(drop=True)
+
+    def classify(self, emails_data):
+        updates = classify_stage.ApplicationTracker.build_updates(emails_data, self.email_processor)
+        for name, rows in emails_data.groupby('Account'):
+            self.trackers[name].record([updates[index] for index in rows.index if index in updates])
+            self.stores[name].mark_classified(dict(zip(rows['MessageID'], rows['Status'])))
+            self.stores[name].mark_tracked(rows['MessageID'].tolist())
+            metrics.inc('tracked_emails_total', rows.shape[0], account=name)
+        self.tracked += emails_data.shape[0]
+        logger.info("Tracked %d emails so far.", self.tracked)
+
+    def run(self):
+        failed = []
+        # Workers are spawned rather than forked so they do not inherit the classifier's threads
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=context) as pool:
+            futures = {pool.submit(fetch_and_refine, account, self.fetch): name for name, account in self.accounts.items()}
+            # The models load while the first accounts are being fetched
+            self.email_processor.load()
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    fetched, refined = future.result()
+                    logger.info("%s: fetched %d, refined %d", name, fetched, refined)
+                except Exception as e:
+                    # Mail the account refined before failing is still tracked
+                    failed.append(name)
+                    logger.error("%s: fetch or refine failed: %s", name, e)
+                self.open(name)
+                self.collect(name)
+        if self.pending is not None and not self.pending.empty:
+            self.classify(self.pending)
+            self.pending = None
+        if TrackerConfig.EXPORT_CSV:
+            for tracker in self.trackers.values():
+                tracker.export()
+        self.export_merged()
+        for store in self.stores.values():
+            store.close()
+        return self.tracked, failed
+
+    def export_merged(self, accounts_dir=ShardConfig.ACCOUNTS_DIR, csv_path=ShardConfig.MERGED_TRACKER_PATH):
+        # The merged report also covers accounts left out of this run
+        stores = {name: tracker.store for name, tracker in self.trackers.items()}
+        others = {account.name: TrackerStore(account.tracker_db_path) for account in list_accounts(accounts_dir)
+                  if account.name not in stores and os.path.isfile(account.tracker_db_path)}
+        export_merged_csv({**others, **stores}, csv_path)
+        for store in others.values():
+            store.close()
+
+def main():
+    # shardedTracker.py [account ...] processes the named accounts, or every directory in ShardConfig.ACCOUNTS_DIR;
+    # shardedTracker.py authorize <account> runs the OAuth flow once to create the account's token
+    if len(sys.argv) > 2 and sys.argv[1] == 'authorize':
+        account = Account(sys.argv[2])
+        os.makedirs(account.root, exist_ok=True)
+        GmailService(account.token_path, account.cred_path)
+        print(f"Authorized {account.name}, token saved to {account.token_path}")
+        return
+    accounts = list_accounts(names=sys.argv[1:])
+    if not accounts:
+        print(f"No accounts in {ShardConfig.ACCOUNTS_DIR}; add one with: python processEmails/shardedTracker.py authorize <name>")
+        return
+    tracked, failed = ShardedTracker(accounts).run()
+    print(f"Tracked {tracked} emails across {len(accounts)} accounts, merged into {ShardConfig.MERGED_TRACKER_PATH}")
+    if failed:
+        print(f"Accounts that failed to fetch or refine: {', '.join(failed)}")
+
+if __name__ == "__main__":
+    with metrics.run('shardedTracker'):
+        main()
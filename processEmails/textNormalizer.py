@@ -0,0 +1,46 @@
+import re
+from bs4 import BeautifulSoup
+
+URL_PATTERN = re.compile(r'https?://\S+|www\.\S+')
+TAG_PATTERN = re.compile(r'<.*?>')
+# A whitespace separated run with an '@' that is neither its first nor its last character
+EMAIL_PATTERN = re.compile(r'\S+@\S+')
+# Single character words and everything that is not an ASCII letter or whitespace, matched against the same string
+# so the word boundaries are the ones the single character pass would have seen
+FILTER_PATTERN = re.compile(r'\b\w\b|[^a-zA-Z\s]')
+
+# word_tokenize splits these tokens in two; on text made only of ASCII letters and spaces nothing else changes
+SPLIT_CONTRACTIONS = {'cannot': 3, 'gimme': 3, 'gonna': 3, 'gotta': 3, 'lemme': 3, 'wanna': 3}
+
+
+class TextNormalizer:
+    # Produces the same tokens as the original refine_text chain before lemmatization:
+    # HTML is parsed at most once, patterns are precompiled and skipped when their marker characters are absent,
+    # and the character filters run as one substitution followed by a single split.
+
+    @staticmethod
+    def html_to_text(body):
+        if '<' in body:
+            soup = BeautifulSoup(body, "html.parser")
+            if soup.find():
+                return soup.get_text(separator="\n")
+        return body.strip()
+
+    @staticmethod
+    def tokenize(body):
+        text = TextNormalizer.html_to_text(body)
+        if '://' in text or 'www.' in text:
+            text = URL_PATTERN.sub('', text)
+        if '<' in text:
+            text = TAG_PATTERN.sub('', text)
+        if '@' in text:
+            text = EMAIL_PATTERN.sub('', text)
+        tokens = []
+        for token in FILTER_PATTERN.sub('', text).split():
+            split_at = SPLIT_CONTRACTIONS.get(token.lower())
+            if split_at:
+                tokens.append(token[:split_at])
+                tokens.append(token[split_at:])
+            else:
+                tokens.append(token)
+        return tokens
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import fcntl
+import sqlite3
+import hashlib
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+
+class TokenCacheConfig:
+    # Premise token ids of every classified email, under one subdirectory per tokenizer fingerprint; None disables the cache.
+    # Subdirectories of tokenizers no longer in use can be deleted
+    PATH = "processEmails/token_cache"
+    # Ids of replaced entries stay in the ids file until they make up this share of it; the live ids are then rewritten
+    COMPACT_DEAD_SHARE = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    "message_id" TEXT PRIMARY KEY,
+    "digest" TEXT,
+    "offset" INTEGER,
+    "length" INTEGER
+);
+CREATE TABLE IF NOT EXISTS meta (
+    "name" TEXT PRIMARY KEY,
+    "value"
+);
+"""
+PROBE = "Tokenizer probe: Ünïcödé text, NUMBERS 12345 and e-mail@example.com"
+# Files a tokenizer is loaded from; the model's weights do not change its ids
+TOKENIZER_FILES = {'tokenizer.json', 'tokenizer_config.json', 'special_tokens_map.json', 'added_tokens.json', 'vocab.txt',
+                   'vocab.json', 'merges.txt', 'spiece.model', 'spm.model', 'sentencepiece.bpe.model'}
+
+def tokenizer_fingerprint(tokenizer, max_len):
+    # The tokenizer's files and the ids of a probe text; a tokenizer loaded by hub name is known by that name
+    digest = hashlib.sha256()
+    source = tokenizer.name_or_path
+    if os.path.isdir(source):
+        for name in sorted(set(os.listdir(source)) & TOKENIZER_FILES):
+            digest.update(name.encode('utf-8'))
+            with open(os.path.join(source, name), 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+    else:
+        digest.update(source.encode('utf-8'))
+    probe = tokenizer(PROBE, add_special_tokens=False)['input_ids']
+    digest.update(json.dumps([type(tokenizer).__name__, max_len, probe]).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def text_digest(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class TokenCache:
+    # Token ids of each email's text, cut to max_len, keyed by MessageID. The ids of every email are appended to one
+    # int32 file that is read back through a memory map, so a hit costs an index lookup and a slice. An entry is
+    # only used while the email's text hashes the same
+    def __init__(self, root, fingerprint, max_len, compact_dead_share=TokenCacheConfig.COMPACT_DEAD_SHARE):
+        self.root = os.path.join(root, fingerprint)
+        os.makedirs(self.root, exist_ok=True)
+        self.max_len = max_len
+        self.compact_dead_share = compact_dead_share
+        self.lock_path = os.path.join(self.root, 'ids.lock')
+        self.conn = sqlite3.connect(os.path.join(self.root, 'index.db'))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.ids = np.empty(0, dtype=np.int32)
+        self.mapped = None
+        self.hits = 0
+        self.misses = 0
+        with self.locked(fcntl.LOCK_EX):
+            if self.meta('dead') is None:
+                # A cache written before the count was kept
+                live = self.conn.execute('SELECT COALESCE(SUM("length"), 0) FROM tokens').fetchone()[0]
+                with self.conn:
+                    self.set_meta('dead', max(self.size(self.ids_file()) - live, 0))
+
+    def locked(self, operation):
+        # Writers take the lock exclusively and readers shared, so the index and the ids file are always read as a pair
+        lock = open(self.lock_path, 'a')
+        fcntl.flock(lock, operation)
+        return lock
+
+    def meta(self, name, default=None):
+        row = self.conn.execute('SELECT "value" FROM meta WHERE "name" = ?', (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, name, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta ("name", "value") VALUES (?, ?)', (name, value))
+
+    def ids_file(self):
+        # Compaction writes a new file and switches the index over in one transaction
+        return self.meta('ids_file', 'ids.bin')
+
+    def size(self, ids_file):
+        path = os.path.join(self.root, ids_file)
+        return os.path.getsize(path) // 4 if os.path.exists(path) else 0
+
+    def view(self, ids_file):
+        # Other processes append too, so the map is reopened whenever the file has grown or been replaced
+        size = self.size(ids_file)
+        if (ids_file, size) != self.mapped:
+            path = os.path.join(self.root, ids_file)
+            self.ids = np.memmap(path, dtype=np.int32, mode='r', shape=(size,)) if size else np.empty(0, dtype=np.int32)
+            self.mapped = (ids_file, size)
+        return self.ids
+
+    def lookup(self, message_ids):
+        rows = {}
+        for i in range(0, len(message_ids), 500):
+            chunk = message_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows.update((row[0], row[1:]) for row in self.conn.execute(
+                f'SELECT "message_id", "digest", "offset", "length" FROM tokens WHERE "message_id" IN ({placeholders})', chunk))
+        return rows
+
+    def get_many(self, message_ids, texts):
+        # Read-only views into the mapped file, or None for an email that is not cached
+        with self.locked(fcntl.LOCK_SH):
+            rows = self.lookup(list(dict.fromkeys(message_ids)))
+            # A file compacted away later stays readable through the map taken here
+            ids = self.view(self.ids_file())
+        found = []
+        for message_id, text in zip(message_ids, texts):
+            row = rows.get(message_id)
+            if row and row[0] == text_digest(text) and row[1] + row[2] <= len(ids):
+                found.append(ids[row[1]:row[1] + row[2]])
+            else:
+                found.append(None)
+        hits = sum(1 for token_ids in found if token_ids is not None)
+        self.hits += hits
+        self.misses += len(found) - hits
+        metrics.inc('token_cache_lookups_total', hits, result='hit')
+        metrics.inc('token_cache_lookups_total', len(found) - hits, result='miss')
+        return found
+
+    def put_many(self, message_ids, texts, token_ids):
+        arrays = [np.asarray(ids[:self.max_len], dtype=np.int32) for ids in token_ids]
+        if not arrays:
+            return
+        with self.locked(fcntl.LOCK_EX):
+            ids_file = self.ids_file()
+            with open(os.path.join(self.root, ids_file), 'ab') as file:
+                offset = file.seek(0, os.SEEK_END) // 4
+                file.write(np.concatenate(arrays).tobytes())
+            rows = {}
+            for message_id, text, array in zip(message_ids, texts, arrays):
+                rows[message_id] = (message_id, text_digest(text), offset, len(array))
+                offset += len(array)
+            # Ids of replaced entries, and of repeats within this call, are no longer referenced
+            dead = sum(row[2] for row in self.lookup(list(rows)).values()) + sum(map(len, arrays)) - sum(row[3] for row in rows.values())
+            # The ids are on disk before the index points at them; a crash in between only leaves unreferenced bytes
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO tokens ("message_id", "digest", "offset", "length") VALUES (?, ?, ?, ?)', rows.values())
+                self.set_meta('dead', self.meta('dead', 0) + dead)
+            if self.meta('dead') > self.compact_dead_share * offset:
+                self.compact(ids_file)
+        metrics.inc('token_cache_writes_total', len(rows))
+
+    def compact(self, ids_file):
+        # Called with the lock held. The live spans are copied in offset order to a file of the next generation
+        generation = int(self.meta('generation', 0)) + 1
+        new_file = f'ids-{generation}.bin'
+        ids = np.memmap(os.path.join(self.root, ids_file), dtype=np.int32, mode='r', shape=(self.size(ids_file),))
+        rows = []
+        offset = 0
+        with open(os.path.join(self.root, new_file), 'wb') as file:
+            for message_id, old_offset, length in self.conn.execute('SELECT "message_id", "offset", "length" FROM tokens ORDER BY "offset"'):
+                file.write(ids[old_offset:old_offset + length].tobytes())
+                rows.append((offset, message_id))
+                offset += length
+        with self.conn:
+            self.conn.executemany('UPDATE tokens SET "offset" = ? WHERE "message_id" = ?', rows)
+            self.set_meta('ids_file', new_file)
+            self.set_meta('generation', generation)
+            self.set_meta('dead', 0)
+        del ids
+        # Files of earlier generations, including one a crash left behind, are no longer referenced
+        for name in os.listdir(self.root):
+            if name.startswith('ids') and name.endswith('.bin') and name != new_file:
+                os.remove(os.path.join(self.root, name))
+        metrics.inc('token_cache_compactions_total')
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM tokens').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+def open_token_cache(model_path, max_len, root=TokenCacheConfig.PATH):
+    # The classifier's tokenizer without torch or the model, for processes that only write the cache
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_path, model_max_length=max_len, truncation=True)
+    return tokenizer, TokenCache(root, tokenizer_fingerprint(tokenizer, max_len), max_len)
@@ -0,0 +1,194 @@
+import os
+import sys
+import time
+import signal
+import processEmails as refine_stage
+import extract as classify_stage
+from emailStore import EmailStore, StoreConfig
+from pipeline import PipelineConfig
+import metrics
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mail'))
+from fetchEmails import GmailService, SQLiteManager
+
+class DaemonConfig:
+    # Producers drop files of message IDs, one per line, into SPOOL_DIR/incoming
+    SPOOL_DIR = 'mail/spool'
+    # A batch is processed once it holds MAX_BATCH IDs or its oldest ID has waited MAX_LATENCY seconds
+    MAX_BATCH = 64
+    MAX_LATENCY = 5.0
+    # Seconds between spool scans while idle
+    POLL_INTERVAL = 0.5
+    # Seconds between Gmail history checks for mail nobody submitted; None only serves the spool
+    GMAIL_POLL_INTERVAL = 60
+    # Rewrite the tracker CSV after every batch; python common/trackerStore.py writes it on demand
+    EXPORT_CSV = False
+
+
+class Spool:
+    # Files move incoming -> processing when claimed and are deleted once their batch is tracked,
+    # so IDs claimed by a daemon that died are picked up again on the next start
+    def __init__(self, spool_dir=DaemonConfig.SPOOL_DIR):
+        self.incoming_dir = os.path.join(spool_dir, 'incoming')
+        self.processing_dir = os.path.join(spool_dir, 'processing')
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        os.makedirs(self.processing_dir, exist_ok=True)
+
+    def submit(self, msg_ids):
+        name = f"{time.time_ns()}-{os.getpid()}.ids"
+        tmp_path = os.path.join(os.path.dirname(self.incoming_dir), name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(msg_ids) + '\n')
+        # The rename is atomic, so the daemon never reads a half written file
+        os.replace(tmp_path, os.path.join(self.incoming_dir, name))
+        return name
+
+    def recover(self):
+        for name in os.listdir(self.processing_dir):
+            os.replace(os.path.join(self.processing_dir, name), os.path.join(self.incoming_dir, name))
+
+    def claim(self, max_ids):
+        claimed = []
+        count = 0
+        for name in sorted(os.listdir(self.incoming_dir)):
+            if count >= max_ids:
+                break
+            path = os.path.join(self.processing_dir, name)
+            try:
+                os.replace(os.path.join(self.incoming_dir, name), path)
+            except FileNotFoundError:
+                continue
+            with open(path, encoding='utf-8') as file:
+                msg_ids = [line.strip() for line in file if line.strip()]
+            claimed.append((path, msg_ids))
+            count += len(msg_ids)
+        return claimed
+
+    def done(self, paths):
+        for path in paths:
+            os.remove(path)
+
+
+class TrackerDaemon:
+    # Keeps the Gmail client, the refine stage and the classifier/NER models loaded between batches
+    def __init__(self, spool, max_batch=DaemonConfig.MAX_BATCH, max_latency=DaemonConfig.MAX_LATENCY,
+                 poll_interval=DaemonConfig.POLL_INTERVAL, gmail_poll_interval=DaemonConfig.GMAIL_POLL_INTERVAL):
+        self.spool = spool
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.poll_interval = poll_interval
+        self.gmail_poll_interval = gmail_poll_interval
+        self.store = EmailStore(StoreConfig.DB_PATH)
+        self.fetch_manager = SQLiteManager(GmailService().service, self.store)
+        self.refine_manager = refine_stage.StoreFileManager(self.store)
+        self.classify_manager = classify_stage.StoreDataManager(self.store, PipelineConfig.APPLICATION_TRACKER_PATH)
+        self.refiner = refine_stage.EmailProcessor(refine_stage.RefineConfig.WORKERS)
+        self.classifier = classify_stage.EmailProcessor()
+        self.classifier.load()
+        self.pending_ids = {}
+        self.pending_paths = []
+        self.pending_since = None
+        self.last_gmail_poll = None
+        self.running = False
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def collect(self):
+        for path, msg_ids in self.spool.claim(self.max_batch - len(self.pending_ids)):
+            self.pending_paths.append(path)
+            self.pending_ids.update(dict.fromkeys(msg_ids))
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+
+    def batch_due(self):
+        if not self.pending_ids:
+            return False
+        return len(self.pending_ids) >= self.max_batch or time.monotonic() - self.pending_since >= self.max_latency
+
+    def gmail_due(self):
+        if self.gmail_poll_interval is None:
+            return False
+        return self.last_gmail_poll is None or time.monotonic() - self.last_gmail_poll >= self.gmail_poll_interval
+
+    def fetch(self, msg_ids):
+        existing_ids = self.store.existing_ids(msg_ids)
+        new_ids = [msg_id for msg_id in msg_ids if msg_id not in existing_ids]
+        emails, failed_ids = self.fetch_manager.email_manager.fetch_new(new_ids, self.fetch_manager.rate_limiter)
+        self.store.add_fetched(emails)
+        self.store.add_failed(failed_ids)
+
+    def track_pending(self):
+        # Everything not yet refined or classified is picked up, including rows a one-shot run left behind
+        for chunk in self.store.iter_pending_refine(self.max_batch):
+            self.refine_manager.append_emails(self.refiner.process_emails(chunk, []))
+        tracked = 0
+        for emails_data in self.classify_manager.iter_emails(self.max_batch):
+            self.classify_manager.application_tracker.update_application_tracker(emails_data, self.classifier)
+            self.classify_manager.flush_emails(emails_data)
+            tracked += emails_data.shape[0]
+        if DaemonConfig.EXPORT_CSV and tracked:
+            self.classify_manager.application_tracker.export()
+        return tracked
+
+    def process_batch(self):
+        start = time.monotonic()
+        self.fetch(list(self.pending_ids))
+        tracked = self.track_pending()
+        self.spool.done(self.pending_paths)
+        waited = start - self.pending_since
+        metrics.observe('daemon_batch_wait_seconds', waited)
+        metrics.observe('daemon_batch_seconds', time.monotonic() - start)
+        metrics.inc('tracked_emails_total', tracked)
+        # A long-running process is scraped between batches rather than at exit
+        metrics.export()
+        print(f"Tracked {tracked} emails from {len(self.pending_ids)} submitted IDs, "
+              f"waited {waited:.1f}s, processed in {time.monotonic() - start:.1f}s")
+        self.pending_ids = {}
+        self.pending_paths = []
+        self.pending_since = None
+
+    def poll_gmail(self):
+        self.last_gmail_poll = time.monotonic()
+        for _ in self.fetch_manager.iter_new_emails(PipelineConfig.START_DATE):
+            pass
+        tracked = self.track_pending()
+        if tracked:
+            metrics.inc('tracked_emails_total', tracked)
+            metrics.export()
+            print(f"Tracked {tracked} emails found in Gmail")
+
+    def run(self):
+        self.spool.recover()
+        self.running = True
+        print(f"Waiting for message IDs in {self.spool.incoming_dir}")
+        try:
+            while self.running:
+                self.collect()
+                if self.batch_due():
+                    self.process_batch()
+                elif self.gmail_due():
+                    self.poll_gmail()
+                else:
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.refiner.close()
+            print("Tracker daemon stopped")
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'submit':
+        print(f"Queued {Spool().submit(sys.argv[2:])}")
+        return
+    if StoreConfig.BACKEND != 'sqlite':
+        print("The tracker daemon needs StoreConfig.BACKEND = 'sqlite'")
+        return
+    refine_stage.set_max_csv_field_size()
+    with metrics.run('trackerDaemon'):
+        daemon = TrackerDaemon(Spool())
+        signal.signal(signal.SIGTERM, daemon.stop)
+        daemon.run()
+
+if __name__ == "__main__":
+    main()
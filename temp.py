@@ -1,6 +1,14 @@
+import sys
 import pandas as pd
 
-data = pd.read_csv('processEmails/processed_emails.csv')
+sys.path.append('common')
+from emailStore import StoreConfig
+
+if StoreConfig.PROCESSED_FORMAT == 'parquet':
+    from processedStore import ProcessedStore
+    data = ProcessedStore(StoreConfig.PROCESSED_DIR).read(columns=['text'])
+else:
+    data = pd.read_csv(StoreConfig.PROCESSED_CSV_PATH)
 
 df = '\n'.join(data['text'])
 
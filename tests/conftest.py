@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The scripts put common/ on sys.path themselves; the tests import their modules directly
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for directory in ('common', 'mail', 'processEmails'):
+    sys.path.insert(0, os.path.join(ROOT, directory))
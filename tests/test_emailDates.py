@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip('numpy')
+from emailDates import date_to_epoch, dates_to_epochs
+
+DATES = [
+    'Tue, 15 Aug 2023 19:48:01 +0000',
+    'Tue, 5 Sep 2023 07:02:09 -0700',
+    'Wed, 06 Dec 2023 23:59:59 +0530 (IST)',
+    'Thu, 29 Feb 2024 12:00:00 +0100',
+    'Sat, 31 dec 1999 23:59:59 +0000',
+    'Mon, 1 Jan 2024 00:00:00 GMT',
+    '15 Aug 2023 19:48:01 +0000',
+    'Wed, 29 Feb 2023 12:00:00 +0000',
+    'Tue, 15 Aug 2023 25:48:01 +0000',
+    'Tue, 15 Aug 2023 19:48:01 +9999',
+    'Tue, 15 Aug 2023 19:48:01 -2400',
+    'Tue, 15 Aug 2023 19:48:01 +2360',
+    'Tue, 15 Aug 2023 19:48:01 +0560',
+    'No Date',
+    '',
+    'not a date',
+    None,
+]
+
+def test_matches_date_to_epoch():
+    assert dates_to_epochs(DATES) == [date_to_epoch(date) for date in DATES]
+
+def test_fast_path_values():
+    assert dates_to_epochs(['Tue, 15 Aug 2023 19:48:01 +0000', 'Tue, 5 Sep 2023 07:02:09 -0700']) == [1692128881, 1693922529]
+
+def test_invalid_dates_are_none():
+    assert dates_to_epochs(['Wed, 29 Feb 2023 12:00:00 +0000', 'Tue, 15 Aug 2023 19:48:01 +9999', 'No Date', None]) == [None] * 4
+
+def test_empty():
+    assert dates_to_epochs([]) == []
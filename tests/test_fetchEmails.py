@@ -0,0 +1,69 @@
+import base64
+import json
+import pytest
+
+pytest.importorskip('googleapiclient')
+import httplib2
+from googleapiclient.errors import HttpError
+from fetchEmails import EmailManager, RateLimiter, classify_error
+
+def http_error(status, reason=None):
+    content = json.dumps({'error': {'errors': [{'reason': reason}]}}).encode('utf-8') if reason else b''
+    return HttpError(httplib2.Response({'status': status}), content)
+
+def test_classify_error():
+    assert classify_error(http_error(429)) == 'rate_limit'
+    assert classify_error(http_error(403, 'userRateLimitExceeded')) == 'rate_limit'
+    assert classify_error(http_error(403, 'forbidden')) == 'permanent'
+    assert classify_error(http_error(404)) == 'permanent'
+    assert classify_error(http_error(408)) == 'transient'
+    assert classify_error(http_error(503)) == 'transient'
+    assert classify_error(TimeoutError()) == 'transient'
+
+def test_rate_halves_on_quota_errors_down_to_the_minimum():
+    limiter = RateLimiter(40, min_rate=4, burst=50, increase=1.0)
+    limiter.on_rate_limited()
+    assert limiter.rate == 20
+    assert limiter.tokens <= 0
+    for _ in range(5):
+        limiter.on_rate_limited()
+    assert limiter.rate == 4
+
+def test_rate_rises_additively_up_to_the_maximum():
+    limiter = RateLimiter(40, min_rate=4, burst=50, increase=1.0)
+    limiter.on_rate_limited()
+    limiter.on_success()
+    limiter.on_success()
+    assert limiter.rate == 22
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.rate == 40
+
+def test_no_rate_never_waits(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda seconds: pytest.fail('slept'))
+    limiter = RateLimiter(None)
+    limiter.acquire(1000)
+    limiter.on_rate_limited()
+    limiter.on_success()
+    assert not limiter.rate
+
+def test_acquire_waits_out_debt(monkeypatch):
+    slept = []
+    monkeypatch.setattr('time.sleep', slept.append)
+    limiter = RateLimiter(10, min_rate=1, burst=5)
+    limiter.acquire(5)
+    limiter.acquire(5)
+    assert len(slept) == 1 and slept[0] == pytest.approx(0.5, abs=0.05)
+
+def encode(byte_data):
+    return base64.urlsafe_b64encode(byte_data).decode('ascii').rstrip('=')
+
+def test_decode_mime_data_keeps_the_error_sentinel_for_invalid_utf8():
+    assert EmailManager.decode_mime_data(encode('caf\u00e9'.encode('utf-8'))) == 'caf\u00e9'
+    assert EmailManager.decode_mime_data(encode(b'caf\xe9')) == "Error decoding body."
+    assert EmailManager.decode_mime_data(encode(b'caf\xe9' + b'x' * 100), max_chars=10) == "Error decoding body."
+
+def test_decode_mime_data_drops_a_character_split_by_the_cut():
+    text = '\u00e9' * 100
+    assert EmailManager.decode_mime_data(encode(text.encode('utf-8')), max_chars=10) == '\u00e9' * 10
+    assert EmailManager.decode_mime_data(encode(('a' + text).encode('utf-8')), max_chars=10) == 'a' + '\u00e9' * 9
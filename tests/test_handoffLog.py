@@ -0,0 +1,86 @@
+import csv
+import json
+import os
+import threading
+from handoffLog import HandoffConfig, HandoffLog, compact, recover, source_lock
+
+FIELDNAMES = ['MessageID', 'Subject']
+
+def write_csv(path, ids):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        writer.writerows({'MessageID': msg_id, 'Subject': f'subject {msg_id}'} for msg_id in ids)
+
+def read_ids(path):
+    with open(path, newline='', encoding='utf-8') as file:
+        return [row['MessageID'] for row in csv.DictReader(file)]
+
+def write_journal(source, flushed_size):
+    with open(source + HandoffConfig.JOURNAL_SUFFIX, 'w', encoding='utf-8') as file:
+        json.dump({'flushed_size': flushed_size}, file)
+
+def test_compact_moves_consumed_rows(tmp_path):
+    source, flushed = str(tmp_path / 'emails.csv'), str(tmp_path / 'flushed.csv')
+    write_csv(source, ['a', 'b', 'c'])
+    HandoffLog(source).append(['a', 'c'])
+    assert compact(source, flushed) == 2
+    assert read_ids(source) == ['b']
+    assert read_ids(flushed) == ['a', 'c']
+    assert HandoffLog(source).read_ids() == set()
+    assert not os.path.exists(source + HandoffConfig.JOURNAL_SUFFIX)
+
+def test_recover_rolls_back_before_source_replaced(tmp_path):
+    # Crashed while appending to the flushed file: the source's .tmp is still there
+    source, flushed = str(tmp_path / 'emails.csv'), str(tmp_path / 'flushed.csv')
+    write_csv(source, ['a', 'b', 'c'])
+    write_csv(flushed, ['x'])
+    flushed_size = os.path.getsize(flushed)
+    HandoffLog(source).append(['a'])
+    write_csv(source + '.tmp', ['b', 'c'])
+    write_journal(source, flushed_size)
+    with open(flushed, 'a', newline='', encoding='utf-8') as file:
+        file.write('a,subject a\n')
+
+    assert recover(source, flushed) == 'rolled back'
+    assert read_ids(source) == ['a', 'b', 'c']
+    assert read_ids(flushed) == ['x']
+    assert HandoffLog(source).read_ids() == {'a'}
+    assert not os.path.exists(source + '.tmp')
+    assert not os.path.exists(source + HandoffConfig.JOURNAL_SUFFIX)
+
+def test_recover_completes_after_source_replaced(tmp_path):
+    # Crashed after replacing the source but before trimming the log
+    source, flushed = str(tmp_path / 'emails.csv'), str(tmp_path / 'flushed.csv')
+    write_csv(source, ['b', 'c'])
+    write_csv(flushed, ['a'])
+    HandoffLog(source).append(['a', 'c'])
+    write_journal(source, 0)
+
+    assert recover(source, flushed) == 'completed'
+    assert HandoffLog(source).read_ids() == {'c'}
+    assert read_ids(flushed) == ['a']
+    assert not os.path.exists(source + HandoffConfig.JOURNAL_SUFFIX)
+
+def test_recover_without_journal_removes_stale_tmp(tmp_path):
+    source, flushed = str(tmp_path / 'emails.csv'), str(tmp_path / 'flushed.csv')
+    write_csv(source, ['a'])
+    write_csv(source + '.tmp', [])
+    assert recover(source, flushed) is None
+    assert not os.path.exists(source + '.tmp')
+    assert read_ids(source) == ['a']
+
+def test_compact_waits_for_appending_producer(tmp_path):
+    source, flushed = str(tmp_path / 'emails.csv'), str(tmp_path / 'flushed.csv')
+    write_csv(source, ['a', 'b'])
+    HandoffLog(source).append(['a'])
+    with source_lock(source):
+        compaction = threading.Thread(target=compact, args=(source, flushed))
+        compaction.start()
+        compaction.join(0.2)
+        assert compaction.is_alive()
+        with open(source, 'a', newline='', encoding='utf-8') as file:
+            csv.DictWriter(file, fieldnames=FIELDNAMES).writerow({'MessageID': 'c', 'Subject': 'subject c'})
+    compaction.join()
+    assert read_ids(source) == ['b', 'c']
+    assert read_ids(flushed) == ['a']
@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('transformers')
+from llm_inference import NLIEngine
+
+def engine(batch_size, max_batch_tokens):
+    # make_batches only reads the batch limits, so the model and tokenizer are left out
+    nli_engine = NLIEngine.__new__(NLIEngine)
+    nli_engine.batch_size = batch_size
+    nli_engine.max_batch_tokens = max_batch_tokens
+    return nli_engine
+
+def pairs(*lengths):
+    return [([0] * length, None) for length in lengths]
+
+def test_fixed_batches_keep_order():
+    assert engine(2, None).make_batches(pairs(5, 1, 3, 2, 4)) == [[0, 1], [2, 3], [4]]
+
+def test_token_budget_groups_similar_lengths():
+    batches = engine(8, 12).make_batches(pairs(5, 1, 6, 2, 4, 1))
+    assert batches == [[1, 5, 3], [4, 0], [2]]
+
+def test_every_pair_in_one_batch_within_limits():
+    lengths = [7, 3, 12, 1, 9, 4, 4, 30, 2, 8]
+    batch_size, max_batch_tokens = 3, 24
+    batches = engine(batch_size, max_batch_tokens).make_batches(pairs(*lengths))
+    assert sorted(index for batch in batches for index in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) <= batch_size
+        # A pair longer than the budget still gets a batch of its own
+        assert len(batch) == 1 or len(batch) * max(lengths[index] for index in batch) <= max_batch_tokens
+
+def test_no_pairs():
+    assert engine(4, 16).make_batches([]) == []
+    assert engine(4, None).make_batches([]) == []
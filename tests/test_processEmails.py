@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip('nltk')
+from processEmails import LemmaCache
+
+class SuffixLemmatizer:
+    def lemmatize(self, word):
+        return word[:-1] if word.endswith('s') else word
+
+def test_drain_reports_lookups_since_the_last_drain():
+    worker_cache = LemmaCache(SuffixLemmatizer())
+    worker_cache.learned = []
+    for word in ['jobs', 'jobs', 'roles']:
+        worker_cache.lemmatize(word)
+    assert worker_cache.drain() == ([('jobs', 'job'), ('roles', 'role')], 1, 2)
+    worker_cache.lemmatize('jobs')
+    assert worker_cache.drain() == ([], 1, 0)
+
+def test_merge_adds_worker_lemmas_within_the_bound():
+    cache = LemmaCache(SuffixLemmatizer(), max_size=2)
+    cache.lemmatize('offers')
+    cache.merge([('jobs', 'job'), ('roles', 'role')], 3, 2)
+    assert list(cache.cache.items()) == [('jobs', 'job'), ('roles', 'role')]
+    assert cache.stats() == {'hits': 3, 'misses': 3, 'size': 2, 'hit_rate': 0.5}
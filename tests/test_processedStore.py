@@ -0,0 +1,98 @@
+import json
+import pytest
+
+pytest.importorskip('pyarrow')
+pytest.importorskip('pandas')
+from processedStore import ProcessedStore
+
+def emails(*ids, date='2023-08-15 19:48:01+00:00'):
+    return [{'MessageID': msg_id, 'From': 'jobs@acme.com', 'To': 'me', 'Subject': 's', 'Body': 'b',
+             'Date': 'Tue, 15 Aug 2023 19:48:01 +0000', 'Headers': '', 'text': f'text {msg_id}', 'ParsedDate': date}
+            for msg_id in ids]
+
+def stores(tmp_path):
+    return ProcessedStore(str(tmp_path / 'processed')), ProcessedStore(str(tmp_path / 'flushed'))
+
+def test_move(tmp_path):
+    processed, flushed = stores(tmp_path)
+    processed.append(emails('a', 'b'))
+    processed.append(emails('c', date='2023-09-01 00:00:00+00:00'))
+    assert processed.move(['a', 'c'], flushed) == 2
+    assert processed.ids() == {'b'}
+    assert flushed.ids() == {'a', 'c'}
+
+def test_recover_rolls_back_an_unfinished_move(tmp_path):
+    # Crashed while writing the target: its files are deleted and the rows stay where they were
+    processed, flushed = stores(tmp_path)
+    processed.append(emails('a', 'b'))
+    flushed.append(emails('a'), token='t1')
+    processed.write_journal({'target': flushed.root, 'token': 't1', 'ids': ['a'], 'appended': False})
+    assert processed.recover() == 'rolled back'
+    assert processed.ids() == {'a', 'b'}
+    assert flushed.ids() == set()
+
+def test_recover_completes_a_written_move(tmp_path):
+    # Crashed after writing the target: the rows are removed from the source
+    processed, flushed = stores(tmp_path)
+    processed.append(emails('a', 'b'))
+    flushed.append(emails('a'), token='t1')
+    processed.write_journal({'target': flushed.root, 'token': 't1', 'ids': ['a'], 'appended': True})
+    assert processed.recover() == 'completed'
+    assert processed.ids() == {'b'}
+    assert flushed.ids() == {'a'}
+    assert processed.recover() is None
+
+def test_move_recovers_first(tmp_path):
+    processed, flushed = stores(tmp_path)
+    processed.append(emails('a', 'b', 'c'))
+    flushed.append(emails('a'), token='t1')
+    with open(processed.journal_path, 'w', encoding='utf-8') as file:
+        json.dump({'target': flushed.root, 'token': 't1', 'ids': ['a'], 'appended': True}, file)
+    assert processed.move(['b'], flushed) == 1
+    assert processed.ids() == {'c'}
+    assert sorted(flushed.read(['MessageID'])['MessageID']) == ['a', 'b']
+
+def test_compact_merges_partition_files(tmp_path):
+    processed, _ = stores(tmp_path)
+    for msg_id in 'abcd':
+        processed.append(emails(msg_id))
+    processed.append(emails('e', date='2023-09-01 00:00:00+00:00'))
+    directory = str(tmp_path / 'processed' / 'month=2023-08')
+    assert len(processed.partition_files(directory)) == 4
+    assert processed.compact() == 1
+    assert len(processed.partition_files(directory)) == 1
+    assert processed.ids() == set('abcde')
+
+def test_append_merges_a_month_past_the_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr('emailStore.StoreConfig.PROCESSED_MAX_PARTITION_FILES', 2)
+    processed, _ = stores(tmp_path)
+    for msg_id in 'abc':
+        processed.append(emails(msg_id))
+    assert len(processed.partition_files(str(tmp_path / 'processed' / 'month=2023-08'))) == 1
+    assert processed.ids() == set('abc')
+
+def test_recover_partition_after_rename(tmp_path):
+    # Crashed after renaming the merged file: the files it replaced are deleted
+    processed, _ = stores(tmp_path)
+    processed.append(emails('a'))
+    processed.append(emails('b'))
+    directory = tmp_path / 'processed' / 'month=2023-08'
+    files = processed.partition_files(str(directory))
+    processed.append(emails('a', 'b'), token='merged')
+    merged = [name for name in processed.partition_files(str(directory)) if name not in files][0]
+    (directory / '.compact').write_text(json.dumps({'merged': merged, 'tmp': '.part-x.tmp', 'files': files}))
+    processed.recover_partition(str(directory))
+    assert processed.partition_files(str(directory)) == [merged]
+    assert sorted(processed.read(['MessageID'])['MessageID']) == ['a', 'b']
+
+def test_recover_partition_before_rename(tmp_path):
+    processed, _ = stores(tmp_path)
+    processed.append(emails('a'))
+    processed.append(emails('b'))
+    directory = tmp_path / 'processed' / 'month=2023-08'
+    files = processed.partition_files(str(directory))
+    (directory / '.part-x.tmp').write_bytes(b'partial')
+    (directory / '.compact').write_text(json.dumps({'merged': 'part-x-0.parquet', 'tmp': '.part-x.tmp', 'files': files}))
+    processed.recover_partition(str(directory))
+    assert processed.partition_files(str(directory)) == files
+    assert sorted(directory.iterdir()) == sorted(directory / name for name in files)
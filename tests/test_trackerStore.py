@@ -0,0 +1,45 @@
+from trackerStore import TrackerStore
+
+def update(company, status, date, message_id, email='jobs@acme.com'):
+    return {'Company Name': company, 'Email': email, 'Status': status, 'Status Updated': date, 'MessageID': message_id}
+
+def test_older_status_does_not_replace_newer(tmp_path):
+    store = TrackerStore(str(tmp_path / 'tracker.db'))
+    store.upsert_many([update('Acme', 'Rejected', 'Tue, 15 Aug 2023 19:48:01 +0000', 'm2')])
+    store.upsert_many([update('Acme', 'Applied', 'Mon, 14 Aug 2023 10:00:00 +0000', 'm1')])
+    assert [row['Status'] for row in store.rows()] == ['Rejected']
+    assert [row['Status'] for row in store.history('Acme', 'jobs@acme.com')] == ['Applied', 'Rejected']
+    store.close()
+
+def test_later_status_in_one_batch_wins_whatever_the_order(tmp_path):
+    store = TrackerStore(str(tmp_path / 'tracker.db'))
+    store.upsert_many([update('Acme Inc.', 'Accepted', 'Wed, 16 Aug 2023 09:00:00 +0000', 'm3'),
+                       update('acme', 'Applied', 'Mon, 14 Aug 2023 10:00:00 +0000', 'm1')])
+    rows = store.rows()
+    assert len(rows) == 1
+    assert rows[0]['Status'] == 'Accepted'
+    assert rows[0]['Company Name'] == 'Acme Inc.'
+    store.close()
+
+def test_equal_dates_take_the_latest_update(tmp_path):
+    store = TrackerStore(str(tmp_path / 'tracker.db'))
+    date = 'Tue, 15 Aug 2023 19:48:01 +0000'
+    store.upsert_many([update('Acme', 'Applied', date, 'm1'), update('Acme', 'Rejected', date, 'm2')])
+    assert [row['Status'] for row in store.rows()] == ['Rejected']
+    store.close()
+
+def test_same_company_from_other_domains_is_kept_apart(tmp_path):
+    store = TrackerStore(str(tmp_path / 'tracker.db'))
+    store.upsert_many([update('Acme', 'Applied', 'Mon, 14 Aug 2023 10:00:00 +0000', 'm1'),
+                       update('Acme', 'Rejected', 'Tue, 15 Aug 2023 10:00:00 +0000', 'm2', email='no-reply@acme.io')])
+    assert store.count() == 2
+    store.close()
+
+def test_rows_list_rejected_last(tmp_path):
+    store = TrackerStore(str(tmp_path / 'tracker.db'))
+    date = 'Mon, 14 Aug 2023 10:00:00 +0000'
+    store.upsert_many([update('Zeta', 'Applied', date, 'm1', email='z@zeta.com'),
+                       update('Beta', 'Rejected', date, 'm2', email='b@beta.com'),
+                       update('Alpha', 'Accepted', date, 'm3', email='a@alpha.com')])
+    assert [row['Company Name'] for row in store.rows()] == ['Alpha', 'Zeta', 'Beta']
+    store.close()